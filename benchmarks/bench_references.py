@@ -0,0 +1,119 @@
+"""
+Mergin Media Sync - a tool to sync media files from Mergin projects to other storage backends
+
+Copyright (C) 2021 Lutra Consulting
+
+License: MIT
+
+Benchmark of reference updates in GeoPackage with several reference tables.
+
+Compares update with connection per reference table and statement per file (the original approach)
+with update grouped per GeoPackage file. Run from repository root:
+
+    python benchmarks/bench_references.py --tables 3 --rows 10000 --files 5000
+"""
+
+import argparse
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import config  # noqa: E402
+from media_sync import _quote_identifier, _update_references  # noqa: E402
+
+
+def create_gpkg(path, tables, rows):
+    """Create synthetic GeoPackage-like database with reference tables"""
+    conn = sqlite3.connect(path)
+    for table in tables:
+        conn.execute(
+            f"CREATE TABLE {table} (fid INTEGER PRIMARY KEY, photo TEXT, ext_url TEXT)"
+        )
+        conn.executemany(
+            f"INSERT INTO {table} (photo) VALUES (?)",
+            ((f"images/img{i}.jpg",) for i in range(rows)),
+        )
+    conn.commit()
+    conn.close()
+
+
+def _try_load_spatialite(conn):
+    try:
+        conn.enable_load_extension(True)
+        conn.execute('SELECT load_extension("mod_spatialite")')
+    except (AttributeError, sqlite3.OperationalError):
+        pass
+
+
+def update_references_per_table(files):
+    """Original approach - new connection per reference, one statement per file"""
+    for ref in config.references:
+        conn = sqlite3.connect(os.path.join(config.project_working_dir, ref.file))
+        _try_load_spatialite(conn)
+        cur = conn.cursor()
+        for file_path, dest in files.items():
+            sql = (
+                f"UPDATE {_quote_identifier(ref.table)} "
+                f"SET {_quote_identifier(ref.driver_path_column)}=:dest_column "
+                f"WHERE {_quote_identifier(ref.local_path_column)}=:file_path"
+            )
+            cur.execute(sql, {"dest_column": dest, "file_path": file_path})
+        conn.commit()
+        conn.close()
+
+
+def run(update, work_dir, template, files):
+    shutil.copyfile(template, os.path.join(work_dir, "survey.gpkg"))
+    start = time.perf_counter()
+    update(files)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[2])
+    parser.add_argument("--tables", type=int, default=3)
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--files", type=int, default=2000)
+    args = parser.parse_args()
+
+    tables = [f"table_{i}" for i in range(args.tables)]
+    work_dir = tempfile.mkdtemp(prefix="bench_references_")
+    template = os.path.join(work_dir, "template.gpkg")
+    create_gpkg(template, tables, args.rows)
+    config.update(
+        {
+            "PROJECT_WORKING_DIR": work_dir,
+            "OPERATION_MODE": "copy",
+            "REFERENCES": [
+                {
+                    "file": "survey.gpkg",
+                    "table": table,
+                    "local_path_column": "photo",
+                    "driver_path_column": "ext_url",
+                }
+                for table in tables
+            ],
+        }
+    )
+    files = {
+        f"images/img{i}.jpg": f"https://example.com/images/img{i}.jpg"
+        for i in range(args.files)
+    }
+
+    print(f"{args.tables} tables with {args.rows} rows, {args.files} uploaded files")
+    try:
+        baseline = run(update_references_per_table, work_dir, template, files)
+        print(f"per table and file: {baseline:.3f} s")
+        grouped = run(_update_references, work_dir, template, files)
+        print(f"grouped per file:   {grouped:.3f} s ({baseline / grouped:.1f}x)")
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+"""
+Mergin Media Sync - a tool to sync media files from Mergin projects to other storage backends
+
+Copyright (C) 2021 Lutra Consulting
+
+License: MIT
+
+Benchmark of sync hot paths with offline stand-ins for Mergin server and storage backend.
+
+Synthetic project with photos and GeoPackage referencing them is synced with fake Mergin client
+and driver with injected latency. Reports throughput of download, pull, push and reference update,
+results can be saved and compared with a baseline to catch regressions. Run from repository root:
+
+    python benchmarks/bench_sync.py --photos 1000 --photo-size 100000 --rows 10000 --workers 8
+    python benchmarks/bench_sync.py --save baseline.json
+    python benchmarks/bench_sync.py --baseline baseline.json --tolerance 0.2
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import config  # noqa: E402
+from media_sync import (  # noqa: E402
+    _update_references,
+    mc_download,
+    mc_pull,
+    media_sync_push,
+)
+from harness import (  # noqa: E402
+    FakeMerginClient,
+    FakeMerginServer,
+    LatencyDriver,
+    generate_photos,
+    generate_project,
+)
+
+
+def setup_config(work_dir, args):
+    config.update(
+        {
+            "MERGIN__PROJECT_NAME": "bench/project",
+            "PROJECT_WORKING_DIR": work_dir,
+            "ALLOWED_EXTENSIONS": ["jpg"],
+            "BASE_PATH": "",
+            "OPERATION_MODE": "copy",
+            "MANIFEST__FILE": "",
+            "UPLOAD__WORKERS": args.workers,
+            "UPLOAD__ENGINE": "threads",
+            "UPLOAD__DEDUPLICATE": False,
+            "UPLOAD__BATCH_SIZE": 0,
+            "REFERENCES": [
+                {
+                    "file": "survey.gpkg",
+                    "table": "notes",
+                    "local_path_column": "photo",
+                    "driver_path_column": "ext_url",
+                }
+            ],
+        }
+    )
+
+
+def bench_download(root, args):
+    """Download of whole project and listing of files to sync"""
+    server = FakeMerginServer(os.path.join(root, "server"))
+    mc = FakeMerginClient(server, args.api_latency)
+    start = time.perf_counter()
+    files = mc_download(mc, config)
+    return time.perf_counter() - start, len(files)
+
+
+def bench_pull(root, args):
+    """Pull of new version with added photos to existing working directory"""
+    server = FakeMerginServer(os.path.join(root, "server"))
+    mc = FakeMerginClient(server, args.api_latency)
+    mc_download(mc, config)
+    generate_photos(server.dir, args.new_photos, args.photo_size, start=args.photos)
+    server.commit()
+    start = time.perf_counter()
+    files = mc_pull(mc, config)
+    return time.perf_counter() - start, len(files)
+
+
+def bench_push(root, args):
+    """Upload of all photos with driver latency, reference update and push to Mergin"""
+    server = FakeMerginServer(os.path.join(root, "server"))
+    mc = FakeMerginClient(server, args.api_latency)
+    files = mc_download(mc, config)
+    driver = LatencyDriver(config, args.upload_latency, args.bandwidth)
+    start = time.perf_counter()
+    media_sync_push(mc, driver, files, config)
+    return time.perf_counter() - start, len(files)
+
+
+def bench_references(root, args):
+    """Update of references to all photos in GeoPackage"""
+    server = FakeMerginServer(os.path.join(root, "server"))
+    mc = FakeMerginClient(server)
+    files = mc_download(mc, config)
+    migrated_files = {f["path"]: "bench://" + f["path"] for f in files}
+    start = time.perf_counter()
+    _update_references(migrated_files, config)
+    return time.perf_counter() - start, args.rows
+
+
+BENCHMARKS = {
+    "mc_download": (bench_download, "files"),
+    "mc_pull": (bench_pull, "files"),
+    "media_sync_push": (bench_push, "files"),
+    "_update_references": (bench_references, "rows"),
+}
+
+
+def run(name, template, args):
+    """Run benchmark repeatedly with fresh copy of project, returns the best result"""
+    bench, _ = BENCHMARKS[name]
+    best = None
+    for _ in range(args.repeat):
+        root = tempfile.mkdtemp(prefix="bench_sync_")
+        try:
+            shutil.copytree(template, os.path.join(root, "server"))
+            setup_config(os.path.join(root, "work"), args)
+            # progress messages of sync are not part of the report
+            output = None if args.verbose else open(os.devnull, "w")
+            with contextlib.redirect_stdout(output or sys.stdout):
+                elapsed, count = bench(root, args)
+            if output:
+                output.close()
+        finally:
+            shutil.rmtree(root)
+        if best is None or elapsed < best[0]:
+            best = (elapsed, count)
+    return best
+
+
+def compare(results, baseline, tolerance):
+    """Returns names of benchmarks with throughput lower than baseline by more than tolerance"""
+    return [
+        name
+        for name, result in results.items()
+        if name in baseline
+        and result["throughput"] < baseline[name]["throughput"] * (1 - tolerance)
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[2])
+    parser.add_argument("--photos", type=int, default=500)
+    parser.add_argument("--photo-size", type=int, default=100000, help="bytes")
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--new-photos", type=int, default=100, help="added by pull")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--upload-latency", type=float, default=0.01, help="seconds")
+    parser.add_argument("--bandwidth", type=float, help="bytes per second")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="seconds")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--only", action="append", choices=list(BENCHMARKS))
+    parser.add_argument("--verbose", action="store_true", help="print sync messages")
+    parser.add_argument("--save", help="write results to JSON file")
+    parser.add_argument("--baseline", help="compare results with JSON file")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    template = tempfile.mkdtemp(prefix="bench_sync_template_")
+    generate_project(template, args.photos, args.photo_size, args.rows)
+    print(
+        f"{args.photos} photos of {args.photo_size} bytes, {args.rows} rows, "
+        f"{args.workers} workers, best of {args.repeat}"
+    )
+
+    results = {}
+    try:
+        for name in args.only or BENCHMARKS:
+            elapsed, count = run(name, template, args)
+            unit = BENCHMARKS[name][1]
+            results[name] = {
+                "seconds": elapsed,
+                unit: count,
+                "throughput": count / elapsed,
+            }
+            print(f"{name:<20} {elapsed:8.3f} s {count / elapsed:12.1f} {unit}/s")
+    finally:
+        shutil.rmtree(template)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print("Regressions against baseline: " + ", ".join(regressions))
+            sys.exit(1)
+        print("No regressions against baseline")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+"""
+Mergin Media Sync - a tool to sync media files from Mergin projects to other storage backends
+
+Copyright (C) 2021 Lutra Consulting
+
+License: MIT
+
+Offline stand-ins for Mergin server and storage backends and generator of synthetic projects for benchmarks.
+"""
+
+import json
+import os
+import shutil
+import sqlite3
+import time
+
+from mergin import MerginProject
+
+from drivers import Driver
+from file_index import scan_project_files
+
+# photos are filled with random data in blocks of this size, so large photos are generated quickly
+PHOTO_BLOCK_SIZE = 64 * 1024
+
+
+def generate_photos(directory, count, size, start=0):
+    """Create photos with random content in images/ subdirectory
+    :param directory: str project directory
+    :param count: int number of photos
+    :param size: int size of each photo in bytes
+    :param start: int number of the first photo
+    :return: list(str) project paths of created photos
+    """
+    os.makedirs(os.path.join(directory, "images"), exist_ok=True)
+    block = os.urandom(min(size, PHOTO_BLOCK_SIZE))
+    paths = []
+    for i in range(start, start + count):
+        path = f"images/img{i}.jpg"
+        with open(os.path.join(directory, path), "wb") as f:
+            # unique prefix so that photos have different checksums
+            f.write(str(i).encode().ljust(16))
+            written = 16
+            while written < size:
+                chunk = block[: size - written]
+                f.write(chunk)
+                written += len(chunk)
+        paths.append(path)
+    return paths
+
+
+def generate_gpkg(path, rows, photos):
+    """Create GeoPackage-like database with notes table referencing photos
+    :param path: str path to database file
+    :param rows: int number of rows, rows are assigned to photos round robin
+    :param photos: list(str) project paths of photos
+    """
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "CREATE TABLE notes (fid INTEGER PRIMARY KEY, photo TEXT, ext_url TEXT)"
+    )
+    conn.executemany(
+        "INSERT INTO notes (photo) VALUES (?)",
+        ((photos[i % len(photos)] if photos else None,) for i in range(rows)),
+    )
+    conn.commit()
+    conn.close()
+
+
+def generate_project(directory, photos, photo_size, rows):
+    """Create project with photos and survey.gpkg with references to them
+    :param directory: str project directory
+    :param photos: int number of photos
+    :param photo_size: int size of each photo in bytes
+    :param rows: int number of rows in notes table
+    """
+    paths = generate_photos(directory, photos, photo_size)
+    generate_gpkg(os.path.join(directory, "survey.gpkg"), rows, paths)
+
+
+class FakeMerginServer:
+    """Project history of single project kept in local directory, stand-in for Mergin server"""
+
+    def __init__(self, directory, full_name="bench/project"):
+        """
+        :param directory: str directory with project files of the latest version
+        :param full_name: str project name with namespace
+        """
+        self.dir = directory
+        self.full_name = full_name
+        self.versions = []
+        self.commit()
+
+    @property
+    def version(self):
+        return f"v{len(self.versions)}"
+
+    @property
+    def files(self):
+        return self.versions[-1]
+
+    def commit(self):
+        """Create new version from current content of project directory"""
+        files = scan_project_files(self.dir, lambda name: False)
+        for f in files:
+            f["mtime"] = f["mtime"].isoformat()
+        self.versions.append(files)
+        return self.version
+
+
+class FakeMerginClient:
+    """Stand-in for MerginClient working with FakeMerginServer, each API call takes given latency"""
+
+    def __init__(self, server, latency=0.0):
+        self.server = server
+        self.latency = latency
+        self.calls = []
+
+    def _call(self, name):
+        self.calls.append(name)
+        if self.latency:
+            time.sleep(self.latency)
+
+    def get_projects_by_names(self, projects):
+        self._call("get_projects_by_names")
+        return {
+            name: (
+                {"version": self.server.version}
+                if name == self.server.full_name
+                else {"error": 404}
+            )
+            for name in projects
+        }
+
+    def project_info(self, project_path, since=None, version=None):
+        self._call("project_info")
+        files = [dict(f, history={}) for f in self.server.files]
+        return {"version": self.server.version, "files": files}
+
+    def download_project(self, project_path, directory):
+        self._call("download_project")
+        os.makedirs(directory)
+        self._transfer(self.server.dir, directory, self.server.files)
+        self._write_metadata(directory)
+
+    def pull_project(self, directory):
+        self._call("pull_project")
+        mp = MerginProject(directory)
+        changes = mp.compare_file_sets(mp.files(), self.server.files)
+        self._transfer(
+            self.server.dir, directory, changes["added"] + changes["updated"]
+        )
+        for f in changes["removed"]:
+            os.remove(os.path.join(directory, f["path"]))
+        self._write_metadata(directory)
+
+    def push_project(self, directory):
+        self._call("push_project")
+        mp = MerginProject(directory)
+        changes = mp.compare_file_sets(mp.files(), mp.inspect_files())
+        self._transfer(
+            directory, self.server.dir, changes["added"] + changes["updated"]
+        )
+        for f in changes["removed"]:
+            os.remove(os.path.join(self.server.dir, f["path"]))
+        self.server.commit()
+        self._write_metadata(directory)
+
+    def _transfer(self, src_dir, dest_dir, files):
+        for f in files:
+            dest = os.path.join(dest_dir, f["path"])
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            shutil.copyfile(os.path.join(src_dir, f["path"]), dest)
+
+    def _write_metadata(self, directory):
+        """Write project metadata like real client, GeoPackages have base copies for diffs"""
+        meta_dir = os.path.join(directory, ".mergin")
+        os.makedirs(meta_dir, exist_ok=True)
+        namespace, name = self.server.full_name.split("/")
+        for f in self.server.files:
+            if f["path"].endswith(".gpkg"):
+                shutil.copyfile(
+                    os.path.join(directory, f["path"]),
+                    os.path.join(meta_dir, f["path"]),
+                )
+        with open(os.path.join(meta_dir, "mergin.json"), "w") as f:
+            json.dump(
+                {
+                    "name": name,
+                    "namespace": namespace,
+                    "version": self.server.version,
+                    "files": self.server.files,
+                },
+                f,
+            )
+
+
+class LatencyDriver(Driver):
+    """Driver which only pretends to upload files, each upload takes latency plus transfer time at given bandwidth"""
+
+    def __init__(self, config, latency=0.05, bandwidth=None):
+        """
+        :param latency: float seconds of each upload request
+        :param bandwidth: float bytes per second of each upload, None for no transfer time
+        """
+        super(LatencyDriver, self).__init__(config)
+        self.latency = latency
+        self.bandwidth = bandwidth
+
+    def upload_file(self, src, obj_path):
+        delay = self.latency
+        if self.bandwidth:
+            delay += os.path.getsize(src) / self.bandwidth
+        time.sleep(delay)
+        return "bench://" + obj_path
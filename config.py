@@ -6,10 +6,11 @@ Copyright (C) 2021 Lutra Consulting
 License: MIT
 """
 
+import os
 import pathlib
 
 from dynaconf import Dynaconf
-from drivers import DriverType
+from drivers import DriverType, LocalTransfer, get_driver_names
 
 config = Dynaconf(
     envvar_prefix=False,
@@ -29,11 +30,7 @@ def validate_config(config):
     ):
         raise ConfigError("Config error: Incorrect mergin settings")
 
-    if not (
-        config.driver == DriverType.LOCAL
-        or config.driver == DriverType.MINIO
-        or config.driver == DriverType.GOOGLE_DRIVE
-    ):
+    if str(config.driver) not in get_driver_names():
         raise ConfigError("Config error: Unsupported driver")
 
     if config.operation_mode not in ["move", "copy"]:
@@ -42,6 +39,10 @@ def validate_config(config):
     if config.driver == "local" and not config.local.dest:
         raise ConfigError("Config error: Incorrect Local driver settings")
 
+    transfer = config.get("local.transfer")
+    if transfer and transfer not in [str(t) for t in LocalTransfer]:
+        raise ConfigError("Config error: Unsupported Local driver transfer method")
+
     if config.driver == DriverType.MINIO and not (
         config.minio.endpoint
         and config.minio.access_key
@@ -50,6 +51,82 @@ def validate_config(config):
     ):
         raise ConfigError("Config error: Incorrect MinIO driver settings")
 
+    part_size = config.get("minio.part_size")
+    if part_size and not (isinstance(part_size, int) and part_size >= 5):
+        raise ConfigError("Config error: MinIO part size must be at least 5 MB")
+
+    if config.driver == DriverType.S3:
+        if not (
+            config.get("s3.endpoint")
+            and config.get("s3.access_key")
+            and config.get("s3.secret_key")
+            and config.get("s3.bucket")
+        ):
+            raise ConfigError("Config error: Incorrect S3 driver settings")
+        part_size = config.get("s3.part_size")
+        if part_size and not (isinstance(part_size, int) and part_size >= 5):
+            raise ConfigError("Config error: S3 part size must be at least 5 MB")
+        url_type = config.get("s3.url")
+        if url_type not in [None, "public", "presigned", "cdn"]:
+            raise ConfigError("Config error: Unsupported S3 URL type")
+        if url_type == "cdn" and not config.get("s3.cdn_url"):
+            raise ConfigError("Config error: S3 CDN URL is not set")
+        url_expiration = config.get("s3.url_expiration")
+        if url_expiration is not None and not (
+            isinstance(url_expiration, int) and 0 < url_expiration <= 7 * 24 * 3600
+        ):
+            raise ConfigError(
+                "Config error: S3 URL expiration must be between 1 second and 7 days"
+            )
+
+    workers = config.get("upload.workers")
+    if workers is not None and not (isinstance(workers, int) and workers > 0):
+        raise ConfigError("Config error: Incorrect upload settings")
+
+    batch_size = config.get("upload.batch_size")
+    if batch_size is not None and not (isinstance(batch_size, int) and batch_size >= 0):
+        raise ConfigError("Config error: Incorrect upload settings")
+
+    for key in ["retry.max_attempts", "retry.breaker_threshold"]:
+        value = config.get(key)
+        if value is not None and not (isinstance(value, int) and value > 0):
+            raise ConfigError("Config error: Incorrect retry settings")
+
+    for key in ["checkpoint.files", "checkpoint.minutes"]:
+        value = config.get(key)
+        if value is not None and not (isinstance(value, (int, float)) and value >= 0):
+            raise ConfigError("Config error: Incorrect checkpoint settings")
+
+    rate_limit = config.get("rate_limit") or {}
+    windows = rate_limit.get("windows") or []
+    if not isinstance(windows, list):
+        raise ConfigError("Config error: Incorrect rate limit settings")
+    for window in windows:
+        if not (isinstance(window, dict) and "start" in window and "end" in window):
+            raise ConfigError("Config error: Incorrect rate limit settings")
+    for limits in [rate_limit] + windows:
+        for key in ["bytes_per_second", "requests_per_second"]:
+            value = limits.get(key)
+            if value is not None and not (
+                isinstance(value, (int, float)) and value >= 0
+            ):
+                raise ConfigError("Config error: Incorrect rate limit settings")
+
+    metrics_port = config.get("metrics.port")
+    if metrics_port is not None and not (
+        isinstance(metrics_port, int) and 0 <= metrics_port <= 65535
+    ):
+        raise ConfigError("Config error: Incorrect metrics settings")
+
+    if config.get("upload.engine") not in [None, "threads", "asyncio"]:
+        raise ConfigError("Config error: Unsupported upload engine")
+
+    max_in_flight = config.get("upload.max_in_flight")
+    if max_in_flight is not None and not (
+        isinstance(max_in_flight, int) and max_in_flight > 0
+    ):
+        raise ConfigError("Config error: Incorrect upload settings")
+
     if not (config.allowed_extensions and len(config.allowed_extensions)):
         raise ConfigError("Config error: Allowed extensions can not be empty")
 
@@ -78,6 +155,77 @@ def validate_config(config):
     ):
         raise ConfigError("Config error: Incorrect GoogleDrive driver settings")
 
+    chunk_size = config.get("google_drive.chunk_size")
+    if chunk_size and not (isinstance(chunk_size, int) and chunk_size > 0):
+        raise ConfigError("Config error: Incorrect GoogleDrive chunk size")
+
+    daemon_workers = config.get("daemon.workers")
+    if daemon_workers is not None and not (
+        isinstance(daemon_workers, int) and daemon_workers > 0
+    ):
+        raise ConfigError("Config error: Incorrect daemon settings")
+
+    max_sleep_time = config.get("daemon.max_sleep_time")
+    if max_sleep_time is not None and not (
+        isinstance(max_sleep_time, (int, float)) and max_sleep_time > 0
+    ):
+        raise ConfigError("Config error: Incorrect daemon settings")
+
+    backoff_factor = config.get("daemon.backoff_factor")
+    if backoff_factor is not None and not (
+        isinstance(backoff_factor, (int, float)) and backoff_factor >= 1
+    ):
+        raise ConfigError("Config error: Incorrect daemon settings")
+
+    jitter = config.get("daemon.jitter")
+    if jitter is not None and not (
+        isinstance(jitter, (int, float)) and 0 <= jitter < 1
+    ):
+        raise ConfigError("Config error: Incorrect daemon settings")
+
+
+def get_project_configs(config):
+    """Returns config for each project to sync, project entries override global settings
+    :param config: global config, optionally with list of projects
+    :return: list of configs, only global config if no projects are listed
+    """
+    projects = config.get("projects")
+    if not projects:
+        return [config]
+
+    if not isinstance(projects, list):
+        raise ConfigError(
+            "Config error: Incorrect projects settings. Needs to be list of projects."
+        )
+
+    project_configs = []
+    working_dirs = set()
+    for project in projects:
+        if not (isinstance(project, dict) and project.get("project_name")):
+            raise ConfigError("Config error: Incorrect project settings")
+
+        project_config = config.dynaconf_clone()
+        project_config.set("projects", [])
+        project_config.set("mergin.project_name", project["project_name"])
+        # by default each project gets its own subdirectory of global working dir
+        working_dir = project.get("project_working_dir") or os.path.join(
+            config.project_working_dir, project["project_name"].replace("/", "_")
+        )
+        project_config.set("project_working_dir", working_dir)
+        for key, value in project.items():
+            if key in ["project_name", "project_working_dir"]:
+                continue
+            project_config.set(key, value, merge=isinstance(value, dict))
+
+        working_dir = os.path.abspath(working_dir)
+        if working_dir in working_dirs:
+            raise ConfigError(
+                f"Config error: Projects can not share working directory {working_dir}"
+            )
+        working_dirs.add(working_dir)
+        project_configs.append(project_config)
+    return project_configs
+
 
 def update_config_path(
     path_param: str,
@@ -6,26 +6,38 @@ Copyright (C) 2021 Lutra Consulting
 License: MIT
 """
 
+import asyncio
+import errno
+import filecmp
+import hashlib
+import importlib
+import json
 import os
-from pathlib import Path
 import shutil
-import typing
-import re
+import threading
+import time
 import enum
+from concurrent.futures import ThreadPoolExecutor
+from importlib.metadata import entry_points
 
-from minio import Minio
-from minio.error import S3Error
-from urllib.parse import urlparse, urlunparse
+from metrics import metrics
+from ratelimit import RateLimiter, ThrottledReader
 
-from google.oauth2 import service_account
-from googleapiclient.discovery import build, Resource
-from googleapiclient.http import MediaFileUpload
+try:
+    import fcntl
+except ImportError:
+    # not available on Windows, files are copied there
+    fcntl = None
+
+# entry point group of drivers provided by other packages, value is "module:DriverClass"
+DRIVERS_ENTRY_POINT_GROUP = "mergin_media_sync.drivers"
 
 
 class DriverType(enum.Enum):
     LOCAL = "local"
     MINIO = "minio"
     GOOGLE_DRIVE = "google_drive"
+    S3 = "s3"
 
     def __eq__(self, value):
         if isinstance(value, str):
@@ -42,247 +54,596 @@ class DriverError(Exception):
     pass
 
 
+class TransientDriverError(DriverError):
+    """Error which is likely to go away when upload is repeated, e.g. network failure or overloaded server"""
+
+    pass
+
+
+# HTTP statuses of failures worth retrying
+TRANSIENT_HTTP_STATUSES = [408, 429, 500, 502, 503, 504]
+
+
+class UploadState:
+    """Small JSON file to keep state of unfinished uploads between runs"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._state = {}
+        if os.path.exists(path):
+            try:
+                with open(path, "r") as f:
+                    self._state = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"Ignoring invalid upload state file {path}: " + str(e))
+
+    def get(self, key):
+        with self._lock:
+            return self._state.get(key)
+
+    def set(self, key, value):
+        with self._lock:
+            self._state[key] = value
+            self._save()
+
+    def remove(self, key):
+        with self._lock:
+            if self._state.pop(key, None) is not None:
+                self._save()
+
+    def _save(self):
+        # write to temporary file first so crash does not leave broken state file
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self._state, f)
+        os.replace(tmp_path, self.path)
+
+
 class Driver:
+    # settings of driver config section which determine where files are stored, None for all settings
+    destination_settings = None
+
     def __init__(self, config):
         self.config = config
+        # None if uploads are not limited
+        self.rate_limiter = RateLimiter.from_config(config)
 
     def upload_file(self, src, obj_path):
         """Copy object to destination and return path"""
         raise NotImplementedError
 
+    def copy_file(self, src_path, obj_path):
+        """Copy object uploaded before from src_path to obj_path without sending the data again
+        :return: str destination of copied file or None if driver can not copy objects or source does not exist
+        """
+        return None
+
+    def list_existing(self, prefix=""):
+        """Returns files already present at destination, listed with bulk requests
+        :param prefix: str project path prefix, e.g. directory of files to be uploaded
+        :return: dict map of project paths to dicts with size, dest and driver specific data or None if not supported
+        """
+        return None
+
+    def is_uploaded(self, src, existing):
+        """Returns whether existing file at destination has the same content as local file
+        :param src: str path to local file
+        :param existing: dict file data returned by list_existing()
+        """
+        return False
 
-class LocalDriver(Driver):
-    """Driver to work with local drive, for testing purpose mainly"""
+    def get_url(self, obj_path):
+        """Returns current URL of file uploaded before, e.g. newly signed URL for destination recorded in manifest
+        :param obj_path: str project path the file was uploaded under
+        :return: str destination or None if recorded destination stays valid
+        """
+        return None
+
+
+class CircuitBreaker:
+    """Stops calls to failing service for a while after number of consecutive failures"""
+
+    def __init__(self, threshold, cooldown, clock=time.monotonic):
+        """
+        :param threshold: int number of consecutive failures which opens breaker
+        :param cooldown: float seconds before calls are let through again
+        :param clock: callable returning current time in seconds
+        """
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+
+    def allow(self):
+        """Returns whether call can be made"""
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            # after cooldown calls are let through again, next failure opens breaker again
+            return self._clock() - self._opened_at >= self.cooldown
+
+    @classmethod
+    def from_config(cls, config, clock=time.monotonic):
+        return cls(
+            config.get("retry.breaker_threshold") or 10,
+            config.get("retry.breaker_cooldown") or 300,
+            clock,
+        )
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._failures >= self.threshold:
+                self._opened_at = self._clock()
+
+
+class RetryingDriver(Driver):
+    """Driver wrapper which repeats uploads failed with transient errors with exponential backoff
+    and pauses uploads for a while when driver keeps failing"""
+
+    def __init__(
+        self, driver, config, sleep=time.sleep, clock=time.monotonic, breaker=None
+    ):
+        """
+        :param breaker: optional circuit breaker shared by wrappers of the same driver, e.g. for several projects
+        """
+        # attributes like rate limiter are used from wrapped driver
+        self.driver = driver
+        self.config = config
+        self.project = config.get("mergin.project_name")
+        self.max_attempts = config.get("retry.max_attempts") or 3
+        backoff = config.get("retry.backoff")
+        self.backoff = 1 if backoff is None else backoff
+        self.max_backoff = config.get("retry.max_backoff") or 30
+        self.breaker = breaker or CircuitBreaker.from_config(config, clock)
+        self._sleep = sleep
 
-    def __init__(self, config):
-        super(LocalDriver, self).__init__(config)
-        self.dest = config.local.dest
-
-        try:
-            if not os.path.exists(self.dest):
-                os.makedirs(self.dest)
-        except OSError as e:
-            raise DriverError("Local driver init error: " + str(e))
+    def __getattr__(self, name):
+        return getattr(self.driver, name)
 
     def upload_file(self, src, obj_path):
-        dest = os.path.join(self.dest, obj_path)
-        dest_dir = os.path.dirname(dest)
-        try:
-            if not os.path.exists(dest_dir):
-                os.makedirs(dest_dir)
-            shutil.copyfile(src, dest)
-        except (shutil.SameFileError, OSError) as e:
-            raise DriverError("Local driver error: " + str(e))
-        return dest
+        return self._retry(self.driver.upload_file, src, obj_path)
 
+    def copy_file(self, src_path, obj_path):
+        return self._retry(self.driver.copy_file, src_path, obj_path)
 
-class MinioDriver(Driver):
-    """Driver to handle connection to minio-like server"""
+    def list_existing(self, prefix=""):
+        return self.driver.list_existing(prefix)
 
-    def __init__(self, config):
-        super(MinioDriver, self).__init__(config)
+    def is_uploaded(self, src, existing):
+        return self.driver.is_uploaded(src, existing)
 
-        try:
-            self.client = Minio(
-                endpoint=config.minio.endpoint,
-                access_key=config.minio.access_key,
-                secret_key=config.minio.secret_key,
-                secure=config.as_bool("minio.secure"),
-                region=config.minio.region,
-            )
-            self.bucket = config.minio.bucket
-            bucket_found = self.client.bucket_exists(self.bucket)
-            if not bucket_found:
-                self.client.make_bucket(self.bucket)
-
-            self.bucket_subpath = None
-            if hasattr(config.minio, "bucket_subpath"):
-                if config.minio.bucket_subpath:
-                    self.bucket_subpath = config.minio.bucket_subpath
-
-            # construct base url for bucket
-            scheme = "https://" if config.as_bool("minio.secure") else "http://"
-            self.base_url = scheme + config.minio.endpoint + "/" + self.bucket
-        except S3Error as e:
-            raise DriverError("MinIO driver init error: " + str(e))
+    def get_url(self, obj_path):
+        return self.driver.get_url(obj_path)
 
-    def upload_file(self, src, obj_path):
-        if self.bucket_subpath:
-            obj_path = f"{self.bucket_subpath}/{obj_path}"
-        try:
-            res = self.client.fput_object(self.bucket, obj_path, src)
-            dest = self.base_url + "/" + res.object_name
-        except S3Error as e:
-            raise DriverError("MinIO driver error: " + str(e))
-        return dest
+    def _retry(self, operation, src, obj_path):
+        attempt = 1
+        while True:
+            self._check_breaker()
+            try:
+                dest = operation(src, obj_path)
+            except DriverError as e:
+                self._sleep(self._on_failure(e, attempt, obj_path))
+                attempt += 1
+                continue
+            self.breaker.record_success()
+            return dest
+
+    def _check_breaker(self):
+        if not self.breaker.allow():
+            raise DriverError("Uploads are paused after repeated driver failures")
+
+    def _on_failure(self, e, attempt, obj_path):
+        """Record failed attempt, returns seconds to wait before next attempt or raises error if it is not repeated"""
+        # permanent errors are not repeated but they count for breaker
+        self.breaker.record_failure()
+        if not isinstance(e, TransientDriverError) or attempt >= self.max_attempts:
+            raise e
+        delay = min(self.backoff * 2 ** (attempt - 1), self.max_backoff)
+        print(f"Upload of {obj_path} failed, retrying in {delay} s: " + str(e))
+        metrics.inc("upload_retries_total", project=self.project)
+        return delay
+
+
+class AsyncDriver:
+    """Driver with native asyncio interface"""
+
+    async def upload_file_async(self, src, obj_path):
+        """Copy object to destination and return path"""
+        raise NotImplementedError
 
+    async def close(self):
+        """Release resources held by driver"""
+        pass
 
-class GoogleDriveDriver(Driver):
-    """Driver to handle connection to Google Drive"""
 
-    def __init__(self, config):
-        super(GoogleDriveDriver, self).__init__(config)
+class AsyncDriverAdapter(AsyncDriver):
+    """Adapter to run blocking driver in thread pool executor"""
 
-        try:
-            self._credentials = service_account.Credentials.from_service_account_file(
-                Path(config.google_drive.service_account_file),
-                scopes=["https://www.googleapis.com/auth/drive.file"],
-            )
+    def __init__(self, driver, max_workers=None):
+        self.driver = driver
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
 
-            self._service: Resource = build(
-                "drive", "v3", credentials=self._credentials
-            )
+    async def upload_file_async(self, src, obj_path):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, self.driver.upload_file, src, obj_path
+        )
 
-            self._folder = config.google_drive.folder
-            self._folder_id = self._folder_exists(self._folder)
+    async def close(self):
+        self._executor.shutdown(wait=False)
 
-            if not self._folder_id:
-                self._folder_id = self._create_folder(self._folder)
 
-            for email in self._get_share_with(config.google_drive):
-                if email:
-                    self._share_with(email)
+class AsyncRetryingDriver(RetryingDriver, AsyncDriver):
+    """Retrying wrapper which keeps asyncio interface of driver, waits between attempts do not block event loop"""
 
-        except Exception as e:
-            raise DriverError("GoogleDrive driver init error: " + str(e))
+    def __init__(
+        self, driver, config, sleep=asyncio.sleep, clock=time.monotonic, breaker=None
+    ):
+        super(AsyncRetryingDriver, self).__init__(driver, config, sleep, clock, breaker)
 
-    def upload_file(self, src: str, obj_path: str) -> str:
-        try:
-            file_metadata = {
-                "name": obj_path,
-                "parents": [self._folder_id],
-            }
-            media = MediaFileUpload(src)
-
-            file = (
-                self._service.files()
-                .create(body=file_metadata, media_body=media, fields="id")
-                .execute()
-            )
+    async def upload_file_async(self, src, obj_path):
+        attempt = 1
+        while True:
+            self._check_breaker()
+            try:
+                dest = await self.driver.upload_file_async(src, obj_path)
+            except DriverError as e:
+                await self._sleep(self._on_failure(e, attempt, obj_path))
+                attempt += 1
+                continue
+            self.breaker.record_success()
+            return dest
 
-            file_id = file.get("id")
+    async def close(self):
+        await self.driver.close()
 
-        except Exception as e:
-            raise DriverError("GoogleDrive driver error: " + str(e))
+    # drivers with asyncio interface only do not support optional features of blocking drivers
 
-        return self._file_link(file_id)
+    def copy_file(self, src_path, obj_path):
+        if not isinstance(self.driver, Driver):
+            return None
+        return super(AsyncRetryingDriver, self).copy_file(src_path, obj_path)
 
-    def _folder_exists(self, folder_name: str) -> typing.Optional[str]:
-        """Check if a folder with the specified name exists. Return boolean and folder ID if exists."""
+    def list_existing(self, prefix=""):
+        if not isinstance(self.driver, Driver):
+            return None
+        return super(AsyncRetryingDriver, self).list_existing(prefix)
 
-        # Query to check if a folder with the specified name exists
-        try:
-            query = f"name = '{folder_name}' and mimeType = 'application/vnd.google-apps.folder'"
-            results = (
-                self._service.files().list(q=query, fields="files(id, name)").execute()
-            )
-            items = results.get("files", [])
-        except Exception as e:
-            raise DriverError("Google Drive folder exists error: " + str(e))
+    def is_uploaded(self, src, existing):
+        if not isinstance(self.driver, Driver):
+            return False
+        return super(AsyncRetryingDriver, self).is_uploaded(src, existing)
+
+    def get_url(self, obj_path):
+        if not isinstance(self.driver, Driver):
+            return None
+        return super(AsyncRetryingDriver, self).get_url(obj_path)
+
+
+def as_async_driver(driver, max_workers=None):
+    """Return driver with asyncio interface, blocking drivers are wrapped in adapter"""
+    if isinstance(driver, AsyncDriver):
+        return driver
+    return AsyncDriverAdapter(driver, max_workers)
+
+
+def close_drivers(drivers):
+    """Release resources of drivers with asyncio interface (e.g. HTTP sessions) when they are not used anymore
+    :param drivers: list of drivers, shared drivers are closed once
+    """
+    closed = set()
+    for driver in drivers:
+        # projects have own retrying wrappers of shared driver
+        wrapped = driver.driver if isinstance(driver, RetryingDriver) else driver
+        if isinstance(driver, AsyncDriver) and id(wrapped) not in closed:
+            closed.add(id(wrapped))
+            asyncio.run(driver.close())
+
+
+# ioctl to share data blocks of files (reflink), supported by e.g. btrfs and XFS on Linux
+FICLONE = 0x40049409
+
+# errors of link, ioctl or copy_file_range meaning the method is not supported for given files
+UNSUPPORTED_TRANSFER_ERRORS = [
+    errno.EXDEV,
+    errno.EPERM,
+    errno.EMLINK,
+    errno.EINVAL,
+    errno.ENOSYS,
+    errno.ENOTTY,
+    errno.EOPNOTSUPP,
+]
+
+
+class LocalTransfer(enum.Enum):
+    """How LocalDriver creates files at destination, methods which can not be used fall back to copy"""
+
+    # hardlink in move mode (source is removed anyway), otherwise reflink or copy
+    AUTO = "auto"
+    # copy data in kernel (copy_file_range or sendfile) without reading it to userspace
+    COPY = "copy"
+    # share data blocks with source (copy-on-write), destination is independent of later changes of source
+    REFLINK = "reflink"
+    # link the same file, changes of source file in place are visible at destination
+    HARDLINK = "hardlink"
+
+    def __str__(self):
+        return self.value
+
+
+def _hardlink(src, tmp):
+    os.link(src, tmp)
 
-        if len(items) > 1:
-            print(
-                f"Multiple folders with name '{folder_name}' found. Using the first one found."
-            )
 
-        if items:
-            return items[0]["id"]
+def _reflink(src, tmp):
+    if fcntl is None:
+        raise OSError(errno.ENOTSUP, "Reflinks are not supported")
+    with open(src, "rb") as fsrc, open(tmp, "wb") as fdst:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+
+
+def _copy(src, tmp, rate_limiter=None):
+    """Copy file in kernel if possible, falls back to copy through userspace"""
+    with open(src, "rb") as fsrc, open(tmp, "wb") as fdst:
+        if rate_limiter:
+            shutil.copyfileobj(ThrottledReader(fsrc, rate_limiter), fdst)
+            return
+        size = os.fstat(fsrc.fileno()).st_size
+        for kernel_copy in [
+            getattr(os, "copy_file_range", None),
+            getattr(os, "sendfile", None),
+        ]:
+            if kernel_copy is None:
+                continue
+            try:
+                _kernel_copy(kernel_copy, fsrc.fileno(), fdst.fileno(), size)
+                return
+            except OSError as e:
+                if e.errno not in UNSUPPORTED_TRANSFER_ERRORS:
+                    raise
+                # the next method starts from scratch
+                fdst.truncate(0)
+                fdst.seek(0)
+        fsrc.seek(0)
+        fdst.seek(0)
+        shutil.copyfileobj(fsrc, fdst)
+
+
+def _kernel_copy(kernel_copy, src_fd, dst_fd, size):
+    """Copy whole file with os.copy_file_range or os.sendfile"""
+    offset = 0
+    while offset < size:
+        if kernel_copy is os.sendfile:
+            copied = os.sendfile(dst_fd, src_fd, offset, size - offset)
         else:
-            return None
+            copied = os.copy_file_range(src_fd, dst_fd, size - offset, offset, offset)
+        if copied == 0:
+            # file was truncated meanwhile
+            break
+        offset += copied
 
-    def _create_folder(self, folder_name: str) -> str:
-        file_metadata = {
-            "name": folder_name,
-            "mimeType": "application/vnd.google-apps.folder",
-        }
 
-        try:
-            folder = (
-                self._service.files().create(body=file_metadata, fields="id").execute()
-            )
-            return folder.get("id")
-        except Exception as e:
-            raise DriverError("Google Drive create folder error: " + str(e))
+class LocalDriver(Driver):
+    """Driver to work with local drive, for testing purpose mainly
 
-    def _file_link(self, file_id: str) -> str:
-        """Get a link to the file in Google Drive."""
-        try:
-            file = (
-                self._service.files()
-                .get(fileId=file_id, fields="webViewLink")
-                .execute()
-            )
-            return file.get("webViewLink")
-        except Exception as e:
-            raise DriverError("Google Drive file link error: " + str(e))
+    Files are written to temporary file next to destination and renamed into place, so readers of destination
+    (e.g. on NFS mount) never see partially written files.
+    """
 
-    def _has_already_permission(self, email: str) -> bool:
-        """Check if email already has permission to the folder."""
-        try:
-            # List all permissions for the file
-            permissions = (
-                self._service.permissions()
-                .list(
-                    fileId=self._folder_id,
-                    fields="permissions(id, emailAddress, role, type)",
-                )
-                .execute()
-            )
+    destination_settings = ["dest"]
 
-            return any(
-                permission.get("emailAddress", "").lower() == email.lower()
-                for permission in permissions.get("permissions", [])
-            )
+    def __init__(self, config):
+        super(LocalDriver, self).__init__(config)
+        self.dest = config.local.dest
+        self.transfer = LocalTransfer(config.get("local.transfer") or "auto")
+        self.methods = self._transfer_methods(config)
 
-        except Exception as e:
-            raise DriverError("Google Drive has permission error: " + str(e))
+        try:
+            if not os.path.exists(self.dest):
+                os.makedirs(self.dest)
+        except OSError as e:
+            raise DriverError("Local driver init error: " + str(e))
 
-        return False
+    def _transfer_methods(self, config):
+        """Returns methods to try in order, copy is always the last one"""
+        if self.transfer == LocalTransfer.HARDLINK:
+            return [_hardlink, _reflink, _copy]
+        if self.transfer == LocalTransfer.REFLINK:
+            return [_reflink, _copy]
+        if self.transfer == LocalTransfer.AUTO:
+            if config.operation_mode == "move":
+                return [_hardlink, _reflink, _copy]
+            return [_reflink, _copy]
+        return [_copy]
+
+    def upload_file(self, src, obj_path):
+        dest = os.path.join(self.dest, obj_path)
+        dest_dir = os.path.dirname(dest)
+        # unique per thread, so concurrent uploads of the same path do not collide
+        tmp = os.path.join(
+            dest_dir,
+            f".{os.path.basename(dest)}.{os.getpid()}.{threading.get_ident()}.part",
+        )
+        try:
+            os.makedirs(dest_dir, exist_ok=True)
+            if os.path.exists(dest) and os.path.samefile(src, dest):
+                # e.g. hardlinked by previous sync, there is nothing to transfer
+                return dest
+            if self.rate_limiter:
+                self.rate_limiter.request()
+            self._transfer(src, tmp)
+            os.replace(tmp, dest)
+        except OSError as e:
+            if os.path.lexists(tmp):
+                os.remove(tmp)
+            raise DriverError("Local driver error: " + str(e))
+        return dest
 
-    def _share_with(self, email: str) -> None:
-        """Share the folder with the specified email."""
-        if not self._has_already_permission(email):
+    def _transfer(self, src, tmp):
+        for method in self.methods:
+            if os.path.lexists(tmp):
+                os.remove(tmp)
             try:
-                permission = {
-                    "type": "user",
-                    "role": "writer",
-                    "emailAddress": email,
-                }
-                self._service.permissions().create(
-                    fileId=self._folder_id, body=permission
-                ).execute()
-            except Exception as e:
-                raise DriverError("Google Drive sharing folder error: " + str(e))
-
-    def _get_share_with(self, config_google_drive) -> typing.List[str]:
-        email_regex = re.compile(r"(^[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+$)")
-
-        emails_to_share_with = []
-        if isinstance(config_google_drive.share_with, str):
-            if email_regex.match(config_google_drive.share_with):
-                emails_to_share_with.append(config_google_drive.share_with)
-        elif isinstance(config_google_drive.share_with, list):
-            for email in config_google_drive.share_with:
-                if email_regex.match(email):
-                    emails_to_share_with.append(email)
-        else:
-            raise DriverError(
-                "Google Drive sharing: Incorrect GoogleDrive shared_with settings"
+                if method is _copy:
+                    # only copied bytes count against rate limit, links share data
+                    _copy(src, tmp, self.rate_limiter)
+                else:
+                    method(src, tmp)
+                return
+            except OSError as e:
+                if method is _copy or e.errno not in UNSUPPORTED_TRANSFER_ERRORS:
+                    raise
+
+    def list_existing(self, prefix=""):
+        existing = {}
+        for root, dirs, files in os.walk(os.path.join(self.dest, prefix)):
+            for name in files:
+                if name.startswith(".") and name.endswith(".part"):
+                    # unfinished upload
+                    continue
+                dest = os.path.join(root, name)
+                path = os.path.relpath(dest, self.dest).replace(os.sep, "/")
+                try:
+                    existing[path] = {"size": os.path.getsize(dest), "dest": dest}
+                except OSError:
+                    # removed meanwhile
+                    continue
+        return existing
+
+    def is_uploaded(self, src, existing):
+        try:
+            return os.path.getsize(src) == existing["size"] and filecmp.cmp(
+                src, existing["dest"], shallow=False
             )
+        except OSError:
+            return False
+
+
+# built-in drivers, modules of storage backends are imported only when their driver is used
+_drivers = {
+    str(DriverType.LOCAL): "drivers:LocalDriver",
+    str(DriverType.MINIO): "minio_driver:MinioDriver",
+    str(DriverType.GOOGLE_DRIVE): "google_drive_driver:GoogleDriveDriver",
+    str(DriverType.S3): "s3_driver:S3Driver",
+}
+_drivers_lock = threading.Lock()
+_entry_points_loaded = False
+
+
+def register_driver(name, driver):
+    """Register driver to be used with given name in config
+    :param name: str driver name
+    :param driver: Driver subclass or its import path "module:DriverClass"
+    """
+    with _drivers_lock:
+        _drivers[name] = driver
+
+
+def get_driver_names():
+    """Returns names of all available drivers, including drivers of installed plugins"""
+    _load_entry_points()
+    with _drivers_lock:
+        return sorted(_drivers)
+
+
+def get_driver_class(name):
+    """Returns driver class registered with name, its module is imported on first use"""
+    _load_entry_points()
+    with _drivers_lock:
+        driver = _drivers.get(name)
+    if driver is None:
+        raise DriverError("Unsupported driver: " + str(name))
+    if isinstance(driver, type):
+        return driver
+
+    try:
+        if isinstance(driver, str):
+            module_name, class_name = driver.split(":")
+            driver_class = getattr(importlib.import_module(module_name), class_name)
+        else:
+            driver_class = driver.load()
+    except (ImportError, AttributeError, ValueError) as e:
+        raise DriverError(f"Unable to load driver {name}: " + str(e))
+    register_driver(name, driver_class)
+    return driver_class
 
-        if not emails_to_share_with:
-            print("Google Drive sharing: Not shared with any user")
 
-        return emails_to_share_with
+def _load_entry_points():
+    """Add drivers of installed plugins to registry, built-in drivers can not be replaced"""
+    global _entry_points_loaded
+    if _entry_points_loaded:
+        return
+    plugins = entry_points(group=DRIVERS_ENTRY_POINT_GROUP)
+    with _drivers_lock:
+        for entry_point in plugins:
+            _drivers.setdefault(entry_point.name, entry_point)
+        _entry_points_loaded = True
 
 
 def create_driver(config):
     """Create driver object based on type defined in config"""
-    driver = None
+    return get_driver_class(str(config.driver))(config)
+
+
+def create_drivers(configs):
+    """Create driver objects for list of project configs, projects with the same driver settings share driver object
+    :param configs: list of project configs
+    :return: list of drivers in the same order as configs, each project has its own retrying wrapper
+    """
+    drivers = {}
+    project_drivers = []
+    for config in configs:
+        key = _get_driver_key(config)
+        if key not in drivers:
+            # failures of shared driver are tracked across projects
+            drivers[key] = (create_driver(config), CircuitBreaker.from_config(config))
+        driver, breaker = drivers[key]
+        # retries are counted per project, drivers with asyncio interface keep it
+        if isinstance(driver, AsyncDriver):
+            project_drivers.append(AsyncRetryingDriver(driver, config, breaker=breaker))
+        else:
+            project_drivers.append(RetryingDriver(driver, config, breaker=breaker))
+    return project_drivers
+
+
+def get_destination_key(config):
+    """Returns key identifying where driver in config stores files, e.g. endpoint and bucket, credentials are not part of it"""
+    name = str(config.driver)
+    settings = config.get(name) or {}
+    try:
+        keys = get_driver_class(name).destination_settings
+    except DriverError:
+        keys = None
+    if keys is not None:
+        settings = {key: settings.get(key) for key in keys}
+    data = json.dumps(
+        {"driver": name, "settings": settings}, sort_keys=True, default=str
+    )
+    return hashlib.sha1(data.encode()).hexdigest()
+
+
+def _get_driver_key(config):
+    """Returns key identifying driver settings in config"""
+    settings = {
+        "driver": str(config.driver),
+        "options": config.get(str(config.driver)) or {},
+        # connection pool of MinIO driver is sized by upload settings
+        "upload": config.get("upload") or {},
+        "retry": config.get("retry") or {},
+        # rate limit is shared by all uploads of driver
+        "rate_limit": config.get("rate_limit") or {},
+    }
     if config.driver == DriverType.LOCAL:
-        driver = LocalDriver(config)
-    elif config.driver == DriverType.MINIO:
-        driver = MinioDriver(config)
-    elif config.driver == DriverType.GOOGLE_DRIVE:
-        driver = GoogleDriveDriver(config)
-    return driver
+        # transfer method of local driver depends on operation mode, e.g. hardlinks are safe only in move mode
+        settings["operation_mode"] = config.operation_mode
+    return json.dumps(settings, sort_keys=True, default=str)
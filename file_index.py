@@ -0,0 +1,124 @@
+"""
+Mergin Media Sync - a tool to sync media files from Mergin projects to other storage backends
+
+Copyright (C) 2021 Lutra Consulting
+
+License: MIT
+"""
+
+import json
+import os
+import time
+from datetime import datetime
+
+from mergin.utils import generate_checksum
+
+# files modified so recently may still change within the same mtime tick, their checksum is not kept
+RACY_INTERVAL_NS = 2 * 10**9
+
+
+class FileIndex:
+    """Persisted stat signatures (size, mtime, inode) and checksums of project files
+
+    Files with unchanged signature are not read and hashed again.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._modified = False
+        try:
+            with open(path, "r") as f:
+                self._entries = json.load(f)
+        except (OSError, ValueError):
+            self._entries = {}
+
+    def checksum(self, path, abs_path, stat):
+        """Returns checksum of file, file is hashed only if its stat signature changed
+        :param path: str file path in project
+        :param abs_path: str absolute path to file
+        :param stat: os.stat_result of file
+        :return: str checksum
+        """
+        signature = [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+        entry = self._entries.get(path)
+        if entry and entry[:3] == signature:
+            return entry[3]
+
+        checksum = generate_checksum(abs_path)
+        if time.time_ns() - stat.st_mtime_ns > RACY_INTERVAL_NS:
+            self._entries[path] = signature + [checksum]
+        else:
+            self._entries.pop(path, None)
+        self._modified = True
+        return checksum
+
+    def retain(self, paths):
+        """Forget files which are not in paths"""
+        paths = set(paths)
+        for path in [p for p in self._entries if p not in paths]:
+            del self._entries[path]
+            self._modified = True
+
+    def save(self):
+        """Write index to disk if it changed"""
+        if not self._modified:
+            return
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self._entries, f)
+        os.replace(tmp_path, self.path)
+        self._modified = False
+
+
+def inspect_file(directory, path, index=None):
+    """Returns metadata of project file in MerginProject.inspect_files() format or None if file does not exist
+    :param directory: str project directory
+    :param path: str file path in project
+    :param index: optional FileIndex with known checksums
+    """
+    abs_path = os.path.join(directory, path)
+    try:
+        stat = os.stat(abs_path)
+    except FileNotFoundError:
+        return None
+    return _file_metadata(path, abs_path, stat, index)
+
+
+def scan_project_files(directory, ignore_file, index=None):
+    """Returns metadata of files in project directory like MerginProject.inspect_files(), using stat data from os.scandir
+    :param directory: str project directory
+    :param ignore_file: callable returning True for file names to skip
+    :param index: optional FileIndex with known checksums
+    :return: list(dict) files metadata
+    """
+    files_meta = []
+    dirs = [""]
+    while dirs:
+        rel_dir = dirs.pop()
+        with os.scandir(os.path.join(directory, rel_dir)) as entries:
+            for entry in entries:
+                path = rel_dir + "/" + entry.name if rel_dir else entry.name
+                if entry.is_dir():
+                    # symlinks to directories are not followed, same as os.walk
+                    if entry.name != ".mergin" and not entry.is_symlink():
+                        dirs.append(path)
+                    continue
+                if ignore_file(entry.name):
+                    continue
+                files_meta.append(_file_metadata(path, entry.path, entry.stat(), index))
+    if index is not None:
+        index.retain(f["path"] for f in files_meta)
+    return files_meta
+
+
+def _file_metadata(path, abs_path, stat, index):
+    if index is not None:
+        checksum = index.checksum(path, abs_path, stat)
+    else:
+        checksum = generate_checksum(abs_path)
+    return {
+        "path": path,
+        "checksum": checksum,
+        "size": stat.st_size,
+        "mtime": datetime.fromtimestamp(stat.st_mtime).astimezone(),
+    }
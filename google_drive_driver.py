@@ -0,0 +1,277 @@
+"""
+Mergin Media Sync - a tool to sync media files from Mergin projects to other storage backends
+
+Copyright (C) 2021 Lutra Consulting
+
+License: MIT
+"""
+
+import mimetypes
+import os
+import re
+import threading
+import typing
+from pathlib import Path
+
+from google.oauth2 import service_account
+from googleapiclient.discovery import build, Resource
+from googleapiclient.errors import HttpError
+from googleapiclient.http import DEFAULT_CHUNK_SIZE, MediaIoBaseUpload
+
+from drivers import (
+    Driver,
+    DriverError,
+    TRANSIENT_HTTP_STATUSES,
+    TransientDriverError,
+    UploadState,
+)
+from ratelimit import ThrottledReader
+
+UPLOAD_FIELDS = "id, webViewLink"
+
+
+class GoogleDriveDriver(Driver):
+    """Driver to handle connection to Google Drive"""
+
+    destination_settings = ["folder"]
+
+    def __init__(self, config):
+        super(GoogleDriveDriver, self).__init__(config)
+
+        try:
+            self._credentials = service_account.Credentials.from_service_account_file(
+                Path(config.google_drive.service_account_file),
+                scopes=["https://www.googleapis.com/auth/drive.file"],
+            )
+
+            self._local = threading.local()
+
+            # chunk size in MB, files up to this size are uploaded with single request
+            self._chunk_size = (
+                (config.get("google_drive.chunk_size") or 0) * 1024 * 1024
+            )
+            self._upload_state = None
+            if config.get("google_drive.resume_state_file"):
+                self._upload_state = UploadState(config.google_drive.resume_state_file)
+
+            self._folder = config.google_drive.folder
+            self._folder_id = self._folder_exists(self._folder)
+
+            if not self._folder_id:
+                self._folder_id = self._create_folder(self._folder)
+
+            for email in self._get_share_with(config.google_drive):
+                if email:
+                    self._share_with(email)
+
+        except Exception as e:
+            raise DriverError("GoogleDrive driver init error: " + str(e))
+
+    @property
+    def _service(self) -> Resource:
+        """Drive API service, httplib2 is not thread-safe so each thread builds its own"""
+        if not hasattr(self._local, "service"):
+            self._local.service = build("drive", "v3", credentials=self._credentials)
+        return self._local.service
+
+    def upload_file(self, src: str, obj_path: str) -> str:
+        try:
+            file_metadata = {
+                "name": obj_path,
+                "parents": [self._folder_id],
+            }
+            # file is closed when upload ends, media objects of client do not close it
+            with open(src, "rb") as f:
+                if self._chunk_size and os.path.getsize(src) > self._chunk_size:
+                    file = self._upload_resumable(src, f, file_metadata)
+                else:
+                    media = self._media_upload(src, f)
+                    if self.rate_limiter:
+                        self.rate_limiter.request()
+                    file = (
+                        self._service.files()
+                        .create(
+                            body=file_metadata, media_body=media, fields=UPLOAD_FIELDS
+                        )
+                        .execute()
+                    )
+
+        except HttpError as e:
+            if e.resp.status in TRANSIENT_HTTP_STATUSES:
+                raise TransientDriverError("GoogleDrive driver error: " + str(e))
+            raise DriverError("GoogleDrive driver error: " + str(e))
+        except (ConnectionError, TimeoutError) as e:
+            raise TransientDriverError("GoogleDrive driver error: " + str(e))
+        except Exception as e:
+            raise DriverError("GoogleDrive driver error: " + str(e))
+
+        # link is requested together with upload, ask for it separately only if it is missing
+        return file.get("webViewLink") or self._file_link(file.get("id"))
+
+    def _media_upload(
+        self,
+        src: str,
+        f: typing.BinaryIO,
+        chunksize: int = DEFAULT_CHUNK_SIZE,
+        resumable: bool = False,
+    ):
+        """Returns media body of upload request reading open file, no faster than rate limiter allows"""
+        mimetype = mimetypes.guess_type(src)[0] or "application/octet-stream"
+        if self.rate_limiter:
+            f = ThrottledReader(f, self.rate_limiter)
+        return MediaIoBaseUpload(f, mimetype, chunksize=chunksize, resumable=resumable)
+
+    def _upload_resumable(
+        self, src: str, f: typing.BinaryIO, file_metadata: dict
+    ) -> dict:
+        """Upload file in chunks, session URI is kept in state file so upload can continue after failure"""
+        stat = os.stat(src)
+        state_key = f"{self._folder_id}/{file_metadata['name']}"
+        file_signature = {
+            "src": src,
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+        }
+
+        media = self._media_upload(src, f, chunksize=self._chunk_size, resumable=True)
+        request = self._service.files().create(
+            body=file_metadata, media_body=media, fields=UPLOAD_FIELDS
+        )
+        state = self._upload_state.get(state_key) if self._upload_state else None
+        if state and {k: state.get(k) for k in file_signature} == file_signature:
+            print(f"Resuming upload of {file_metadata['name']}")
+            request.resumable_uri = state["uri"]
+            # makes client ask server for already uploaded bytes first
+            request._in_error_state = True
+
+        response = None
+        try:
+            while response is None:
+                if self.rate_limiter:
+                    self.rate_limiter.request()
+                status, response = request.next_chunk()
+                if self._upload_state and request.resumable_uri:
+                    if not state or state.get("uri") != request.resumable_uri:
+                        state = dict(file_signature, uri=request.resumable_uri)
+                        self._upload_state.set(state_key, state)
+                if status:
+                    print(
+                        f"Uploaded {int(status.progress() * 100)}% of {file_metadata['name']}"
+                    )
+        except HttpError as e:
+            # upload session has expired, next attempt needs to start from scratch
+            if self._upload_state and e.resp.status in [404, 410]:
+                self._upload_state.remove(state_key)
+            raise
+
+        if self._upload_state:
+            self._upload_state.remove(state_key)
+        return response
+
+    def _folder_exists(self, folder_name: str) -> typing.Optional[str]:
+        """Check if a folder with the specified name exists. Return boolean and folder ID if exists."""
+
+        # Query to check if a folder with the specified name exists
+        try:
+            query = f"name = '{folder_name}' and mimeType = 'application/vnd.google-apps.folder'"
+            results = (
+                self._service.files().list(q=query, fields="files(id, name)").execute()
+            )
+            items = results.get("files", [])
+        except Exception as e:
+            raise DriverError("Google Drive folder exists error: " + str(e))
+
+        if len(items) > 1:
+            print(
+                f"Multiple folders with name '{folder_name}' found. Using the first one found."
+            )
+
+        if items:
+            return items[0]["id"]
+        else:
+            return None
+
+    def _create_folder(self, folder_name: str) -> str:
+        file_metadata = {
+            "name": folder_name,
+            "mimeType": "application/vnd.google-apps.folder",
+        }
+
+        try:
+            folder = (
+                self._service.files().create(body=file_metadata, fields="id").execute()
+            )
+            return folder.get("id")
+        except Exception as e:
+            raise DriverError("Google Drive create folder error: " + str(e))
+
+    def _file_link(self, file_id: str) -> str:
+        """Get a link to the file in Google Drive."""
+        try:
+            file = (
+                self._service.files()
+                .get(fileId=file_id, fields="webViewLink")
+                .execute()
+            )
+            return file.get("webViewLink")
+        except Exception as e:
+            raise DriverError("Google Drive file link error: " + str(e))
+
+    def _has_already_permission(self, email: str) -> bool:
+        """Check if email already has permission to the folder."""
+        try:
+            # List all permissions for the file
+            permissions = (
+                self._service.permissions()
+                .list(
+                    fileId=self._folder_id,
+                    fields="permissions(id, emailAddress, role, type)",
+                )
+                .execute()
+            )
+
+            return any(
+                permission.get("emailAddress", "").lower() == email.lower()
+                for permission in permissions.get("permissions", [])
+            )
+
+        except Exception as e:
+            raise DriverError("Google Drive has permission error: " + str(e))
+
+        return False
+
+    def _share_with(self, email: str) -> None:
+        """Share the folder with the specified email."""
+        if not self._has_already_permission(email):
+            try:
+                permission = {
+                    "type": "user",
+                    "role": "writer",
+                    "emailAddress": email,
+                }
+                self._service.permissions().create(
+                    fileId=self._folder_id, body=permission
+                ).execute()
+            except Exception as e:
+                raise DriverError("Google Drive sharing folder error: " + str(e))
+
+    def _get_share_with(self, config_google_drive) -> typing.List[str]:
+        email_regex = re.compile(r"(^[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+$)")
+
+        emails_to_share_with = []
+        if isinstance(config_google_drive.share_with, str):
+            if email_regex.match(config_google_drive.share_with):
+                emails_to_share_with.append(config_google_drive.share_with)
+        elif isinstance(config_google_drive.share_with, list):
+            for email in config_google_drive.share_with:
+                if email_regex.match(email):
+                    emails_to_share_with.append(email)
+        else:
+            raise DriverError(
+                "Google Drive sharing: Incorrect GoogleDrive shared_with settings"
+            )
+
+        if not emails_to_share_with:
+            print("Google Drive sharing: Not shared with any user")
+
+        return emails_to_share_with
@@ -0,0 +1,239 @@
+"""
+Mergin Media Sync - a tool to sync media files from Mergin projects to other storage backends
+
+Copyright (C) 2021 Lutra Consulting
+
+License: MIT
+"""
+
+import os
+import sqlite3
+import threading
+import time
+
+
+class UploadManifest:
+    """Local SQLite record of files already uploaded to storage backend, kept across runs"""
+
+    def __init__(self, path):
+        self.path = path
+        dirname = os.path.dirname(os.path.abspath(path))
+        os.makedirs(dirname, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            "project TEXT NOT NULL, "
+            "path TEXT NOT NULL, "
+            "size INTEGER, "
+            "checksum TEXT, "
+            "version TEXT, "
+            "driver TEXT, "
+            "dest TEXT, "
+            "uploaded_at REAL, "
+            "destination TEXT, "
+            "object TEXT, "
+            "PRIMARY KEY (project, path))"
+        )
+        self._add_columns("files", {"destination": "TEXT", "object": "TEXT"})
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS files_checksum_idx ON files (project, checksum)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS failed_files ("
+            "project TEXT NOT NULL, "
+            "path TEXT NOT NULL, "
+            "attempts INTEGER NOT NULL, "
+            "error TEXT, "
+            "retry_at REAL NOT NULL, "
+            "PRIMARY KEY (project, path))"
+        )
+        self._conn.commit()
+
+    def _add_columns(self, table, columns):
+        """Add columns missing in manifest created by older version"""
+        existing = [row[1] for row in self._conn.execute(f"PRAGMA table_info({table})")]
+        for name, column_type in columns.items():
+            if name not in existing:
+                self._conn.execute(
+                    f"ALTER TABLE {table} ADD COLUMN {name} {column_type}"
+                )
+
+    def get(self, project, path):
+        """Returns manifest entry for project file or None if file was not uploaded yet
+        :param project: str full project name
+        :param path: str file path in project
+        :return: dict entry
+        """
+        return self._fetch_one("project = ? AND path = ?", (project, path))
+
+    def get_by_checksum(self, project, checksum, driver, destination):
+        """Returns any manifest entry of project file with given content uploaded by driver to destination
+        :param project: str full project name
+        :param checksum: str file checksum
+        :param driver: str driver type
+        :param destination: str key of destination, e.g. bucket and its subpath
+        :return: dict entry
+        """
+        return self._fetch_one(
+            "project = ? AND checksum = ? AND driver = ? AND destination = ?",
+            (project, checksum, driver, destination),
+        )
+
+    def _fetch_one(self, where, params):
+        with self._lock:
+            cur = self._conn.execute(
+                "SELECT path, size, checksum, version, driver, dest, uploaded_at, destination, object "
+                f"FROM files WHERE {where} LIMIT 1",
+                params,
+            )
+            row = cur.fetchone()
+        if not row:
+            return None
+        keys = [
+            "path",
+            "size",
+            "checksum",
+            "version",
+            "driver",
+            "dest",
+            "uploaded_at",
+            "destination",
+            "object",
+        ]
+        entry = dict(zip(keys, row))
+        # entries recorded by older version do not have object path
+        entry["object"] = entry["object"] or entry["path"]
+        return entry
+
+    def add(self, project, entries):
+        """Record uploaded files in a single transaction
+        :param project: str full project name
+        :param entries: list(dict) with path, size, checksum, version, driver, destination, dest
+            and object (project path the content was uploaded under) keys
+        """
+        now = time.time()
+        rows = [
+            (
+                project,
+                e["path"],
+                e["size"],
+                e["checksum"],
+                e["version"],
+                e["driver"],
+                e["dest"],
+                now,
+                e["destination"],
+                e["object"],
+            )
+            for e in entries
+        ]
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO files "
+                "(project, path, size, checksum, version, driver, dest, uploaded_at, destination, object) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+
+    def get_failed(self, project):
+        """Returns paths of files which failed to upload and are due to be retried
+        :param project: str full project name
+        :return: list(str) file paths
+        """
+        with self._lock:
+            cur = self._conn.execute(
+                "SELECT path FROM failed_files WHERE project = ? AND retry_at <= ? ORDER BY path",
+                (project, time.time()),
+            )
+            return [row[0] for row in cur.fetchall()]
+
+    def count_failed(self, project):
+        """Returns number of files waiting to be retried, including those which are not due yet"""
+        with self._lock:
+            cur = self._conn.execute(
+                "SELECT COUNT(*) FROM failed_files WHERE project = ?", (project,)
+            )
+            return cur.fetchone()[0]
+
+    def add_failed(self, project, errors, delay, max_delay):
+        """Record files which failed to upload, each failure postpones next retry of file
+        :param project: str full project name
+        :param errors: dict map of file paths to error messages
+        :param delay: float seconds before the first retry
+        :param max_delay: float max seconds between retries
+        """
+        now = time.time()
+        with self._lock, self._conn:
+            for path, error in errors.items():
+                row = self._conn.execute(
+                    "SELECT attempts FROM failed_files WHERE project = ? AND path = ?",
+                    (project, path),
+                ).fetchone()
+                attempts = (row[0] if row else 0) + 1
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO failed_files (project, path, attempts, error, retry_at) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (
+                        project,
+                        path,
+                        attempts,
+                        error,
+                        now + retry_delay(attempts, delay, max_delay),
+                    ),
+                )
+
+    def remove_failed(self, project, paths):
+        """Remove files from retry queue, e.g. after they were uploaded
+        :param project: str full project name
+        :param paths: iterable(str) file paths
+        """
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "DELETE FROM failed_files WHERE project = ? AND path = ?",
+                ((project, path) for path in paths),
+            )
+
+    def close(self):
+        self._conn.close()
+
+
+class RetryQueue:
+    """In-memory queue of files which failed to upload, used when upload manifest is not configured"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._failed = {}
+
+    def get_failed(self, project):
+        now = time.time()
+        with self._lock:
+            failed = self._failed.get(project, {})
+            return sorted(path for path, e in failed.items() if e["retry_at"] <= now)
+
+    def count_failed(self, project):
+        with self._lock:
+            return len(self._failed.get(project, {}))
+
+    def add_failed(self, project, errors, delay, max_delay):
+        now = time.time()
+        with self._lock:
+            failed = self._failed.setdefault(project, {})
+            for path, error in errors.items():
+                attempts = failed.get(path, {}).get("attempts", 0) + 1
+                failed[path] = {
+                    "attempts": attempts,
+                    "error": error,
+                    "retry_at": now + retry_delay(attempts, delay, max_delay),
+                }
+
+    def remove_failed(self, project, paths):
+        with self._lock:
+            failed = self._failed.get(project, {})
+            for path in paths:
+                failed.pop(path, None)
+
+
+def retry_delay(attempts, delay, max_delay):
+    """Returns seconds before next retry of file which failed given number of times"""
+    return min(delay * 2 ** (attempts - 1), max_delay)
@@ -6,31 +6,112 @@ Copyright (C) 2021 Lutra Consulting
 License: MIT
 """
 
+import asyncio
+import itertools
 import os
 import sqlite3
+import time
+from contextlib import contextmanager
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from mergin import MerginClient, MerginProject, LoginError, ClientError
+from mergin.utils import generate_checksum
 
 from version import __version__
-from drivers import DriverError, create_driver
-from config import config, validate_config, ConfigError
+from drivers import (
+    DriverError,
+    as_async_driver,
+    close_drivers,
+    create_drivers,
+    get_destination_key,
+)
+from config import config, validate_config, get_project_configs, ConfigError
+from manifest import RetryQueue, UploadManifest
+from file_index import FileIndex, inspect_file, scan_project_files
+from metrics import metrics
+
+# index of local files checksums stored with project metadata
+FILE_INDEX_NAME = "media-sync-index.json"
+
+
+# files which failed to upload when upload manifest is not configured
+_retry_queue = RetryQueue()
 
 
 class MediaSyncError(Exception):
     pass
 
 
+class ProjectContext:
+    """Mergin project state shared by steps of a single sync cycle
+
+    Local files are inspected only once per cycle, later only files touched by the sync are inspected again.
+    """
+
+    def __init__(self, config=config):
+        self.config = config
+        self._mp = None
+        self._files = None
+        self._invalidated = set()
+        self._index = None
+
+    @property
+    def mp(self):
+        """MerginProject of working directory, its changes to push are computed from cached listing"""
+        if self._mp is None:
+            self._mp = MerginProject(self.config.project_working_dir)
+            self._mp.inspect_files = self.inspect_files
+        return self._mp
+
+    def reload(self):
+        """Discard project metadata after they were changed by pull or push, listing of files is kept"""
+        self._mp = None
+
+    def invalidate(self, paths):
+        """Mark project files which were modified, added or removed since they were inspected"""
+        if self._files is not None:
+            self._invalidated.update(paths)
+
+    def inspect_files(self):
+        """Returns metadata of files in project directory like MerginProject.inspect_files()"""
+        index = self._get_index()
+        if self._files is None:
+            project = self.config.mergin.project_name
+            with metrics.timer("scan", project) as fields:
+                files = scan_project_files(self.mp.dir, self.mp.ignore_file, index)
+                fields["files"] = len(files)
+            self._files = {f["path"]: f for f in files}
+        for path in self._invalidated:
+            self._files.pop(path, None)
+            if self.mp.ignore_file(os.path.basename(path)):
+                continue
+            file = inspect_file(self.mp.dir, path, index)
+            if file:
+                self._files[path] = file
+        self._invalidated.clear()
+        if index is not None:
+            index.save()
+        # callers modify returned metadata
+        return [dict(f) for f in self._files.values()]
+
+    def _get_index(self):
+        """Returns persisted index of file checksums if enabled"""
+        if self._index is None and self.config.get("scan.stat_index", True):
+            self._index = FileIndex(self.mp.fpath_meta(FILE_INDEX_NAME))
+        return self._index
+
+
 def _quote_identifier(identifier):
     """Quote identifiers"""
     return '"' + identifier + '"'
 
 
-def _get_project_version():
+def _get_project_version(config=config, ctx=None):
     """Returns the current version of the project"""
-    mp = MerginProject(config.project_working_dir)
-    return mp.version()
+    ctx = ctx or ProjectContext(config)
+    return ctx.mp.version()
 
 
-def _check_has_working_dir():
+def _check_has_working_dir(config=config):
     if not os.path.exists(config.project_working_dir):
         raise MediaSyncError(
             "The project working directory does not exist: "
@@ -44,10 +125,10 @@ def _check_has_working_dir():
         )
 
 
-def _check_pending_changes():
+def _check_pending_changes(config=config, ctx=None):
     """Check working directory was not modified manually - this is probably uncommitted change from last attempt"""
-    mp = MerginProject(config.project_working_dir)
-    status_push = mp.get_push_changes()
+    ctx = ctx or ProjectContext(config)
+    status_push = ctx.mp.get_push_changes()
     if status_push["added"] or status_push["updated"] or status_push["removed"]:
         raise MediaSyncError(
             "There are pending changes in the local directory - please review and push manually! "
@@ -55,7 +136,7 @@ def _check_pending_changes():
         )
 
 
-def _get_media_sync_files(files):
+def _get_media_sync_files(files, config=config):
     """Return files relevant to media sync from project files"""
     allowed_extensions = config.allowed_extensions
     files_to_upload = [
@@ -92,63 +173,113 @@ def create_mergin_client():
         raise MediaSyncError("Mergin client error: " + str(e))
 
 
-def mc_download(mc):
+def mc_download(mc, config=config, ctx=None):
     """Clone mergin project to local dir
     :param mc: mergin client instance
+    :param ctx: project context of sync cycle
     :return: list(dict) list of project files metadata
     """
+    ctx = ctx or ProjectContext(config)
     print("Downloading project from Mergin server ...")
     try:
-        mc.download_project(config.mergin.project_name, config.project_working_dir)
+        with metrics.timer("download", config.mergin.project_name):
+            mc.download_project(config.mergin.project_name, config.project_working_dir)
     except ClientError as e:
         # this could be e.g. DNS error
         raise MediaSyncError("Mergin client error on download: " + str(e))
-    mp = MerginProject(config.project_working_dir)
-    print(f"Downloaded {_get_project_version()} from Mergin")
-    files_to_upload = _get_media_sync_files(mp.inspect_files())
+    print(f"Downloaded {_get_project_version(config, ctx)} from Mergin")
+    files_to_upload = _get_media_sync_files(ctx.inspect_files(), config)
     return files_to_upload
 
 
-def mc_pull(mc):
+def mc_pull(mc, config=config, ctx=None):
     """Pull latest version to synchronize with local dir
     :param mc: mergin client instance
+    :param ctx: project context of sync cycle
     :return: list(dict) list of project files metadata
     """
     print("Pulling from mergin server ...")
-    _check_pending_changes()
-
-    mp = MerginProject(config.project_working_dir)
+    ctx = ctx or ProjectContext(config)
+    mp = ctx.mp
     local_version = mp.version()
+    project_name = mp.project_full_name()
 
+    # cheap version probe first, project files and local directory are scanned only if there is new version
     try:
-        project_info = mc.project_info(mp.project_full_name(), since=local_version)
-        projects = mc.get_projects_by_names([mp.project_full_name()])
-        server_version = projects[mp.project_full_name()]["version"]
+        projects = mc.get_projects_by_names([project_name])
     except ClientError as e:
         # this could be e.g. DNS error
         raise MediaSyncError("Mergin client error: " + str(e))
 
-    _check_pending_changes()
+    # server reports error instead of project info e.g. if project does not exist
+    server_version = (projects.get(project_name) or {}).get("version")
+    if not server_version:
+        raise MediaSyncError(
+            "Unable to get project version from Mergin: " + project_name
+        )
 
     if server_version == local_version:
         print("No changes on Mergin.")
         return
 
+    _check_pending_changes(config, ctx)
+
     try:
-        status_pull = mp.get_pull_changes(project_info["files"])
-        mc.pull_project(config.project_working_dir)
+        with metrics.timer("pull", project_name):
+            project_info = mc.project_info(project_name, since=local_version)
+            status_pull = mp.get_pull_changes(project_info["files"])
+            mc.pull_project(config.project_working_dir)
     except ClientError as e:
         raise MediaSyncError("Mergin client error on pull: " + str(e))
 
-    print("Pulled new version from Mergin: " + _get_project_version())
+    # other files in working directory were not changed by pull
+    ctx.reload()
+    ctx.invalidate(
+        f["path"]
+        for f in status_pull["added"] + status_pull["updated"] + status_pull["removed"]
+    )
+
+    print("Pulled new version from Mergin: " + _get_project_version(config, ctx))
     files_to_upload = _get_media_sync_files(
-        status_pull["added"] + status_pull["updated"]
+        status_pull["added"] + status_pull["updated"], config
     )
     return files_to_upload
 
 
-def _update_references(files):
-    """Update references to media files in reference table"""
+def _load_files_table(gpkg_cur, files):
+    """Load map of project paths to destinations into temporary table to join reference tables with"""
+    gpkg_cur.execute(
+        "CREATE TEMP TABLE IF NOT EXISTS media_sync_files (file_path TEXT PRIMARY KEY, dest TEXT)"
+    )
+    gpkg_cur.execute("DELETE FROM temp.media_sync_files")
+    gpkg_cur.executemany(
+        "INSERT OR REPLACE INTO temp.media_sync_files (file_path, dest) VALUES (?, ?)",
+        files.items(),
+    )
+
+
+def _update_reference_table(gpkg_cur, ref, config=config):
+    """Update references in table with single statement joined with temporary table of uploaded files"""
+    table = _quote_identifier(ref.table)
+    local_path_column = _quote_identifier(ref.local_path_column)
+    driver_path_column = _quote_identifier(ref.driver_path_column)
+    set_clause = (
+        f"{driver_path_column}=(SELECT dest FROM temp.media_sync_files "
+        f"WHERE file_path={table}.{local_path_column})"
+    )
+    # remove reference to the local path only in the move mode
+    if config.operation_mode == "move":
+        set_clause += f", {local_path_column}=Null"
+    sql = (
+        f"UPDATE {table} SET {set_clause} "
+        f"WHERE {local_path_column} IN (SELECT file_path FROM temp.media_sync_files)"
+    )
+    gpkg_cur.execute(sql)
+
+
+def _get_references_by_file(config=config):
+    """Returns reference settings grouped by GeoPackage file they point to"""
+    references = {}
     for ref in config.references:
         reference_config = [
             ref.file,
@@ -157,99 +288,623 @@ def _update_references(files):
             ref.driver_path_column,
         ]
         if not all(reference_config):
-            return
+            break
+        references.setdefault(ref.file, []).append(ref)
+    return references
+
+
+def _load_spatialite(gpkg_conn):
+    """Load mod_spatialite extension, e.g. to provide spatial functions for GeoPackage triggers"""
+    gpkg_conn.enable_load_extension(True)
+    gpkg_conn.execute('SELECT load_extension("mod_spatialite")')
+
+
+def _update_references(files, config=config):
+    """Update references to media files in reference table"""
+    if not files:
+        return
 
+    for gpkg_file, references in _get_references_by_file(config).items():
         print("Updating references ...")
         try:
             gpkg_conn = sqlite3.connect(
-                os.path.join(config.project_working_dir, ref.file)
+                os.path.join(config.project_working_dir, gpkg_file)
             )
-            gpkg_conn.enable_load_extension(True)
-            gpkg_cur = gpkg_conn.cursor()
-            gpkg_cur.execute('SELECT load_extension("mod_spatialite")')
-            for file_path, dest in files.items():
-                # remove reference to the local path only in the move mode
-                if config.operation_mode == "move":
-                    sql = (
-                        f"UPDATE {_quote_identifier(ref.table)} "
-                        f"SET {_quote_identifier(ref.driver_path_column)}=:dest_column, {_quote_identifier(ref.local_path_column)}=Null "
-                        f"WHERE {_quote_identifier(ref.local_path_column)}=:file_path"
-                    )
-                elif config.operation_mode == "copy":
-                    sql = (
-                        f"UPDATE {_quote_identifier(ref.table)} "
-                        f"SET {_quote_identifier(ref.driver_path_column)}=:dest_column "
-                        f"WHERE {_quote_identifier(ref.local_path_column)}=:file_path"
-                    )
-                gpkg_cur.execute(sql, {"dest_column": dest, "file_path": file_path})
-            gpkg_conn.commit()
-            gpkg_conn.close()
+            try:
+                gpkg_cur = gpkg_conn.cursor()
+                spatialite_loaded = False
+                # all tables in GeoPackage are updated in one transaction
+                _load_files_table(gpkg_cur, files)
+                for ref in references:
+                    try:
+                        _update_reference_table(gpkg_cur, ref, config)
+                    except sqlite3.OperationalError as e:
+                        # triggers on the table need spatial functions, extension is loaded only then
+                        if spatialite_loaded or "no such function" not in str(e):
+                            raise
+                        _load_spatialite(gpkg_conn)
+                        spatialite_loaded = True
+                        _update_reference_table(gpkg_cur, ref, config)
+                gpkg_conn.commit()
+            finally:
+                gpkg_conn.close()
         except sqlite3.OperationalError as e:
             raise MediaSyncError("SQLITE error: " + str(e))
 
 
-def media_sync_push(mc, driver, files):
-    if not files:
+def _get_upload_workers(config=config):
+    """Returns number of files to be uploaded concurrently"""
+    return config.get("upload.workers") or 1
+
+
+def _prepare_upload(file, config=config):
+    """Returns absolute path to project file to be uploaded or None if it is missing"""
+    src = os.path.join(config.project_working_dir, file["path"])
+    if not os.path.exists(src):
+        print("Missing local file: " + str(file["path"]))
+        return None
+
+    size = os.path.getsize(src) / 1024 / 1024  # file size in MB
+    print(f"Uploading {file['path']} of size {size:.2f} MB")
+    return src
+
+
+def _upload_file(driver, file, config=config, failed=None):
+    """Upload single project file with driver
+    :param driver: driver instance
+    :param file: dict file metadata
+    :param failed: optional dict to collect errors of failed uploads by file path
+    :return: str destination of uploaded file or None if file was not uploaded
+    """
+    try:
+        dest = _copy_file(driver, file, config)
+        if dest is not None:
+            return dest
+        src = _prepare_upload(file, config)
+        if not src:
+            return None
+        with _track_upload(src, config):
+            return driver.upload_file(src, file["path"])
+    except DriverError as e:
+        print(f"Failed to upload {file['path']}: " + str(e))
+        metrics.inc("upload_failures_total", project=config.mergin.project_name)
+        if failed is not None:
+            failed[file["path"]] = str(e)
+        return None
+
+
+def _copy_file(driver, file, config=config):
+    """Copy file uploaded before under different path on server side
+    :return: str destination of copied file or None if file needs to be uploaded
+    """
+    if not (file.get("copy_from") and hasattr(driver, "copy_file")):
+        return None
+    dest = driver.copy_file(file["copy_from"], file["path"])
+    if dest is not None:
+        print(f"Copied {file['path']} from {file['copy_from']} on server")
+        metrics.inc("files_copied_total", project=config.mergin.project_name)
+    return dest
+
+
+@contextmanager
+def _track_upload(src, config=config):
+    """Record duration and size of upload of single file in metrics"""
+    project = config.mergin.project_name
+    size = os.path.getsize(src)
+    metrics.add("uploads_in_flight", 1, project=project)
+    try:
+        with metrics.timer("upload", project, bytes=size):
+            yield
+        metrics.inc("files_uploaded_total", project=project)
+        metrics.inc("bytes_uploaded_total", size, project=project)
+    finally:
+        metrics.add("uploads_in_flight", -1, project=project)
+
+
+def _upload_files(driver, files, config=config):
+    """Upload files with driver using pool of workers
+    :param driver: driver instance
+    :param files: list(dict) list of project files metadata
+    :return: dict map of project paths to destinations of successfully uploaded files
+    """
+    return dict(_iter_upload_results(driver, files, config))
+
+
+def _iter_upload_results(driver, files, config=config, failed=None):
+    """Upload files with driver using pool of workers, results are yielded as uploads complete
+    :param driver: driver instance
+    :param files: iterable(dict) project files metadata
+    :param failed: optional dict to collect errors of failed uploads by file path
+    :return: generator of tuples (project path, destination) of successfully uploaded files
+    """
+    workers = _get_upload_workers(config)
+    files = iter(files)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # only a few files are queued ahead of workers to keep memory flat for huge diffs
+        futures = {
+            executor.submit(_upload_file, driver, file, config, failed): file
+            for file in itertools.islice(files, 2 * workers)
+        }
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                file = futures.pop(future)
+                for next_file in itertools.islice(files, 1):
+                    futures[
+                        executor.submit(_upload_file, driver, next_file, config, failed)
+                    ] = next_file
+                dest = future.result()
+                if dest is not None:
+                    yield file["path"], dest
+
+
+def _iter_uploads(driver, files, config=config, failed=None):
+    """Upload files with configured upload engine
+    :param driver: driver instance
+    :param files: list(dict) list of project files metadata
+    :param failed: optional dict to collect errors of failed uploads by file path
+    :return: generator of tuples (project path, destination) of successfully uploaded files
+    """
+    if config.get("upload.engine") != "asyncio":
+        yield from _iter_upload_results(driver, files, config, failed)
         return
-    print("Synchronizing files with external drive...")
-    _check_has_working_dir()
-    migrated_files = {}
 
-    # TODO make async and parallel for better performance
+    # event loop is run per batch so that uploaded files can be committed before all files are uploaded
+    for batch in _iter_batches(files, _get_batch_size(config)):
+        results = asyncio.run(_upload_files_async(driver, batch, config, failed))
+        yield from results.items()
+
+
+def _get_batch_size(config=config):
+    """Returns number of uploaded files committed at once, 0 for all files at once"""
+    return config.get("upload.batch_size") or 0
+
+
+def _iter_batches(items, size, is_due=None):
+    """Split iterable to lists of given size, with size 0 all items are in single list
+    :param is_due: optional callable to end batch early, it gets items of batch collected so far
+    """
+    items = iter(items)
+    while True:
+        batch = []
+        for item in items:
+            batch.append(item)
+            if len(batch) == size or (is_due and is_due(batch)):
+                break
+        if not batch:
+            return
+        yield batch
+
+
+async def _upload_files_async(driver, files, config=config, failed=None):
+    """Upload files with asyncio event loop, number of uploads in flight is limited by upload.max_in_flight
+    :param driver: driver instance, blocking drivers are run in pool of upload.workers threads
+    :param files: list(dict) list of project files metadata
+    :param failed: optional dict to collect errors of failed uploads by file path
+    :return: dict map of project paths to destinations of successfully uploaded files
+    """
+    async_driver = as_async_driver(driver, _get_upload_workers(config))
+    semaphore = asyncio.Semaphore(config.get("upload.max_in_flight") or 100)
+
+    async def upload(file):
+        async with semaphore:
+            try:
+                if file.get("copy_from"):
+                    # copy request is blocking, it does not block event loop in thread
+                    dest = await asyncio.to_thread(_copy_file, driver, file, config)
+                    if dest is not None:
+                        return dest
+                src = _prepare_upload(file, config)
+                if not src:
+                    return None
+                with _track_upload(src, config):
+                    return await async_driver.upload_file_async(src, file["path"])
+            except DriverError as e:
+                print(f"Failed to upload {file['path']}: " + str(e))
+                metrics.inc("upload_failures_total", project=config.mergin.project_name)
+                if failed is not None:
+                    failed[file["path"]] = str(e)
+                return None
+
+    try:
+        results = await asyncio.gather(*(upload(file) for file in files))
+    finally:
+        # only adapter created here is closed, passed in driver is used by next batches and sync cycles
+        if async_driver is not driver:
+            await async_driver.close()
+    return {
+        file["path"]: dest for file, dest in zip(files, results) if dest is not None
+    }
+
+
+def _open_manifest(config=config):
+    """Returns upload manifest if configured, otherwise None"""
+    if not config.get("manifest.file"):
+        return None
+    try:
+        return UploadManifest(config.manifest.file)
+    except sqlite3.Error as e:
+        raise MediaSyncError("Upload manifest error: " + str(e))
+
+
+def _get_checksum(file, config=config):
+    """Returns checksum of project file, computed from local file if metadata do not provide it"""
+    if file.get("checksum"):
+        return file["checksum"]
+    src = os.path.join(config.project_working_dir, file["path"])
+    if not os.path.exists(src):
+        return None
+    return generate_checksum(src)
+
+
+def _deduplicate_files(files, config=config):
+    """Group files with identical content so each content is uploaded only once
+    :param files: list(dict) list of project files metadata
+    :return: tuple(list(dict), dict) files to upload and map of their paths to paths of duplicates
+    """
+    unique_files = {}
+    duplicates = {}
+    files_to_upload = []
     for file in files:
-        src = os.path.join(config.project_working_dir, file["path"])
-        if not os.path.exists(src):
-            print("Missing local file: " + str(file["path"]))
+        checksum = _get_checksum(file, config)
+        if checksum is not None and checksum in unique_files:
+            original = unique_files[checksum]["path"]
+            duplicates.setdefault(original, []).append(file["path"])
             continue
-
-        try:
-            size = os.path.getsize(src) / 1024 / 1024  # file size in MB
-            print(f"Uploading {file['path']} of size {size:.2f} MB")
-            dest = driver.upload_file(src, file["path"])
-            migrated_files[file["path"]] = dest
-        except DriverError as e:
-            print(f"Failed to upload {file['path']}: " + str(e))
+        if checksum is not None:
+            unique_files[checksum] = file
+        files_to_upload.append(file)
+    return files_to_upload, duplicates
+
+
+def _filter_synced_files(manifest, files, config=config, driver=None):
+    """Split files to those which need to be uploaded and those already uploaded according to manifest
+    :param manifest: upload manifest
+    :param files: list(dict) list of project files metadata
+    :param driver: optional driver instance to get current URLs of uploaded files, e.g. newly signed ones
+    :return: tuple(list(dict), dict) files to upload and map of project paths to destinations of skipped files
+    """
+    files_to_upload = []
+    synced_files = {}
+    # files uploaded to other bucket, folder etc. are uploaded again
+    destination = get_destination_key(config)
+    for file in files:
+        if not os.path.exists(os.path.join(config.project_working_dir, file["path"])):
+            files_to_upload.append(file)
             continue
 
+        checksum = _get_checksum(file, config)
+        entry = manifest.get(config.mergin.project_name, file["path"])
+        if not (
+            entry
+            and entry["driver"] == str(config.driver)
+            and entry["destination"] == destination
+            and entry["checksum"] == checksum
+        ):
+            entry = None
+        copy_source = None
+        if entry is None:
+            # the same content might have been uploaded under different path
+            copy_source = manifest.get_by_checksum(
+                config.mergin.project_name, checksum, str(config.driver), destination
+            )
+            if config.get("upload.deduplicate"):
+                entry, copy_source = copy_source, None
+
+        if entry:
+            print(f"Skipping {file['path']}, already uploaded")
+            # recorded URL might have expired meanwhile
+            url = driver.get_url(entry["object"]) if driver else None
+            synced_files[file["path"]] = url or entry["dest"]
+        elif copy_source:
+            # driver may copy the object on server side instead of uploading it again
+            files_to_upload.append(dict(file, copy_from=copy_source["object"]))
+        else:
+            files_to_upload.append(file)
+    return files_to_upload, synced_files
+
+
+def _filter_existing_files(driver, files, config=config):
+    """Split files to those which need to be uploaded and those already present at destination with the same content
+    :param driver: driver instance, destination is listed once with bulk requests
+    :param files: list(dict) list of project files metadata
+    :return: tuple(list(dict), dict) files to upload and map of project paths to destinations of existing files
+    """
+    if not files:
+        return files, {}
+    # only directory with files to be uploaded is listed
+    prefix = os.path.commonprefix([file["path"] for file in files])
+    prefix = prefix[: prefix.rfind("/") + 1]
+    try:
+        with metrics.timer("list_existing", config.mergin.project_name):
+            existing = driver.list_existing(prefix)
+    except DriverError as e:
+        print("Unable to list files at destination, all files are uploaded: " + str(e))
+        return files, {}
+    if existing is None:
+        return files, {}
+
+    files_to_upload = []
+    existing_files = {}
+    for file in files:
+        src = os.path.join(config.project_working_dir, file["path"])
+        obj = existing.get(file["path"])
+        if obj and os.path.exists(src) and driver.is_uploaded(src, obj):
+            print(f"Skipping {file['path']}, already present at destination")
+            existing_files[file["path"]] = obj["dest"]
+        else:
+            files_to_upload.append(file)
+    return files_to_upload, existing_files
+
+
+def _record_uploads(manifest, files, migrated_files, version, config=config):
+    """Record successfully uploaded files in manifest"""
+    destination = get_destination_key(config)
+    entries = [
+        {
+            "path": file["path"],
+            "size": file.get("size"),
+            "checksum": _get_checksum(file, config),
+            "version": version,
+            "driver": str(config.driver),
+            "destination": destination,
+            "dest": migrated_files[file["path"]],
+            # duplicates point to object uploaded under path of original file
+            "object": file.get("object") or file["path"],
+        }
+        for file in files
+        if file["path"] in migrated_files
+    ]
+    try:
+        manifest.add(config.mergin.project_name, entries)
+    except sqlite3.Error as e:
+        raise MediaSyncError("Upload manifest error: " + str(e))
+
+
+def _commit_uploads(ctx, manifest, files, migrated_files, version, config=config):
+    """Record uploaded files in manifest, update references to them and remove them in move mode
+    :param ctx: project context of sync cycle
+    :param manifest: upload manifest or None
+    :param files: list(dict) metadata of files uploaded in this run
+    :param migrated_files: dict map of project paths to destinations of files to commit
+    :param version: str project version
+    """
+    if manifest:
+        _record_uploads(manifest, files, migrated_files, version, config)
+
     # update reference table (if applicable)
-    _update_references(migrated_files)
+    if migrated_files:
+        with metrics.timer(
+            "update_references", config.mergin.project_name, files=len(migrated_files)
+        ):
+            _update_references(migrated_files, config)
+        ctx.invalidate(ref.file for ref in config.references)
 
     # remove from local dir if move mode
     if config.operation_mode == "move":
         for file in migrated_files.keys():
             src = os.path.join(config.project_working_dir, file)
             os.remove(src)
+        ctx.invalidate(migrated_files.keys())
 
-    # push changes to mergin back (with changed references and removed files) if applicable
+
+def _is_checkpoint_due(files_count, last_push, config=config):
+    """Returns whether committed files should be pushed to Mergin before sync is finished
+    :param files_count: int number of files committed since last push
+    :param last_push: float time.monotonic() of last push or start of sync
+    """
+    if not files_count:
+        return False
+    checkpoint_files = config.get("checkpoint.files")
+    if checkpoint_files and files_count >= checkpoint_files:
+        return True
+    checkpoint_minutes = config.get("checkpoint.minutes")
+    return bool(
+        checkpoint_minutes and time.monotonic() - last_push >= checkpoint_minutes * 60
+    )
+
+
+def _push_changes(mc, ctx, config=config):
+    """Push changed references and removed files to Mergin if there are any"""
     try:
-        mp = MerginProject(config.project_working_dir)
-        status_push = mp.get_push_changes()
+        status_push = ctx.mp.get_push_changes()
         if status_push["added"]:
             raise MediaSyncError(
                 "There are changes to be added - it should never happen"
             )
         if status_push["updated"] or status_push["removed"]:
-            mc.push_project(config.project_working_dir)
-            version = _get_project_version()
+            with metrics.timer("push", config.mergin.project_name):
+                mc.push_project(config.project_working_dir)
+            ctx.reload()
+            version = _get_project_version(config, ctx)
             print("Pushed new version to Mergin: " + version)
     except (ClientError, MediaSyncError) as e:
         # this could be either because of some temporal error (network, server lock)
         # or permanent one that needs to be resolved by user
         raise MediaSyncError("Mergin client error on push: " + str(e))
 
+
+def _get_queued_files(retry_queue, files, config=config):
+    """Returns metadata of files which failed to upload before and are due to be retried
+    :param retry_queue: upload manifest or in-memory retry queue
+    :param files: list(dict) files to be synced anyway
+    """
+    project = config.mergin.project_name
+    paths = {file["path"] for file in files}
+    queued_files = []
+    removed = []
+    for path in retry_queue.get_failed(project):
+        if path in paths:
+            continue
+        src = os.path.join(config.project_working_dir, path)
+        if not os.path.exists(src):
+            # file was removed from project meanwhile
+            removed.append(path)
+            continue
+        queued_files.append({"path": path, "size": os.path.getsize(src)})
+    if removed:
+        retry_queue.remove_failed(project, removed)
+    if queued_files:
+        print(f"Retrying upload of {len(queued_files)} files which failed before")
+    return queued_files
+
+
+def _sync_files(mc, driver, files, manifest, retry_queue, ctx, config=config):
+    """Upload files and commit them in batches, failed uploads are queued to be retried later
+    :return: set(str) paths of committed files
+    """
+    project = config.mergin.project_name
+    synced_files = {}
+    if manifest:
+        files, synced_files = _filter_synced_files(manifest, files, config, driver)
+
+    files_to_upload = files
+    if config.get("upload.skip_existing"):
+        files_to_upload, existing_files = _filter_existing_files(driver, files, config)
+        synced_files.update(existing_files)
+
+    duplicates = {}
+    if config.get("upload.deduplicate"):
+        files_to_upload, duplicates = _deduplicate_files(files_to_upload, config)
+
+    version = _get_project_version(config, ctx)
+    files_since_push = 0
+    last_push = time.monotonic()
+    files_by_path = {file["path"]: file for file in files}
+    for path, duplicate_paths in duplicates.items():
+        for duplicate_path in duplicate_paths:
+            files_by_path[duplicate_path] = dict(
+                files_by_path[duplicate_path], object=path
+            )
+    failed = {}
+    # files uploaded in previous runs still need references and removal in move mode
+    results = itertools.chain(
+        synced_files.items(), _iter_uploads(driver, files_to_upload, config, failed)
+    )
+    # uploaded files are committed in batches so that interrupted sync loses at most one batch,
+    # batch ends early when checkpoint is due so that checkpoints do not wait for the whole batch
+    batches = _iter_batches(
+        results,
+        _get_batch_size(config),
+        lambda batch: _is_checkpoint_due(
+            files_since_push + len(batch), last_push, config
+        ),
+    )
+    committed = set()
+    try:
+        for batch in batches:
+            migrated_files = dict(batch)
+            # duplicates point to the same destination as uploaded file
+            for path, dest in batch:
+                for duplicate_path in duplicates.get(path, []):
+                    migrated_files[duplicate_path] = dest
+            uploaded_files = [
+                files_by_path[path] for path in migrated_files if path in files_by_path
+            ]
+            _commit_uploads(
+                ctx, manifest, uploaded_files, migrated_files, version, config
+            )
+            retry_queue.remove_failed(project, migrated_files.keys())
+            committed.update(migrated_files)
+            files_since_push += len(migrated_files)
+            if _is_checkpoint_due(files_since_push, last_push, config):
+                # long sync makes durable progress on Mergin
+                _push_changes(mc, ctx, config)
+                version = _get_project_version(config, ctx)
+                files_since_push = 0
+                last_push = time.monotonic()
+        return committed
+    except Exception as e:
+        # interrupted sync, files not committed yet (even if uploaded) would not come again with the next pull
+        for path in itertools.chain(files_by_path, synced_files):
+            if path not in committed:
+                failed.setdefault(path, "Sync interrupted: " + str(e))
+        raise
+    finally:
+        for path in list(failed):
+            # duplicates need to be committed with the file they point to
+            for duplicate_path in duplicates.get(path, []):
+                failed.setdefault(duplicate_path, failed[path])
+        if failed:
+            # failed files would not come again with the next pull, they are retried in later runs
+            print(f"Upload of {len(failed)} files failed, they will be retried later")
+            retry_queue.add_failed(
+                project,
+                failed,
+                config.get("retry.queue_delay") or 60,
+                config.get("retry.max_queue_delay") or 3600,
+            )
+        metrics.set(
+            "retry_queue_files", retry_queue.count_failed(project), project=project
+        )
+
+
+def media_sync_push(mc, driver, files, config=config, ctx=None):
+    manifest = _open_manifest(config)
+    retry_queue = manifest or _retry_queue
+    # pull returns None when there are no changes on Mergin
+    files = list(files or [])
+    # without new version, only files which failed before are synced, local changes must not be pushed with them
+    idle = not files
+    committed = set()
+    try:
+        # files which failed to upload in previous runs are retried
+        if os.path.exists(config.project_working_dir):
+            files += _get_queued_files(retry_queue, files, config)
+        if not files:
+            return
+        ctx = ctx or ProjectContext(config)
+        print("Synchronizing files with external drive...")
+        _check_has_working_dir(config)
+        if idle:
+            _check_pending_changes(config, ctx)
+        committed = _sync_files(mc, driver, files, manifest, retry_queue, ctx, config)
+    finally:
+        if manifest:
+            manifest.close()
+
+    # push changes to mergin back (with changed references and removed files) if applicable
+    if committed or not idle:
+        _push_changes(mc, ctx, config)
     print("Sync finished")
 
 
+def sync_project(mc, driver, config=config):
+    """Initialize or pull project to sync with latest version and push its media files to driver
+    :param mc: mergin client
+    :param driver: driver instance
+    :param config: project config
+    :return: bool whether new project version was fetched from Mergin
+    """
+    # local files are inspected once per sync cycle
+    ctx = ProjectContext(config)
+    if os.path.exists(config.project_working_dir):
+        files_to_sync = mc_pull(mc, config, ctx)
+    else:
+        files_to_sync = mc_download(mc, config, ctx)
+
+    if not files_to_sync:
+        print("No files to sync")
+
+    # sync media files with external driver, files which failed before are retried too
+    media_sync_push(mc, driver, files_to_sync or [], config, ctx)
+    # pull returns None when there are no changes on Mergin
+    return files_to_sync is not None
+
+
 def main():
     print(f"== Starting Mergin Media Sync version {__version__} ==")
+    metrics.configure(config)
     try:
-        validate_config(config)
+        project_configs = get_project_configs(config)
+        for project_config in project_configs:
+            validate_config(project_config)
     except ConfigError as e:
         print("Error: " + str(e))
         return
 
     try:
-        driver = create_driver(config)
+        drivers = create_drivers(project_configs)
     except DriverError as e:
         print("Error: " + str(e))
         return
@@ -257,21 +912,14 @@ def main():
     try:
         print("Logging in to Mergin...")
         mc = create_mergin_client()
-        # initialize or pull changes to sync with latest project version
-        if os.path.exists(config.project_working_dir):
-            files_to_sync = mc_pull(mc)
-        else:
-            files_to_sync = mc_download(mc)
-
-        if not files_to_sync:
-            print("No files to sync")
-            return
-
-        # sync media files with external driver
-        media_sync_push(mc, driver, files_to_sync)
+        for project_config, driver in zip(project_configs, drivers):
+            print(f"Syncing project {project_config.mergin.project_name}")
+            sync_project(mc, driver, project_config)
         print("== Media sync done! ==")
     except MediaSyncError as err:
         print("Error: " + str(err))
+    finally:
+        close_drivers(drivers)
 
 
 if __name__ == "__main__":
@@ -9,20 +9,50 @@ License: MIT
 import argparse
 import sys
 import datetime
-import os
 import time
-from drivers import DriverError, create_driver
+from concurrent.futures import ThreadPoolExecutor
+from drivers import DriverError, close_drivers, create_drivers
 from media_sync import (
     create_mergin_client,
-    mc_download,
-    media_sync_push,
-    mc_pull,
+    sync_project,
     MediaSyncError,
 )
-from config import config, validate_config, ConfigError, update_config_path
+from config import (
+    config,
+    validate_config,
+    get_project_configs,
+    ConfigError,
+    update_config_path,
+)
+from metrics import metrics, start_metrics_server
+from scheduler import PollScheduler
 from version import __version__
 
 
+def _sync_project(mc, driver, project_config):
+    """Sync single project, errors are reported so they do not affect other projects
+    :return: bool whether there were changes on Mergin
+    """
+    project_name = project_config.mergin.project_name
+    try:
+        with metrics.timer("sync", project_name):
+            return sync_project(mc, driver, project_config)
+    except MediaSyncError as e:
+        print(f"Error in project {project_name}: " + str(e))
+        metrics.inc("sync_errors_total", project=project_name)
+        return False
+
+
+def sync_projects(executor, mc, project_configs, drivers, scheduler):
+    """Sync projects which are due with pool of workers and wait until they are finished"""
+    futures = {
+        executor.submit(_sync_project, mc, drivers[i], project_configs[i]): i
+        for i in scheduler.due()
+    }
+    for future, i in futures.items():
+        scheduler.record(i, future.result())
+
+
 def main():
     parser = argparse.ArgumentParser(
         prog="media_sync_daemon.py",
@@ -47,54 +77,69 @@ def main():
         print("Error:" + str(e))
         sys.exit(1)
 
-    sleep_time = config.as_int("daemon.sleep_time")
+    workers = config.get("daemon.workers") or 1
+    metrics.configure(config)
 
     try:
-        validate_config(config)
+        project_configs = get_project_configs(config)
+        for project_config in project_configs:
+            validate_config(project_config)
     except ConfigError as e:
         print("Error: " + str(e))
         return
 
     try:
-        driver = create_driver(config)
+        # projects with the same driver settings share driver and its connections
+        drivers = create_drivers(project_configs)
     except DriverError as e:
         print("Error: " + str(e))
         return
 
+    metrics_port = config.get("metrics.port")
+    if metrics_port:
+        metrics_host = config.get("metrics.host") or "127.0.0.1"
+        try:
+            start_metrics_server(metrics, metrics_port, metrics_host)
+        except OSError as e:
+            print("Error: Unable to start metrics endpoint: " + str(e))
+            return
+        print(f"Serving metrics at http://{metrics_host}:{metrics_port}/metrics")
+
     print("Logging in to Mergin...")
     try:
+        # single mergin client is shared by all projects
         mc = create_mergin_client()
-
-        # initialize or pull changes to sync with latest project version
-        if not os.path.exists(config.project_working_dir):
-            files_to_sync = mc_download(mc)
-            media_sync_push(mc, driver, files_to_sync)
     except MediaSyncError as e:
         print("Error: " + str(e))
         return
 
+    print(f"Syncing {len(project_configs)} project(s) with {workers} worker(s)")
+    scheduler = PollScheduler.from_config(config, len(project_configs))
     # keep running until killed by ctrl+c:
-    # - sleep N seconds
-    # - pull
+    # - sleep until some project is due, idle projects are polled less often
+    # - initialize or pull the project
     # - push
-    while True:
-        print(datetime.datetime.now())
-        try:
-            files_to_sync = mc_pull(mc)
-            media_sync_push(mc, driver, files_to_sync)
-
-            # check mergin client token expiration
-            delta = mc._auth_session["expire"] - datetime.datetime.now(
-                datetime.timezone.utc
-            )
-            if delta.total_seconds() < 3600:
-                mc = create_mergin_client()
-
-        except MediaSyncError as e:
-            print("Error: " + str(e))
-
-        print("Going to sleep")
-        time.sleep(sleep_time)
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            while True:
+                print(datetime.datetime.now())
+                sync_projects(executor, mc, project_configs, drivers, scheduler)
+
+                try:
+                    # check mergin client token expiration
+                    delta = mc._auth_session["expire"] - datetime.datetime.now(
+                        datetime.timezone.utc
+                    )
+                    if delta.total_seconds() < 3600:
+                        mc = create_mergin_client()
+                except MediaSyncError as e:
+                    print("Error: " + str(e))
+
+                sleep_time = scheduler.time_to_next()
+                print(f"Going to sleep for {sleep_time:.1f} s")
+                time.sleep(sleep_time)
+    finally:
+        close_drivers(drivers)
 
 
 if __name__ == "__main__":
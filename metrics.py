@@ -0,0 +1,181 @@
+"""
+Mergin Media Sync - a tool to sync media files from Mergin projects to other storage backends
+
+Copyright (C) 2021 Lutra Consulting
+
+License: MIT
+"""
+
+import json
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# prefix of metric names exposed to Prometheus
+METRICS_PREFIX = "media_sync_"
+
+COUNTER = "counter"
+GAUGE = "gauge"
+SUMMARY = "summary"
+
+
+class Metrics:
+    """Thread-safe registry of counters, gauges and timings of sync stages
+
+    Values are kept per metric name and labels (e.g. project), timings are summaries with sum and count.
+    """
+
+    def __init__(self, clock=time.perf_counter):
+        """
+        :param clock: callable returning current time in seconds
+        """
+        self.json_logs = False
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._types = {}
+        self._values = {}
+
+    def configure(self, config):
+        """Apply metrics settings from config"""
+        self.json_logs = bool(config.get("metrics.json_logs"))
+
+    def inc(self, name, value=1, **labels):
+        """Increase counter"""
+        self._update(name, COUNTER, labels, lambda v: v + value)
+
+    def add(self, name, value, **labels):
+        """Change gauge by value, e.g. +1 when upload starts and -1 when it ends"""
+        self._update(name, GAUGE, labels, lambda v: v + value)
+
+    def set(self, name, value, **labels):
+        """Set gauge to value"""
+        self._update(name, GAUGE, labels, lambda v: value)
+
+    def observe(self, name, seconds, **labels):
+        """Record duration of single operation"""
+        self._update(
+            name,
+            SUMMARY,
+            labels,
+            lambda v: (v[0] + seconds, v[1] + 1) if v else (seconds, 1),
+        )
+
+    def get(self, name, **labels):
+        """Returns current value of metric, (sum, count) for timings"""
+        with self._lock:
+            return self._values.get(name, {}).get(_labels_key(labels))
+
+    @contextmanager
+    def timer(self, stage, project=None, **fields):
+        """Measure duration of sync stage, it is recorded even if stage fails
+        :param stage: str stage name, e.g. pull, scan, upload, push
+        :param project: optional str project name
+        :param fields: extra values for JSON log line, e.g. number of bytes
+        :return: dict of log fields, caller can add values known only at the end of stage
+        """
+        labels = {"stage": stage}
+        if project:
+            labels["project"] = project
+        start = self._clock()
+        error = None
+        try:
+            yield fields
+        except BaseException as e:
+            error = str(e)
+            raise
+        finally:
+            duration = self._clock() - start
+            self.observe("stage_duration_seconds", duration, **labels)
+            if error is not None:
+                fields["error"] = error
+            self.log("timing", duration=round(duration, 6), **labels, **fields)
+
+    def log(self, event, **fields):
+        """Print JSON log line if JSON logs are enabled"""
+        if not self.json_logs:
+            return
+        line = {"time": time.time(), "event": event}
+        line.update(fields)
+        print(json.dumps(line, default=str), flush=True)
+
+    def render(self):
+        """Returns all metrics in Prometheus text exposition format"""
+        lines = []
+        with self._lock:
+            for name in sorted(self._values):
+                full_name = METRICS_PREFIX + name
+                metric_type = self._types[name]
+                lines.append(f"# TYPE {full_name} {metric_type}")
+                for key, value in sorted(self._values[name].items()):
+                    labels = _format_labels(key)
+                    if metric_type == SUMMARY:
+                        lines.append(f"{full_name}_sum{labels} {value[0]:.6f}")
+                        lines.append(f"{full_name}_count{labels} {value[1]}")
+                    else:
+                        lines.append(f"{full_name}{labels} {value}")
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        """Forget all recorded values"""
+        with self._lock:
+            self._types.clear()
+            self._values.clear()
+
+    def _update(self, name, metric_type, labels, update):
+        key = _labels_key(labels)
+        with self._lock:
+            self._types.setdefault(name, metric_type)
+            values = self._values.setdefault(name, {})
+            default = None if metric_type == SUMMARY else 0
+            values[key] = update(values.get(key, default))
+
+
+def _labels_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(key):
+    if not key:
+        return ""
+    escaped = (
+        (k, v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in key
+    )
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """Serves metrics of the server's registry at /metrics"""
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.server.metrics.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_metrics_server(registry, port, host="127.0.0.1"):
+    """Serve metrics over HTTP in background thread
+    :param registry: Metrics instance
+    :param port: int port to listen on, 0 for any free port
+    :param host: str address to listen on, local only by default
+    :return: running HTTP server, call shutdown() to stop it
+    """
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    server.metrics = registry
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# metrics of the running process
+metrics = Metrics()
@@ -0,0 +1,323 @@
+"""
+Mergin Media Sync - a tool to sync media files from Mergin projects to other storage backends
+
+Copyright (C) 2021 Lutra Consulting
+
+License: MIT
+"""
+
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import certifi
+import urllib3
+from minio import Minio
+from minio.datatypes import Part
+from minio.error import S3Error, ServerError
+from minio.helpers import get_part_info
+
+from drivers import Driver, DriverError, TransientDriverError, UploadState
+from ratelimit import ThrottledReader
+
+# S3 error codes of failures worth retrying
+TRANSIENT_S3_ERRORS = [
+    "InternalError",
+    "RequestTimeout",
+    "ServiceUnavailable",
+    "SlowDown",
+]
+
+# part size of multipart uploads by other tools (e.g. AWS CLI), to recognize their ETags
+DEFAULT_TOOLS_PART_SIZE = 8 * 1024 * 1024
+
+
+class MinioDriver(Driver):
+    """Driver to handle connection to minio-like server"""
+
+    # config section with driver settings and driver name in error messages
+    config_section = "minio"
+    name = "MinIO"
+    destination_settings = ["endpoint", "secure", "region", "bucket", "bucket_subpath"]
+
+    def __init__(self, config):
+        super(MinioDriver, self).__init__(config)
+        settings = config.get(self.config_section)
+
+        try:
+            self.client = Minio(
+                endpoint=settings.endpoint,
+                access_key=settings.access_key,
+                secret_key=settings.secret_key,
+                secure=config.as_bool(f"{self.config_section}.secure"),
+                region=settings.get("region"),
+                http_client=self._create_http_client(config, settings),
+            )
+            self.bucket = settings.bucket
+            bucket_found = self.client.bucket_exists(self.bucket)
+            if not bucket_found:
+                self.client.make_bucket(self.bucket)
+
+            self.bucket_subpath = settings.get("bucket_subpath") or None
+
+            # construct base url for bucket
+            scheme = (
+                "https://"
+                if config.as_bool(f"{self.config_section}.secure")
+                else "http://"
+            )
+            self.base_url = scheme + settings.endpoint + "/" + self.bucket
+        except S3Error as e:
+            raise DriverError(f"{self.name} driver init error: " + str(e))
+
+        # part size in MB, 0 lets client pick part size based on file size
+        self.part_size = (settings.get("part_size") or 0) * 1024 * 1024
+        self.parallel_uploads = settings.get("parallel_uploads") or 3
+        self.upload_state = None
+        if settings.get("resume_state_file"):
+            self.upload_state = UploadState(settings.resume_state_file)
+        # extra headers of uploaded objects
+        self.upload_headers = {}
+
+    @staticmethod
+    def _create_http_client(config, settings):
+        """Pool of HTTP connections shared by all uploads, kept alive between requests"""
+        # every concurrent upload (and each of its parallel parts) needs its own connection
+        pool_size = settings.get("pool_size") or max(
+            10,
+            (config.get("upload.workers") or 1)
+            * (settings.get("parallel_uploads") or 3),
+        )
+        max_retries = settings.get("max_retries")
+        return urllib3.PoolManager(
+            maxsize=pool_size,
+            block=False,
+            timeout=urllib3.Timeout(
+                connect=settings.get("connect_timeout") or 300,
+                read=settings.get("read_timeout") or 300,
+            ),
+            retries=urllib3.Retry(
+                total=5 if max_retries is None else max_retries,
+                backoff_factor=settings.get("retry_backoff") or 0.2,
+                status_forcelist=[500, 502, 503, 504],
+            ),
+            cert_reqs="CERT_REQUIRED",
+            ca_certs=os.environ.get("SSL_CERT_FILE") or certifi.where(),
+        )
+
+    def upload_file(self, src, obj_path):
+        obj_path = self._get_object_name(obj_path)
+        try:
+            if (
+                self.upload_state
+                and self.part_size
+                and os.path.getsize(src) > self.part_size
+            ):
+                self._upload_resumable(src, obj_path)
+            elif self.rate_limiter:
+                self.rate_limiter.request()
+                with open(src, "rb") as f:
+                    self.client.put_object(
+                        self.bucket,
+                        obj_path,
+                        ThrottledReader(f, self.rate_limiter),
+                        os.path.getsize(src),
+                        metadata=self.upload_headers or None,
+                        part_size=self.part_size,
+                        num_parallel_uploads=self.parallel_uploads,
+                    )
+            else:
+                self.client.fput_object(
+                    self.bucket,
+                    obj_path,
+                    src,
+                    metadata=self.upload_headers or None,
+                    part_size=self.part_size,
+                    num_parallel_uploads=self.parallel_uploads,
+                )
+            dest = self._get_url(obj_path)
+        except (S3Error, ServerError, urllib3.exceptions.HTTPError, OSError) as e:
+            raise self._driver_error(e)
+        return dest
+
+    def list_existing(self, prefix=""):
+        """Returns objects already uploaded under prefix, bucket is listed in pages of 1000 objects
+        :param prefix: str project path prefix, e.g. directory of files to be uploaded
+        :return: dict map of project paths to dicts with size, etag and dest of objects
+        """
+        root = self._get_object_name("")
+        existing = {}
+        try:
+            for obj in self.client.list_objects(
+                self.bucket, prefix=root + prefix, recursive=True
+            ):
+                if obj.is_dir:
+                    continue
+                existing[obj.object_name[len(root) :]] = {
+                    "size": obj.size,
+                    "etag": (obj.etag or "").strip('"'),
+                    "dest": self._get_url(obj.object_name),
+                }
+        except (S3Error, ServerError, urllib3.exceptions.HTTPError, OSError) as e:
+            raise self._driver_error(e)
+        return existing
+
+    def is_uploaded(self, src, existing):
+        """Returns whether existing object has the same content as local file, compared by size and ETag"""
+        size = os.path.getsize(src)
+        if size != existing["size"] or not existing["etag"]:
+            return False
+        etag = existing["etag"]
+        if "-" not in etag:
+            return file_etag(src) == etag
+        # ETag of multipart upload depends on part size, only part sizes giving the same part count are tried
+        part_count = int(etag.rsplit("-", 1)[1])
+        part_sizes = {get_part_info(size, self.part_size)[0], DEFAULT_TOOLS_PART_SIZE}
+        return any(
+            file_etag(src, part_size) == etag
+            for part_size in part_sizes
+            if -(-size // part_size) == part_count
+        )
+
+    def get_url(self, obj_path):
+        return self._get_url(self._get_object_name(obj_path))
+
+    def _get_object_name(self, path):
+        """Returns name of object in bucket for project file path"""
+        if self.bucket_subpath:
+            return f"{self.bucket_subpath}/{path}"
+        return path
+
+    def _get_url(self, obj_path):
+        """Returns URL of uploaded object to be stored in references"""
+        return self.base_url + "/" + obj_path
+
+    def _driver_error(self, e):
+        """Returns driver error for exception raised by client, errors worth retrying are transient"""
+        message = f"{self.name} driver error: " + str(e)
+        if isinstance(e, S3Error):
+            if e.code in TRANSIENT_S3_ERRORS:
+                return TransientDriverError(message)
+            return DriverError(message)
+        if isinstance(
+            e,
+            (ServerError, urllib3.exceptions.HTTPError, ConnectionError, TimeoutError),
+        ):
+            return TransientDriverError(message)
+        return DriverError(message)
+
+    def _upload_resumable(self, src, obj_path):
+        """Multipart upload of large file with upload ID kept in state file, so it can continue after failure"""
+        stat = os.stat(src)
+        state_key = f"{self.bucket}/{obj_path}"
+        file_signature = {
+            "src": src,
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "part_size": self.part_size,
+        }
+        uploaded_parts = {}
+        state = self.upload_state.get(state_key)
+        if state and {k: state.get(k) for k in file_signature} == file_signature:
+            uploaded_parts = self._list_uploaded_parts(
+                obj_path, state["upload_id"], stat.st_size
+            )
+            if uploaded_parts is None:
+                state = None
+            else:
+                print(
+                    f"Resuming upload of {obj_path}, {len(uploaded_parts)} parts already uploaded"
+                )
+        elif state:
+            # file was changed since previous attempt
+            self._abort_upload(obj_path, state["upload_id"])
+            state = None
+
+        if not state:
+            headers = {"Content-Type": "application/octet-stream"}
+            headers.update(self.upload_headers)
+            upload_id = self.client._create_multipart_upload(
+                self.bucket, obj_path, headers
+            )
+            state = dict(file_signature, upload_id=upload_id)
+            self.upload_state.set(state_key, state)
+            uploaded_parts = {}
+
+        part_count = -(-stat.st_size // self.part_size)
+        missing_parts = [n for n in range(1, part_count + 1) if n not in uploaded_parts]
+
+        def upload_part(part_number):
+            if self.rate_limiter:
+                self.rate_limiter.request()
+            with open(src, "rb") as f:
+                f.seek((part_number - 1) * self.part_size)
+                # part is read in small chunks at limited rate, like stream of put_object()
+                reader = (
+                    ThrottledReader(f, self.rate_limiter) if self.rate_limiter else f
+                )
+                data = reader.read(self.part_size)
+            etag = self.client._upload_part(
+                self.bucket, obj_path, data, None, state["upload_id"], part_number
+            )
+            return part_number, etag
+
+        with ThreadPoolExecutor(max_workers=self.parallel_uploads) as executor:
+            for part_number, etag in executor.map(upload_part, missing_parts):
+                uploaded_parts[part_number] = etag
+
+        parts = [Part(n, uploaded_parts[n]) for n in range(1, part_count + 1)]
+        self.client._complete_multipart_upload(
+            self.bucket, obj_path, state["upload_id"], parts
+        )
+        self.upload_state.remove(state_key)
+
+    def _list_uploaded_parts(self, obj_path, upload_id, size):
+        """Returns map of part numbers to etags of uploaded parts, None if upload does not exist anymore"""
+        parts = {}
+        marker = None
+        try:
+            while True:
+                result = self.client._list_parts(
+                    self.bucket, obj_path, upload_id, part_number_marker=marker
+                )
+                for part in result.parts:
+                    # only complete parts can be reused
+                    expected_size = min(
+                        self.part_size, size - (part.part_number - 1) * self.part_size
+                    )
+                    if part.size is None or part.size == expected_size:
+                        parts[part.part_number] = part.etag
+                if not result.is_truncated:
+                    break
+                marker = result.next_part_number_marker
+        except S3Error as e:
+            if e.code == "NoSuchUpload":
+                return None
+            raise
+        return parts
+
+    def _abort_upload(self, obj_path, upload_id):
+        try:
+            self.client._abort_multipart_upload(self.bucket, obj_path, upload_id)
+        except S3Error as e:
+            print(f"Failed to abort unfinished upload of {obj_path}: " + str(e))
+
+
+def file_etag(path, part_size=None):
+    """Returns S3 ETag of file uploaded with single request or in parts of given size
+    :param path: str path to file
+    :param part_size: int part size of multipart upload, None for single request
+    :return: str MD5 of file, for multipart upload MD5 of parts MD5s with number of parts
+    """
+    if not part_size:
+        md5 = hashlib.md5()
+        with open(path, "rb") as f:
+            for data in iter(lambda: f.read(1024 * 1024), b""):
+                md5.update(data)
+        return md5.hexdigest()
+
+    digests = []
+    with open(path, "rb") as f:
+        for data in iter(lambda: f.read(part_size), b""):
+            digests.append(hashlib.md5(data).digest())
+    return hashlib.md5(b"".join(digests)).hexdigest() + f"-{len(digests)}"
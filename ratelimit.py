@@ -0,0 +1,194 @@
+"""
+Mergin Media Sync - a tool to sync media files from Mergin projects to other storage backends
+
+Copyright (C) 2021 Lutra Consulting
+
+License: MIT
+"""
+
+import datetime
+import threading
+import time
+
+# max number of bytes read at once from throttled file, so concurrent uploads take turns
+THROTTLE_CHUNK_SIZE = 256 * 1024
+
+
+class TokenBucket:
+    """Token bucket with debt - tokens are taken right away and caller waits until the debt is paid back
+
+    Callers reserve tokens in order of arrival, so concurrent callers get fair share of the rate.
+    """
+
+    def __init__(self, rate, capacity=None, clock=time.monotonic, sleep=time.sleep):
+        """
+        :param rate: float tokens added per second
+        :param capacity: float max tokens saved up for burst, defaults to rate (one second of burst)
+        :param clock: callable returning current time in seconds
+        :param sleep: callable to wait given number of seconds
+        """
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._tokens = self.capacity
+        self._updated = clock()
+
+    def set_rate(self, rate):
+        """Change rate, e.g. when time window with different limits starts"""
+        with self._lock:
+            self._refill()
+            self.rate = rate
+            self.capacity = rate
+            self._tokens = min(self._tokens, self.capacity)
+
+    def acquire(self, amount):
+        """Take tokens and wait until bucket is not in debt
+        :param amount: float number of tokens
+        :return: float seconds waited
+        """
+        with self._lock:
+            self._refill()
+            self._tokens -= amount
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait:
+            self._sleep(wait)
+        return wait
+
+    def _refill(self):
+        now = self._clock()
+        self._tokens = min(
+            self.capacity, self._tokens + (now - self._updated) * self.rate
+        )
+        self._updated = now
+
+
+class RateLimiter:
+    """Limits bytes and requests per second of uploads, limits can differ in time windows (e.g. full speed at night)"""
+
+    def __init__(
+        self,
+        bytes_per_second=None,
+        requests_per_second=None,
+        windows=None,
+        clock=time.monotonic,
+        sleep=time.sleep,
+        now=datetime.datetime.now,
+    ):
+        """
+        :param bytes_per_second: float default limit of uploaded bytes, None or 0 for no limit
+        :param requests_per_second: float default limit of upload requests, None or 0 for no limit
+        :param windows: list(dict) time windows with start and end ("HH:MM") and their own limits
+        :param clock: callable returning current time in seconds
+        :param sleep: callable to wait given number of seconds
+        :param now: callable returning current local datetime, to find active time window
+        """
+        self.limits = {"bytes": bytes_per_second, "requests": requests_per_second}
+        self.windows = [_parse_window(w) for w in windows or []]
+        self._clock = clock
+        self._sleep = sleep
+        self._now = now
+        self._lock = threading.Lock()
+        self._buckets = {}
+
+    @classmethod
+    def from_config(cls, config):
+        """Returns rate limiter configured in config or None if there are no limits"""
+        settings = config.get("rate_limit") or {}
+        limiter = cls(
+            settings.get("bytes_per_second"),
+            settings.get("requests_per_second"),
+            settings.get("windows"),
+        )
+        return limiter if limiter.is_limited() else None
+
+    def is_limited(self):
+        """Returns whether there are any limits at all"""
+        limits = [self.limits] + [w["limits"] for w in self.windows]
+        return any(any(window_limits.values()) for window_limits in limits)
+
+    def request(self):
+        """Wait for permit to make upload request"""
+        return self._acquire("requests", 1)
+
+    def throttle(self, size):
+        """Wait for permit to upload given number of bytes"""
+        return self._acquire("bytes", size)
+
+    def _acquire(self, kind, amount):
+        rate = self._current_limits()[kind]
+        if not rate:
+            return 0
+        with self._lock:
+            bucket = self._buckets.get(kind)
+            if bucket is None:
+                bucket = TokenBucket(rate, clock=self._clock, sleep=self._sleep)
+                self._buckets[kind] = bucket
+            elif bucket.rate != rate:
+                bucket.set_rate(rate)
+        return bucket.acquire(amount)
+
+    def _current_limits(self):
+        """Returns limits of time window active now or default limits"""
+        if not self.windows:
+            return self.limits
+        now = self._now().time()
+        for window in self.windows:
+            start, end = window["start"], window["end"]
+            if start <= end:
+                active = start <= now < end
+            else:
+                # window over midnight
+                active = now >= start or now < end
+            if active:
+                return window["limits"]
+        return self.limits
+
+
+class ThrottledReader:
+    """File object wrapper which reads data no faster than rate limiter allows"""
+
+    def __init__(self, file, limiter):
+        self._file = file
+        self._limiter = limiter
+
+    def read(self, size=-1):
+        chunks = []
+        remaining = size
+        while remaining != 0:
+            chunk_size = THROTTLE_CHUNK_SIZE
+            if remaining > 0:
+                chunk_size = min(chunk_size, remaining)
+            data = self._file.read(chunk_size)
+            if not data:
+                break
+            self._limiter.throttle(len(data))
+            chunks.append(data)
+            if remaining > 0:
+                remaining -= len(data)
+        return b"".join(chunks)
+
+    def __getattr__(self, name):
+        # seek, tell, close etc. are passed to wrapped file
+        return getattr(self._file, name)
+
+
+def _parse_window(window):
+    return {
+        "start": _parse_time(window["start"]),
+        "end": _parse_time(window["end"]),
+        "limits": {
+            "bytes": window.get("bytes_per_second"),
+            "requests": window.get("requests_per_second"),
+        },
+    }
+
+
+def _parse_time(value):
+    """Parse "HH:MM" time of day"""
+    if isinstance(value, int):
+        # unquoted 22:00 is read from YAML as base 60 number, i.e. minutes since midnight
+        return datetime.time(value // 60, value % 60)
+    hours, minutes = str(value).split(":")
+    return datetime.time(int(hours), int(minutes))
@@ -0,0 +1,69 @@
+"""
+Mergin Media Sync - a tool to sync media files from Mergin projects to other storage backends
+
+Copyright (C) 2021 Lutra Consulting
+
+License: MIT
+"""
+
+from datetime import timedelta
+
+import urllib3
+from minio.commonconfig import CopySource
+from minio.error import S3Error, ServerError
+
+from minio_driver import MinioDriver
+
+# presigned URLs signed with AWS signature version 4 are valid at most 7 days
+MAX_URL_EXPIRATION = 7 * 24 * 3600
+
+
+class S3Driver(MinioDriver):
+    """Driver for AWS S3 and S3 compatible services (e.g. Ceph RGW) with configurable URLs of uploaded files
+
+    URLs stored in references can be public URLs of objects, presigned URLs valid for limited time
+    (for private buckets) or URLs with CDN prefix.
+    """
+
+    config_section = "s3"
+    name = "S3"
+
+    def __init__(self, config):
+        super(S3Driver, self).__init__(config)
+        self.url_type = config.get("s3.url") or "public"
+        self.url_expiration = timedelta(
+            seconds=config.get("s3.url_expiration") or MAX_URL_EXPIRATION
+        )
+        self.cdn_url = (config.get("s3.cdn_url") or "").rstrip("/")
+        storage_class = config.get("s3.storage_class")
+        if storage_class:
+            self.upload_headers["x-amz-storage-class"] = storage_class
+
+    def _get_url(self, obj_path):
+        if self.url_type == "presigned":
+            return self.client.presigned_get_object(
+                self.bucket, obj_path, expires=self.url_expiration
+            )
+        if self.url_type == "cdn":
+            return self.cdn_url + "/" + obj_path
+        return super(S3Driver, self)._get_url(obj_path)
+
+    def copy_file(self, src_path, obj_path):
+        """Server-side copy of object uploaded before, e.g. the same photo under renamed path"""
+        src_obj_path = self._get_object_name(src_path)
+        obj_path = self._get_object_name(obj_path)
+        try:
+            self.client.copy_object(
+                self.bucket,
+                obj_path,
+                CopySource(self.bucket, src_obj_path),
+                metadata=self.upload_headers or None,
+            )
+            return self._get_url(obj_path)
+        except S3Error as e:
+            if e.code in ["NoSuchKey", "ResourceNotFound"]:
+                # source object was removed meanwhile, file is uploaded instead
+                return None
+            raise self._driver_error(e)
+        except (ServerError, urllib3.exceptions.HTTPError, OSError) as e:
+            raise self._driver_error(e)
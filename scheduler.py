@@ -0,0 +1,79 @@
+"""
+Mergin Media Sync - a tool to sync media files from Mergin projects to other storage backends
+
+Copyright (C) 2021 Lutra Consulting
+
+License: MIT
+"""
+
+import random
+import time
+
+
+class PollScheduler:
+    """Schedule of project polling, interval of each project grows while there are no changes on Mergin"""
+
+    def __init__(
+        self,
+        count,
+        min_interval,
+        max_interval=None,
+        backoff_factor=2,
+        jitter=0,
+        clock=time.monotonic,
+        rand=random.random,
+    ):
+        """
+        :param count: int number of projects
+        :param min_interval: float seconds between polls of project with recent changes
+        :param max_interval: float upper bound of interval of idle project, defaults to min_interval
+        :param backoff_factor: float multiplier of interval after poll without changes
+        :param jitter: float relative random deviation of interval to spread polls of projects
+        :param clock: callable returning current time in seconds
+        :param rand: callable returning random float in [0, 1)
+        """
+        self.min_interval = min_interval
+        self.max_interval = max(max_interval or min_interval, min_interval)
+        self.backoff_factor = backoff_factor
+        self.jitter = jitter
+        self._clock = clock
+        self._rand = rand
+        now = clock()
+        self.intervals = [min_interval] * count
+        # all projects are due immediately after start
+        self.next_polls = [now] * count
+
+    @classmethod
+    def from_config(cls, config, count):
+        """Create scheduler with daemon settings from config"""
+        return cls(
+            count,
+            config.as_int("daemon.sleep_time"),
+            max_interval=config.get("daemon.max_sleep_time"),
+            backoff_factor=config.get("daemon.backoff_factor") or 2,
+            jitter=config.get("daemon.jitter") or 0,
+        )
+
+    def due(self):
+        """Returns indexes of projects to be polled now"""
+        now = self._clock()
+        return [i for i, t in enumerate(self.next_polls) if t <= now]
+
+    def record(self, index, changed):
+        """Schedule next poll of project based on result of the last one
+        :param index: int project index
+        :param changed: bool whether there were changes on Mergin
+        """
+        if changed:
+            interval = self.min_interval
+        else:
+            interval = min(
+                self.intervals[index] * self.backoff_factor, self.max_interval
+            )
+        self.intervals[index] = interval
+        deviation = (2 * self._rand() - 1) * self.jitter
+        self.next_polls[index] = self._clock() + interval * (1 + deviation)
+
+    def time_to_next(self):
+        """Returns number of seconds until some project is due"""
+        return max(0, min(self.next_polls) - self._clock())
@@ -42,6 +42,22 @@ def setup_config():
             "DRIVER": "",
             "REFERENCES": [],
             "BASE_PATH": "",
+            "PROJECTS": [],
+            "MANIFEST__FILE": "",
+            "UPLOAD__WORKERS": 1,
+            "UPLOAD__DEDUPLICATE": False,
+            "UPLOAD__ENGINE": "threads",
+            "UPLOAD__MAX_IN_FLIGHT": 100,
+            "UPLOAD__BATCH_SIZE": 0,
+            "UPLOAD__SKIP_EXISTING": False,
+            "CHECKPOINT__FILES": None,
+            "CHECKPOINT__MINUTES": None,
+            "RETRY__MAX_ATTEMPTS": None,
+            "RETRY__BACKOFF": None,
+            "RETRY__BREAKER_THRESHOLD": None,
+            "RETRY__QUEUE_DELAY": None,
+            "RATE_LIMIT": {},
+            "LOCAL__TRANSFER": None,
             "MINIO__ENDPOINT": "",
             "MINIO__ACCESS_KEY": "",
             "MINIO__SECRET_KEY": "",
@@ -49,6 +65,12 @@ def setup_config():
             "MINIO__BUCKET_SUBPATH": "",
             "MINIO__SECURE": False,
             "MINIO__REGION": "",
+            "MINIO__PART_SIZE": None,
+            "MINIO__PARALLEL_UPLOADS": 3,
+            "MINIO__RESUME_STATE_FILE": "",
+            "MINIO__POOL_SIZE": None,
+            "GOOGLE_DRIVE__CHUNK_SIZE": None,
+            "GOOGLE_DRIVE__RESUME_STATE_FILE": "",
         }
     )
 
@@ -0,0 +1,255 @@
+"""
+Mergin Media Sync - a tool to sync media files from Mergin projects to other storage backends
+
+Copyright (C) 2021 Lutra Consulting
+
+License: MIT
+
+Minimal in-memory stand-in for S3 compatible server to test drivers without MinIO service.
+"""
+
+import hashlib
+import threading
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+from xml.sax.saxutils import escape
+
+S3_XMLNS = "http://s3.amazonaws.com/doc/2006-03-01/"
+
+
+class FakeS3Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def _parse(self):
+        url = urlparse(self.path)
+        parts = unquote(url.path).lstrip("/").split("/", 1)
+        bucket = parts[0]
+        key = parts[1] if len(parts) > 1 else ""
+        query = {
+            k: v[0] for k, v in parse_qs(url.query, keep_blank_values=True).items()
+        }
+        return bucket, key, query
+
+    def _body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def _respond(self, status=200, body=b"", headers=None):
+        if isinstance(body, str):
+            body = body.encode()
+        self.send_response(status)
+        headers = headers or {}
+        for name, value in headers.items():
+            self.send_header(name, value)
+        if "Content-Length" not in headers:
+            self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def _error(self, status, code):
+        body = f"<Error><Code>{code}</Code><Message>{code}</Message><Resource>{escape(self.path)}</Resource><RequestId>1</RequestId><HostId>1</HostId></Error>"
+        self._respond(status, body, {"Content-Type": "application/xml"})
+
+    def _dispatch(self):
+        bucket, key, query = self._parse()
+        body = self._body()
+        server = self.server
+        with server.lock:
+            server.requests.append((self.command, bucket, key, query))
+        if server.fail_request and server.fail_request(self.command, key, query):
+            return self._error(400, "InternalError")
+        handler = getattr(self, "_handle_" + self.command.lower())
+        return handler(bucket, key, query, body)
+
+    do_GET = do_PUT = do_POST = do_HEAD = do_DELETE = _dispatch
+
+    def _handle_head(self, bucket, key, query, body):
+        if not key:
+            return self._respond(200 if bucket in self.server.buckets else 404)
+        obj = self.server.objects.get((bucket, key))
+        if obj is None:
+            return self._respond(404)
+        return self._respond(
+            200,
+            headers={
+                "ETag": f'"{obj["etag"]}"',
+                "Content-Length": str(len(obj["data"])),
+                "Last-Modified": "Mon, 01 Jan 2024 00:00:00 GMT",
+            },
+        )
+
+    def _handle_get(self, bucket, key, query, body):
+        if "location" in query:
+            return self._respond(
+                200,
+                f'<LocationConstraint xmlns="{S3_XMLNS}"></LocationConstraint>',
+                {"Content-Type": "application/xml"},
+            )
+        if "uploadId" in query:
+            upload = self.server.uploads.get(query["uploadId"])
+            if upload is None:
+                return self._error(404, "NoSuchUpload")
+            parts = "".join(
+                f"<Part><PartNumber>{n}</PartNumber><ETag>\"{p['etag']}\"</ETag><Size>{len(p['data'])}</Size></Part>"
+                for n, p in sorted(upload["parts"].items())
+            )
+            return self._respond(
+                200,
+                f'<ListPartsResult xmlns="{S3_XMLNS}"><Bucket>{bucket}</Bucket><Key>{escape(key)}</Key>'
+                f"<UploadId>{query['uploadId']}</UploadId><IsTruncated>false</IsTruncated>{parts}</ListPartsResult>",
+                {"Content-Type": "application/xml"},
+            )
+        if not key:
+            return self._list_objects(bucket, query)
+        obj = self.server.objects.get((bucket, key))
+        if obj is None:
+            return self._error(404, "NoSuchKey")
+        return self._respond(200, obj["data"], {"ETag": f'"{obj["etag"]}"'})
+
+    def _list_objects(self, bucket, query):
+        prefix = query.get("prefix", "")
+        start_after = query.get("continuation-token") or query.get("start-after", "")
+        max_keys = int(query.get("max-keys") or 1000)
+        max_keys = min(max_keys, self.server.max_keys)
+        keys = sorted(
+            k
+            for (b, k) in self.server.objects
+            if b == bucket and k.startswith(prefix) and k > start_after
+        )
+        page = keys[:max_keys]
+        truncated = len(keys) > max_keys
+        contents = "".join(
+            f"<Contents><Key>{escape(k)}</Key><LastModified>2024-01-01T00:00:00.000Z</LastModified>"
+            f"<ETag>\"{self.server.objects[(bucket, k)]['etag']}\"</ETag>"
+            f"<Size>{len(self.server.objects[(bucket, k)]['data'])}</Size><StorageClass>STANDARD</StorageClass></Contents>"
+            for k in page
+        )
+        token = (
+            f"<NextContinuationToken>{page[-1]}</NextContinuationToken>"
+            if truncated
+            else ""
+        )
+        return self._respond(
+            200,
+            f'<ListBucketResult xmlns="{S3_XMLNS}"><Name>{bucket}</Name><Prefix>{prefix}</Prefix>'
+            f"<KeyCount>{len(page)}</KeyCount><MaxKeys>{max_keys}</MaxKeys>"
+            f"<IsTruncated>{'true' if truncated else 'false'}</IsTruncated>{token}{contents}</ListBucketResult>",
+            {"Content-Type": "application/xml"},
+        )
+
+    def _handle_put(self, bucket, key, query, body):
+        if not key:
+            self.server.buckets.add(bucket)
+            return self._respond(200)
+        if "uploadId" in query:
+            upload = self.server.uploads.get(query["uploadId"])
+            if upload is None:
+                return self._error(404, "NoSuchUpload")
+            etag = hashlib.md5(body).hexdigest()
+            upload["parts"][int(query["partNumber"])] = {"data": body, "etag": etag}
+            return self._respond(200, headers={"ETag": f'"{etag}"'})
+        copy_source = self.headers.get("x-amz-copy-source")
+        if copy_source:
+            src_bucket, src_key = unquote(copy_source).lstrip("/").split("/", 1)
+            src = self.server.objects.get((src_bucket, src_key))
+            if src is None:
+                return self._error(404, "NoSuchKey")
+            self.server.objects[(bucket, key)] = dict(src, headers=dict(self.headers))
+            return self._respond(
+                200,
+                f"<CopyObjectResult><LastModified>2024-01-01T00:00:00.000Z</LastModified>"
+                f"<ETag>\"{src['etag']}\"</ETag></CopyObjectResult>",
+                {"Content-Type": "application/xml"},
+            )
+        etag = hashlib.md5(body).hexdigest()
+        self.server.objects[(bucket, key)] = {
+            "data": body,
+            "etag": etag,
+            "headers": dict(self.headers),
+        }
+        return self._respond(200, headers={"ETag": f'"{etag}"'})
+
+    def _handle_post(self, bucket, key, query, body):
+        if "uploads" in query:
+            upload_id = uuid.uuid4().hex
+            self.server.uploads[upload_id] = {
+                "key": key,
+                "parts": {},
+                "headers": dict(self.headers),
+            }
+            return self._respond(
+                200,
+                f'<InitiateMultipartUploadResult xmlns="{S3_XMLNS}"><Bucket>{bucket}</Bucket>'
+                f"<Key>{escape(key)}</Key><UploadId>{upload_id}</UploadId></InitiateMultipartUploadResult>",
+                {"Content-Type": "application/xml"},
+            )
+        if "uploadId" in query:
+            upload = self.server.uploads.pop(query["uploadId"], None)
+            if upload is None:
+                return self._error(404, "NoSuchUpload")
+            parts = [upload["parts"][n] for n in sorted(upload["parts"])]
+            digest = hashlib.md5(
+                b"".join(bytes.fromhex(p["etag"]) for p in parts)
+            ).hexdigest()
+            etag = f"{digest}-{len(parts)}"
+            self.server.objects[(bucket, key)] = {
+                "data": b"".join(p["data"] for p in parts),
+                "etag": etag,
+                "headers": upload["headers"],
+            }
+            return self._respond(
+                200,
+                f'<CompleteMultipartUploadResult xmlns="{S3_XMLNS}"><Location>/{bucket}/{key}</Location>'
+                f'<Bucket>{bucket}</Bucket><Key>{escape(key)}</Key><ETag>"{etag}"</ETag></CompleteMultipartUploadResult>',
+                {"Content-Type": "application/xml"},
+            )
+        return self._error(400, "InvalidRequest")
+
+    def _handle_delete(self, bucket, key, query, body):
+        if "uploadId" in query:
+            self.server.uploads.pop(query["uploadId"], None)
+        else:
+            self.server.objects.pop((bucket, key), None)
+        return self._respond(204)
+
+
+class FakeS3Server(ThreadingHTTPServer):
+    """S3 stand-in running in background thread, keeps buckets, objects and multipart uploads in memory"""
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), FakeS3Handler)
+        self.lock = threading.Lock()
+        self.buckets = set()
+        self.objects = {}
+        self.uploads = {}
+        self.requests = []
+        self.connections = 0
+        self.max_keys = 1000
+        # callable(method, key, query) -> bool to make request fail
+        self.fail_request = None
+        self._thread = None
+
+    @property
+    def endpoint(self):
+        return f"127.0.0.1:{self.server_address[1]}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -8,7 +8,7 @@ License: MIT
 
 import pytest
 
-from config import config, ConfigError, validate_config
+from config import config, ConfigError, get_project_configs, validate_config
 
 from .conftest import (
     SERVER_URL,
@@ -36,7 +36,18 @@ def _reset_config():
             "MINIO__ACCESS_KEY": MINIO_ACCESS_KEY,
             "MINIO__SECRET_KEY": MINIO_SECRET_KEY,
             "MINIO__BUCKET": "test",
+            "LOCAL__TRANSFER": None,
             "BASE_PATH": "",
+            "UPLOAD__WORKERS": 1,
+            "UPLOAD__ENGINE": "threads",
+            "UPLOAD__MAX_IN_FLIGHT": 100,
+            "UPLOAD__BATCH_SIZE": 0,
+            "CHECKPOINT__FILES": None,
+            "CHECKPOINT__MINUTES": None,
+            "RETRY__MAX_ATTEMPTS": None,
+            "RATE_LIMIT": {},
+            "METRICS__PORT": None,
+            "PROJECTS": [],
         }
     )
 
@@ -65,6 +76,54 @@ def test_config():
     )
     validate_config(config)
 
+    _reset_config()
+    with pytest.raises(ConfigError, match="Config error: Incorrect upload settings"):
+        config.update({"UPLOAD__WORKERS": 0})
+        validate_config(config)
+    config.update({"UPLOAD__WORKERS": 4})
+    validate_config(config)
+    with pytest.raises(ConfigError, match="Config error: Incorrect upload settings"):
+        config.update({"UPLOAD__BATCH_SIZE": -1})
+        validate_config(config)
+    config.update({"UPLOAD__BATCH_SIZE": 100})
+    validate_config(config)
+    with pytest.raises(
+        ConfigError, match="Config error: Incorrect checkpoint settings"
+    ):
+        config.update({"CHECKPOINT__MINUTES": "often"})
+        validate_config(config)
+    config.update({"CHECKPOINT__FILES": 1000, "CHECKPOINT__MINUTES": 15})
+    validate_config(config)
+    with pytest.raises(ConfigError, match="Config error: Incorrect retry settings"):
+        config.update({"RETRY__MAX_ATTEMPTS": 0})
+        validate_config(config)
+    config.update({"RETRY__MAX_ATTEMPTS": 5})
+    validate_config(config)
+    with pytest.raises(
+        ConfigError, match="Config error: Incorrect rate limit settings"
+    ):
+        config.update({"RATE_LIMIT": {"windows": [{"bytes_per_second": 100}]}})
+        validate_config(config)
+    config.update(
+        {
+            "RATE_LIMIT": {
+                "bytes_per_second": 10**6,
+                "windows": [{"start": "22:00", "end": "06:00", "bytes_per_second": 0}],
+            }
+        }
+    )
+    validate_config(config)
+    with pytest.raises(ConfigError, match="Config error: Incorrect metrics settings"):
+        config.update({"METRICS__PORT": 100000})
+        validate_config(config)
+    config.update({"METRICS__PORT": 9100})
+    validate_config(config)
+    with pytest.raises(ConfigError, match="Config error: Unsupported upload engine"):
+        config.update({"UPLOAD__ENGINE": "processes"})
+        validate_config(config)
+    config.update({"UPLOAD__ENGINE": "asyncio", "UPLOAD__MAX_IN_FLIGHT": 200})
+    validate_config(config)
+
     with pytest.raises(ConfigError, match="Config error: Incorrect mergin settings"):
         config.update({"MERGIN__USERNAME": None})
         validate_config(config)
@@ -81,6 +140,19 @@ def test_config():
         config.update({"DRIVER": "local", "LOCAL__DEST": None})
         validate_config(config)
 
+    _reset_config()
+    with pytest.raises(
+        ConfigError, match="Config error: Unsupported Local driver transfer method"
+    ):
+        config.update(
+            {
+                "DRIVER": "local",
+                "LOCAL__DEST": "/tmp/mediasync_copy",
+                "LOCAL__TRANSFER": "symlink",
+            }
+        )
+        validate_config(config)
+
     _reset_config()
     with pytest.raises(
         ConfigError, match="Config error: Incorrect MinIO driver settings"
@@ -88,6 +160,29 @@ def test_config():
         config.update({"DRIVER": "minio", "MINIO__ENDPOINT": None})
         validate_config(config)
 
+    _reset_config()
+    s3_settings = {
+        "endpoint": "s3.amazonaws.com",
+        "access_key": "access",
+        "secret_key": "secret",
+        "bucket": "media",
+    }
+    with pytest.raises(ConfigError, match="Config error: Incorrect S3 driver settings"):
+        config.update({"DRIVER": "s3", "S3": {"endpoint": "s3.amazonaws.com"}})
+        validate_config(config)
+    with pytest.raises(ConfigError, match="Config error: S3 CDN URL is not set"):
+        config.update({"S3": dict(s3_settings, url="cdn")})
+        validate_config(config)
+    with pytest.raises(
+        ConfigError, match="Config error: S3 URL expiration must be between"
+    ):
+        config.update(
+            {"S3": dict(s3_settings, url="presigned", url_expiration=30 * 24 * 3600)}
+        )
+        validate_config(config)
+    config.update({"S3": dict(s3_settings, url="presigned", url_expiration=3600)})
+    validate_config(config)
+
     _reset_config()
     with pytest.raises(
         ConfigError, match="Config error: Allowed extensions can not be empty"
@@ -111,3 +206,80 @@ def test_config():
     with pytest.raises(ConfigError, match="Config error: Incorrect reference settings"):
         config.update({"REFERENCES": "text"})
         validate_config(config)
+
+
+def test_project_configs():
+    _reset_config()
+    project_configs = get_project_configs(config)
+    assert project_configs == [config]
+
+    config.update(
+        {
+            "MINIO__BUCKET_SUBPATH": "",
+            "PROJECTS": [
+                {"project_name": "test/project-a"},
+                {
+                    "project_name": "test/project-b",
+                    "project_working_dir": "/tmp/project_b",
+                    "minio": {"bucket_subpath": "b"},
+                    "references": [
+                        {
+                            "file": "survey.gpkg",
+                            "table": "notes",
+                            "local_path_column": "photo",
+                            "driver_path_column": "ext_url",
+                        }
+                    ],
+                },
+            ],
+        }
+    )
+    project_a, project_b = get_project_configs(config)
+    validate_config(project_a)
+    validate_config(project_b)
+    assert project_a.mergin.project_name == "test/project-a"
+    assert project_a.project_working_dir == "/tmp/working_project/test_project-a"
+    assert project_a.minio.bucket_subpath == ""
+    assert project_b.mergin.project_name == "test/project-b"
+    assert project_b.project_working_dir == "/tmp/project_b"
+    # overrides are merged with global settings
+    assert project_b.minio.bucket_subpath == "b"
+    assert project_b.minio.bucket == "test"
+    assert project_b.mergin.username == config.mergin.username
+    assert project_b.references[0].table == "notes"
+    # global config is not modified
+    assert config.mergin.project_name == "test/mediasync"
+    assert config.minio.bucket_subpath == ""
+
+    with pytest.raises(ConfigError, match="Config error: Incorrect project settings"):
+        config.update({"PROJECTS": [{"project_working_dir": "/tmp/project"}]})
+        get_project_configs(config)
+
+    with pytest.raises(
+        ConfigError, match="Config error: Projects can not share working directory"
+    ):
+        config.update(
+            {
+                "PROJECTS": [
+                    {"project_name": "test/a", "project_working_dir": "/tmp/project"},
+                    {"project_name": "test/b", "project_working_dir": "/tmp/project"},
+                ]
+            }
+        )
+        get_project_configs(config)
+
+    _reset_config()
+    with pytest.raises(ConfigError, match="Config error: Incorrect daemon settings"):
+        config.update({"DAEMON__WORKERS": 0})
+        validate_config(config)
+    config.update({"DAEMON__WORKERS": 4})
+    validate_config(config)
+    with pytest.raises(ConfigError, match="Config error: Incorrect daemon settings"):
+        config.update({"DAEMON__BACKOFF_FACTOR": 0.5})
+        validate_config(config)
+    config.update({"DAEMON__BACKOFF_FACTOR": 2})
+    with pytest.raises(ConfigError, match="Config error: Incorrect daemon settings"):
+        config.update({"DAEMON__JITTER": 1})
+        validate_config(config)
+    config.update({"DAEMON__JITTER": 0.1, "DAEMON__MAX_SLEEP_TIME": 300})
+    validate_config(config)
@@ -0,0 +1,713 @@
+"""
+Mergin Media Sync - a tool to sync media files from Mergin projects to other storage backends
+
+Copyright (C) 2021 Lutra Consulting
+
+License: MIT
+"""
+
+import errno
+import json
+import os
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from importlib.metadata import EntryPoint
+
+import pytest
+from googleapiclient.discovery import build
+from googleapiclient.http import HttpMockSequence
+
+import drivers
+import google_drive_driver
+from config import config, get_project_configs, validate_config
+from drivers import (
+    DRIVERS_ENTRY_POINT_GROUP,
+    DriverError,
+    LocalDriver,
+    RetryingDriver,
+    TransientDriverError,
+    create_driver,
+    create_drivers,
+    get_driver_class,
+    get_driver_names,
+)
+from google_drive_driver import GoogleDriveDriver
+from minio_driver import MinioDriver, file_etag
+from s3_driver import S3Driver
+
+from metrics import metrics
+from ratelimit import THROTTLE_CHUNK_SIZE, RateLimiter
+
+from .fake_s3 import FakeS3Server
+
+
+@pytest.fixture(scope="function")
+def s3_server():
+    server = FakeS3Server().start()
+    yield server
+    server.stop()
+
+
+def _setup_minio(server, **kwargs):
+    config.update(
+        {
+            "DRIVER": "minio",
+            "MINIO__ENDPOINT": server.endpoint,
+            "MINIO__ACCESS_KEY": "access",
+            "MINIO__SECRET_KEY": "secret",
+            "MINIO__BUCKET": "test",
+            "MINIO__SECURE": False,
+            "MINIO__REGION": "us-east-1",
+        }
+    )
+    config.update({"MINIO__" + k.upper(): v for k, v in kwargs.items()})
+
+
+def test_minio_resumable_upload(tmp_path, s3_server):
+    """Test interrupted multipart upload continues with missing parts only"""
+    state_file = str(tmp_path / "minio_uploads.json")
+    _setup_minio(
+        s3_server, part_size=5, parallel_uploads=2, resume_state_file=state_file
+    )
+    src = str(tmp_path / "video.mp4")
+    data = os.urandom(12 * 1024 * 1024)
+    with open(src, "wb") as f:
+        f.write(data)
+
+    # last part fails to upload
+    s3_server.fail_request = lambda method, key, query: query.get("partNumber") == "3"
+    driver = MinioDriver(config)
+    with pytest.raises(DriverError):
+        driver.upload_file(src, "videos/video.mp4")
+    assert ("test", "videos/video.mp4") not in s3_server.objects
+    with open(state_file) as f:
+        state = json.load(f)
+    upload_id = state["test/videos/video.mp4"]["upload_id"]
+    assert sorted(s3_server.uploads[upload_id]["parts"]) == [1, 2]
+
+    # next run (with new driver instance) uploads only the missing part
+    s3_server.fail_request = None
+    s3_server.requests.clear()
+    driver = MinioDriver(config)
+    dest = driver.upload_file(src, "videos/video.mp4")
+    assert dest == f"http://{s3_server.endpoint}/test/videos/video.mp4"
+    part_uploads = [r for r in s3_server.requests if "partNumber" in r[3]]
+    assert [r[3]["partNumber"] for r in part_uploads] == ["3"]
+    assert s3_server.objects[("test", "videos/video.mp4")]["data"] == data
+    with open(state_file) as f:
+        assert json.load(f) == {}
+
+    # modified file starts new upload
+    with open(src, "wb") as f:
+        f.write(data[::-1])
+    s3_server.fail_request = lambda method, key, query: query.get("partNumber") == "2"
+    with pytest.raises(DriverError):
+        driver.upload_file(src, "videos/video.mp4")
+    with open(src, "ab") as f:
+        f.write(b"more data")
+    s3_server.fail_request = None
+    driver.upload_file(src, "videos/video.mp4")
+    assert not s3_server.uploads
+    assert s3_server.objects[("test", "videos/video.mp4")]["data"] == (
+        data[::-1] + b"more data"
+    )
+
+
+def test_minio_resumable_upload_rate_limit(tmp_path, s3_server):
+    """Test parts of multipart upload are read at limited rate in small chunks"""
+    _setup_minio(
+        s3_server,
+        part_size=5,
+        resume_state_file=str(tmp_path / "minio_uploads.json"),
+    )
+    config.update({"RATE_LIMIT": {"bytes_per_second": 1000000}})
+    src = str(tmp_path / "video.mp4")
+    data = os.urandom(12 * 1024 * 1024)
+    with open(src, "wb") as f:
+        f.write(data)
+    driver = MinioDriver(config)
+    throttled = []
+
+    class RecordingRateLimiter(RateLimiter):
+        def throttle(self, size):
+            throttled.append(size)
+            return 0
+
+    driver.rate_limiter = RecordingRateLimiter(1000000)
+    s3_server.requests.clear()
+    driver.upload_file(src, "videos/video.mp4")
+    assert s3_server.objects[("test", "videos/video.mp4")]["data"] == data
+    assert sum(throttled) == len(data)
+    assert max(throttled) <= THROTTLE_CHUNK_SIZE
+    # create upload, three parts and complete upload
+    assert [(r[0], sorted(r[3])) for r in s3_server.requests] == [
+        ("POST", ["uploads"]),
+        ("PUT", ["partNumber", "uploadId"]),
+        ("PUT", ["partNumber", "uploadId"]),
+        ("PUT", ["partNumber", "uploadId"]),
+        ("POST", ["uploadId"]),
+    ]
+
+
+def test_minio_small_file_upload(tmp_path, s3_server):
+    """Test files smaller than part size are uploaded with single request"""
+    _setup_minio(
+        s3_server,
+        part_size=5,
+        resume_state_file=str(tmp_path / "state.json"),
+        bucket_subpath="sub",
+    )
+    src = str(tmp_path / "img.jpg")
+    with open(src, "wb") as f:
+        f.write(b"image")
+    driver = MinioDriver(config)
+    dest = driver.upload_file(src, "images/img.jpg")
+    assert dest == f"http://{s3_server.endpoint}/test/sub/images/img.jpg"
+    assert s3_server.objects[("test", "sub/images/img.jpg")]["data"] == b"image"
+    assert not os.path.exists(str(tmp_path / "state.json"))
+
+
+def test_minio_list_existing(tmp_path, s3_server):
+    """Test objects at destination are listed in pages and compared by size and ETag"""
+    _setup_minio(s3_server, part_size=5, bucket_subpath="sub")
+    s3_server.max_keys = 2
+    driver = MinioDriver(config)
+    small = str(tmp_path / "small.jpg")
+    with open(small, "wb") as f:
+        f.write(b"image")
+    big = str(tmp_path / "big.mp4")
+    with open(big, "wb") as f:
+        f.write(os.urandom(12 * 1024 * 1024))
+    for i in range(3):
+        driver.upload_file(small, f"images/img{i}.jpg")
+    driver.upload_file(big, "videos/big.mp4")
+    driver.upload_file(small, "other.jpg")
+
+    existing = driver.list_existing("images/")
+    assert sorted(existing) == [f"images/img{i}.jpg" for i in range(3)]
+    assert existing["images/img0.jpg"]["size"] == 5
+    assert existing["images/img0.jpg"]["dest"] == (
+        f"http://{s3_server.endpoint}/test/sub/images/img0.jpg"
+    )
+    # listing is paginated
+    list_requests = [r for r in s3_server.requests if r[0] == "GET" and not r[2]]
+    assert len(list_requests) == 2
+    assert driver.is_uploaded(small, existing["images/img0.jpg"])
+
+    existing = driver.list_existing()
+    assert len(existing) == 5
+    assert existing["videos/big.mp4"]["etag"].endswith("-3")
+    assert driver.is_uploaded(big, existing["videos/big.mp4"])
+    with open(big, "r+b") as f:
+        f.write(b"changed")
+    assert not driver.is_uploaded(big, existing["videos/big.mp4"])
+    assert not driver.is_uploaded(small, existing["videos/big.mp4"])
+
+
+def test_file_etag(tmp_path):
+    """Test ETags of single and multipart uploads"""
+    path = str(tmp_path / "file")
+    with open(path, "wb") as f:
+        f.write(b"a" * 10)
+    assert file_etag(path) == "e09c80c42fda55f9d992e59ca6b3307d"
+    # MD5 of MD5s of parts "aaaa", "aaaa", "aa"
+    assert file_etag(path, 4) == "1c06f341515fe359bacc890ca66aa673-3"
+
+
+def _setup_s3(server, **kwargs):
+    config.update(
+        {
+            "DRIVER": "s3",
+            "S3": {
+                "endpoint": server.endpoint,
+                "access_key": "access",
+                "secret_key": "secret",
+                "bucket": "test",
+                "secure": False,
+                "region": "us-east-1",
+                **kwargs,
+            },
+        }
+    )
+
+
+def test_s3_driver(tmp_path, s3_server):
+    """Test URL types, storage class and server-side copy of S3 driver"""
+    _setup_s3(
+        s3_server,
+        url="presigned",
+        url_expiration=3600,
+        storage_class="STANDARD_IA",
+        bucket_subpath="sub",
+    )
+    src = str(tmp_path / "img.jpg")
+    with open(src, "wb") as f:
+        f.write(b"image")
+    driver = S3Driver(config)
+    dest = driver.upload_file(src, "images/img.jpg")
+    assert dest.startswith(f"http://{s3_server.endpoint}/test/sub/images/img.jpg?")
+    assert "X-Amz-Expires=3600" in dest and "X-Amz-Signature=" in dest
+    obj = s3_server.objects[("test", "sub/images/img.jpg")]
+    assert obj["headers"]["x-amz-storage-class"] == "STANDARD_IA"
+    # URL of uploaded file is signed again, e.g. for file recorded in manifest
+    url = driver.get_url("images/img.jpg")
+    assert url.startswith(f"http://{s3_server.endpoint}/test/sub/images/img.jpg?")
+    assert "X-Amz-Signature=" in url
+
+    # object is copied on server, data are not sent again
+    requests_count = len(s3_server.requests)
+    dest = driver.copy_file("images/img.jpg", "images/renamed.jpg")
+    assert "sub/images/renamed.jpg?" in dest
+    copy = s3_server.objects[("test", "sub/images/renamed.jpg")]
+    assert copy["data"] == b"image"
+    assert copy["headers"]["x-amz-copy-source"] == "/test/sub/images/img.jpg"
+    assert copy["headers"]["x-amz-storage-class"] == "STANDARD_IA"
+    assert [r[0] for r in s3_server.requests[requests_count:]] == ["HEAD", "PUT"]
+    # missing source is uploaded instead
+    assert driver.copy_file("images/missing.jpg", "images/other.jpg") is None
+
+    _setup_s3(s3_server, url="cdn", cdn_url="https://cdn.example.com/media/")
+    driver = S3Driver(config)
+    dest = driver.upload_file(src, "images/img.jpg")
+    assert dest == "https://cdn.example.com/media/images/img.jpg"
+    assert (
+        "x-amz-storage-class"
+        not in s3_server.objects[("test", "images/img.jpg")]["headers"]
+    )
+
+    _setup_s3(s3_server)
+    assert S3Driver(config).upload_file(src, "images/img.jpg") == (
+        f"http://{s3_server.endpoint}/test/images/img.jpg"
+    )
+
+
+def test_minio_rate_limit(tmp_path, s3_server):
+    """Test upload waits for rate limiter"""
+    _setup_minio(s3_server, part_size=5)
+    config.update({"RATE_LIMIT": {"bytes_per_second": 1000, "requests_per_second": 2}})
+    src = str(tmp_path / "img.jpg")
+    with open(src, "wb") as f:
+        f.write(b"x" * 3000)
+    driver = MinioDriver(config)
+    assert isinstance(driver.rate_limiter, RateLimiter)
+    waits = []
+    driver.rate_limiter = RateLimiter(
+        1000, 2, clock=lambda: 0, sleep=lambda seconds: waits.append(seconds)
+    )
+    driver.upload_file(src, "images/img.jpg")
+    assert s3_server.objects[("test", "images/img.jpg")]["data"] == b"x" * 3000
+    # one second of burst, the rest of file is paid by waiting
+    assert sum(waits) == 2
+
+
+@pytest.mark.parametrize("pool_size,max_connections", [(4, 4), (1, None)])
+def test_minio_connection_reuse(tmp_path, s3_server, pool_size, max_connections):
+    """Test concurrent uploads reuse connections from pool of configured size"""
+    _setup_minio(s3_server, pool_size=pool_size)
+    config.update({"UPLOAD__WORKERS": 4})
+    src = str(tmp_path / "img.jpg")
+    with open(src, "wb") as f:
+        f.write(b"image")
+    driver = MinioDriver(config)
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        list(
+            executor.map(
+                lambda i: driver.upload_file(src, f"images/img{i}.jpg"), range(100)
+            )
+        )
+    assert len(s3_server.objects) == 100
+    if max_connections:
+        assert s3_server.connections <= max_connections
+    else:
+        # too small pool makes connections to be thrown away and reopened
+        assert s3_server.connections > 4
+
+
+@pytest.mark.parametrize(
+    "transfer,mode,linked",
+    [
+        ("auto", "copy", False),
+        ("auto", "move", True),
+        ("copy", "move", False),
+        ("reflink", "copy", False),
+        ("hardlink", "copy", True),
+    ],
+)
+def test_local_transfer(tmp_path, transfer, mode, linked):
+    """Test local driver creates files with configured transfer method"""
+    config.update(
+        {
+            "LOCAL__DEST": str(tmp_path / "dest"),
+            "LOCAL__TRANSFER": transfer,
+            "OPERATION_MODE": mode,
+        }
+    )
+    src = str(tmp_path / "img.jpg")
+    with open(src, "wb") as f:
+        f.write(os.urandom(100000))
+    driver = LocalDriver(config)
+    dest = driver.upload_file(src, "images/img.jpg")
+    assert dest == str(tmp_path / "dest" / "images" / "img.jpg")
+    assert os.path.samefile(src, dest) == linked
+    with open(src, "rb") as fsrc, open(dest, "rb") as fdst:
+        assert fsrc.read() == fdst.read()
+    # upload again replaces file, no temporary files are left
+    assert driver.upload_file(src, "images/img.jpg") == dest
+    assert os.listdir(tmp_path / "dest" / "images") == ["img.jpg"]
+
+
+def test_local_transfer_fallback(tmp_path, monkeypatch):
+    """Test local driver falls back to copy when faster methods are not supported"""
+    config.update(
+        {"LOCAL__DEST": str(tmp_path / "dest"), "LOCAL__TRANSFER": "hardlink"}
+    )
+    src = str(tmp_path / "img.jpg")
+    with open(src, "wb") as f:
+        f.write(os.urandom(100000))
+
+    def unsupported(*args):
+        raise OSError(errno.EXDEV, "Invalid cross-device link")
+
+    # links across filesystems and old kernels without copy_file_range
+    monkeypatch.setattr(drivers.os, "link", unsupported)
+    monkeypatch.setattr(drivers.os, "copy_file_range", unsupported, raising=False)
+    driver = LocalDriver(config)
+    dest = driver.upload_file(src, "images/img.jpg")
+    assert not os.path.samefile(src, dest)
+    with open(src, "rb") as fsrc, open(dest, "rb") as fdst:
+        assert fsrc.read() == fdst.read()
+
+    # other errors are not hidden and partial file is removed
+    def no_space(*args):
+        raise OSError(errno.ENOSPC, "No space left on device")
+
+    monkeypatch.setattr(drivers.os, "sendfile", no_space)
+    with pytest.raises(DriverError, match="No space left on device"):
+        driver.upload_file(src, "images/other.jpg")
+    assert os.listdir(tmp_path / "dest" / "images") == ["img.jpg"]
+
+
+def test_create_drivers(tmp_path):
+    """Test projects with the same driver settings share driver object"""
+    config.update(
+        {
+            "DRIVER": "local",
+            "LOCAL__DEST": str(tmp_path / "dest"),
+            "PROJECT_WORKING_DIR": str(tmp_path / "projects"),
+            "PROJECTS": [
+                {"project_name": "test/project-a"},
+                {"project_name": "test/project-b"},
+                {
+                    "project_name": "test/project-c",
+                    "local": {"dest": str(tmp_path / "dest_c")},
+                },
+                {"project_name": "test/project-d", "operation_mode": "move"},
+            ],
+        }
+    )
+    driver_a, driver_b, driver_c, driver_d = create_drivers(get_project_configs(config))
+    # projects share driver and its breaker, retries are counted per project
+    assert driver_a.driver is driver_b.driver
+    assert driver_a.breaker is driver_b.breaker
+    assert driver_a.project == "test/project-a"
+    assert driver_b.project == "test/project-b"
+    assert driver_c.driver is not driver_a.driver
+    assert driver_a.dest == str(tmp_path / "dest")
+    assert driver_c.dest == str(tmp_path / "dest_c")
+    # local driver hardlinks files only for projects in move mode
+    assert driver_d.driver is not driver_a.driver
+    assert drivers._hardlink in driver_d.methods
+    assert drivers._hardlink not in driver_a.methods
+
+
+class PluginDriver(LocalDriver):
+    """Driver of third-party package"""
+
+
+def test_driver_registry(tmp_path, monkeypatch):
+    """Test drivers of plugins are discovered via entry points and loaded on first use"""
+    entry_point = EntryPoint(
+        "plugin", "test.test_drivers:PluginDriver", DRIVERS_ENTRY_POINT_GROUP
+    )
+    overriding_entry_point = EntryPoint(
+        "local", "test.test_drivers:PluginDriver", DRIVERS_ENTRY_POINT_GROUP
+    )
+    monkeypatch.setattr(drivers, "_drivers", dict(drivers._drivers))
+    monkeypatch.setattr(drivers, "_entry_points_loaded", False)
+    monkeypatch.setattr(
+        drivers,
+        "entry_points",
+        lambda group: [entry_point, overriding_entry_point],
+    )
+    assert get_driver_names() == ["google_drive", "local", "minio", "plugin", "s3"]
+    # built-in driver can not be replaced by plugin
+    assert get_driver_class("local") is LocalDriver
+    assert get_driver_class("minio") is MinioDriver
+
+    config.update(
+        {
+            "DRIVER": "plugin",
+            "LOCAL__DEST": str(tmp_path / "dest"),
+            "MERGIN__PROJECT_NAME": "test/project",
+        }
+    )
+    validate_config(config)
+    assert type(create_driver(config)) is PluginDriver
+    assert drivers._drivers["plugin"] is PluginDriver
+
+    with pytest.raises(DriverError, match="Unsupported driver: other"):
+        get_driver_class("other")
+    drivers.register_driver("broken", "missing_module:Driver")
+    with pytest.raises(DriverError, match="Unable to load driver broken"):
+        get_driver_class("broken")
+
+
+def test_lazy_driver_imports():
+    """Test storage backend libraries are not imported until their driver is used"""
+    code = (
+        "import sys, media_sync; "
+        "print(any(m in sys.modules for m in ['minio', 'googleapiclient']))"
+    )
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    output = subprocess.check_output([sys.executable, "-c", code], cwd=root)
+    assert output.strip() == b"False"
+
+
+class FlakyDriver:
+    """Driver which fails with given errors before it succeeds"""
+
+    def __init__(self, errors):
+        self.errors = list(errors)
+        self.attempts = 0
+
+    def upload_file(self, src, obj_path):
+        self.attempts += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return "/dest/" + obj_path
+
+
+def test_retrying_driver():
+    """Test transient errors are retried with backoff and failing driver is paused"""
+    config.update(
+        {
+            "RETRY__MAX_ATTEMPTS": 3,
+            "RETRY__BACKOFF": 1,
+            "RETRY__MAX_BACKOFF": 30,
+            "RETRY__BREAKER_THRESHOLD": 4,
+            "RETRY__BREAKER_COOLDOWN": 60,
+            "MERGIN__PROJECT_NAME": "test/retrying",
+        }
+    )
+    now = [0]
+    sleeps = []
+
+    def create(errors):
+        flaky = FlakyDriver(errors)
+        driver = RetryingDriver(
+            flaky, config, sleep=sleeps.append, clock=lambda: now[0]
+        )
+        return flaky, driver
+
+    flaky, driver = create([TransientDriverError("timeout")] * 2)
+    assert driver.upload_file("src", "img.jpg") == "/dest/img.jpg"
+    assert flaky.attempts == 3
+    assert sleeps == [1, 2]
+    assert metrics.get("upload_retries_total", project="test/retrying") == 2
+
+    # permanent errors are not repeated
+    flaky, driver = create([DriverError("access denied")])
+    with pytest.raises(DriverError, match="access denied"):
+        driver.upload_file("src", "img.jpg")
+    assert flaky.attempts == 1
+
+    # breaker opens after consecutive failures and uploads are paused until cooldown passes
+    flaky, driver = create([TransientDriverError("unavailable")] * 4)
+    with pytest.raises(TransientDriverError):
+        driver.upload_file("src", "img.jpg")
+    with pytest.raises(DriverError, match="Uploads are paused"):
+        driver.upload_file("src", "img.jpg")
+    assert flaky.attempts == 4
+    now[0] = 60
+    assert driver.upload_file("src", "img.jpg") == "/dest/img.jpg"
+    assert flaky.attempts == 5
+
+
+def test_minio_transient_error(tmp_path, s3_server):
+    """Test server errors worth retrying are reported as transient"""
+    _setup_minio(s3_server)
+    src = str(tmp_path / "img.jpg")
+    with open(src, "wb") as f:
+        f.write(b"image")
+    s3_server.fail_request = lambda method, key, query: method == "PUT" and key
+    driver = MinioDriver(config)
+    with pytest.raises(TransientDriverError):
+        driver.upload_file(src, "images/img.jpg")
+    with pytest.raises(DriverError) as e:
+        driver.upload_file(str(tmp_path / "missing.jpg"), "images/missing.jpg")
+    assert not isinstance(e.value, TransientDriverError)
+
+
+class RecordingHttpMockSequence(HttpMockSequence):
+    """Mocked HTTP layer of Google API client which records requests"""
+
+    def __init__(self, iterable):
+        super(RecordingHttpMockSequence, self).__init__(iterable)
+        self.requests = []
+
+    def request(self, uri, method="GET", body=None, headers=None, *args, **kwargs):
+        self.requests.append((method, uri, headers or {}))
+        return super(RecordingHttpMockSequence, self).request(
+            uri, method, body, headers, *args, **kwargs
+        )
+
+
+@pytest.fixture(scope="function")
+def google_drive_http(monkeypatch):
+    """Make Google Drive driver use mocked HTTP layer, returns function to set responses"""
+    mock = {}
+
+    def set_responses(responses):
+        mock["http"] = RecordingHttpMockSequence(responses)
+        return mock["http"]
+
+    monkeypatch.setattr(
+        google_drive_driver.service_account.Credentials,
+        "from_service_account_file",
+        lambda *args, **kwargs: None,
+    )
+    monkeypatch.setattr(
+        google_drive_driver,
+        "build",
+        lambda *args, **kwargs: build("drive", "v3", http=mock["http"]),
+    )
+    return set_responses
+
+
+FOLDER_LIST_RESPONSE = (
+    {"status": "200"},
+    '{"files": [{"id": "folder1", "name": "media"}]}',
+)
+
+
+def test_google_drive_resumable_upload(tmp_path, google_drive_http):
+    """Test interrupted chunked upload to Google Drive continues from last uploaded chunk"""
+    state_file = str(tmp_path / "gdrive_uploads.json")
+    config.update(
+        {
+            "DRIVER": "google_drive",
+            "GOOGLE_DRIVE__SERVICE_ACCOUNT_FILE": "credentials.json",
+            "GOOGLE_DRIVE__FOLDER": "media",
+            "GOOGLE_DRIVE__SHARE_WITH": "",
+            "GOOGLE_DRIVE__CHUNK_SIZE": 1,
+            "GOOGLE_DRIVE__RESUME_STATE_FILE": state_file,
+        }
+    )
+    src = str(tmp_path / "video.mp4")
+    with open(src, "wb") as f:
+        f.write(os.urandom(int(2.5 * 1024 * 1024)))
+
+    session_uri = "https://www.googleapis.com/upload/drive/v3/files?upload_id=session1"
+    http = google_drive_http(
+        [
+            FOLDER_LIST_RESPONSE,
+            ({"status": "200", "location": session_uri}, ""),
+            ({"status": "308", "range": "bytes=0-1048575"}, ""),
+            ({"status": "503"}, "Service Unavailable"),
+        ]
+    )
+    driver = GoogleDriveDriver(config)
+    with pytest.raises(DriverError):
+        driver.upload_file(src, "video.mp4")
+    with open(state_file) as f:
+        assert json.load(f)["folder1/video.mp4"]["uri"] == session_uri
+
+    http = google_drive_http(
+        [
+            FOLDER_LIST_RESPONSE,
+            # status of upload session
+            ({"status": "308", "range": "bytes=0-1048575"}, ""),
+            ({"status": "308", "range": "bytes=0-2097151"}, ""),
+            (
+                {"status": "200"},
+                '{"id": "file1", "webViewLink": "https://drive.google.com/file1"}',
+            ),
+        ]
+    )
+    driver = GoogleDriveDriver(config)
+    assert driver.upload_file(src, "video.mp4") == "https://drive.google.com/file1"
+    uploads = [r for r in http.requests if r[1] == session_uri]
+    assert [r[2].get("Content-Range") for r in uploads] == [
+        "bytes */2621440",
+        "bytes 1048576-2097151/2621440",
+        "bytes 2097152-2621439/2621440",
+    ]
+    with open(state_file) as f:
+        assert json.load(f) == {}
+
+
+def test_google_drive_upload_single_request(tmp_path, google_drive_http):
+    """Test small file is uploaded with single request which returns also link to the file"""
+    config.update(
+        {
+            "DRIVER": "google_drive",
+            "GOOGLE_DRIVE__SERVICE_ACCOUNT_FILE": "credentials.json",
+            "GOOGLE_DRIVE__FOLDER": "media",
+            "GOOGLE_DRIVE__SHARE_WITH": "",
+        }
+    )
+    src = str(tmp_path / "img.jpg")
+    with open(src, "wb") as f:
+        f.write(b"image")
+    http = google_drive_http(
+        [
+            FOLDER_LIST_RESPONSE,
+            (
+                {"status": "200"},
+                '{"id": "file1", "webViewLink": "https://drive.google.com/file1"}',
+            ),
+        ]
+    )
+    driver = GoogleDriveDriver(config)
+    http.requests.clear()
+    assert driver.upload_file(src, "img.jpg") == "https://drive.google.com/file1"
+    assert len(http.requests) == 1
+    assert "webViewLink" in http.requests[0][1]
+
+
+def test_google_drive_rate_limit_closes_files(tmp_path, google_drive_http, monkeypatch):
+    """Test rate limited uploads to Google Drive close uploaded files"""
+    config.update(
+        {
+            "DRIVER": "google_drive",
+            "GOOGLE_DRIVE__SERVICE_ACCOUNT_FILE": "credentials.json",
+            "GOOGLE_DRIVE__FOLDER": "media",
+            "GOOGLE_DRIVE__SHARE_WITH": "",
+            "RATE_LIMIT": {"bytes_per_second": 1000000},
+        }
+    )
+    src = str(tmp_path / "img.jpg")
+    with open(src, "wb") as f:
+        f.write(b"image")
+    opened = []
+
+    def tracking_open(*args, **kwargs):
+        f = open(*args, **kwargs)
+        opened.append(f)
+        return f
+
+    monkeypatch.setattr(google_drive_driver, "open", tracking_open, raising=False)
+    google_drive_http(
+        [
+            FOLDER_LIST_RESPONSE,
+            (
+                {"status": "200"},
+                '{"id": "file1", "webViewLink": "https://drive.google.com/file1"}',
+            ),
+        ]
+    )
+    driver = GoogleDriveDriver(config)
+    assert driver.upload_file(src, "img.jpg") == "https://drive.google.com/file1"
+    assert len(opened) == 1
+    assert opened[0].closed
@@ -0,0 +1,78 @@
+"""
+Mergin Media Sync - a tool to sync media files from Mergin projects to other storage backends
+
+Copyright (C) 2021 Lutra Consulting
+
+License: MIT
+"""
+
+import os
+
+import file_index
+from file_index import FileIndex, scan_project_files
+from mergin.utils import generate_checksum
+
+
+def _write(path, data, mtime=1700000000):
+    """Write file with modification time in the past unless mtime is None"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+
+
+def test_scan_with_index(tmp_path, monkeypatch):
+    """Test files are hashed again only if their stat signature changed"""
+    project_dir = str(tmp_path / "project")
+    index_path = str(tmp_path / "index.json")
+    _write(os.path.join(project_dir, "images", "img1.jpg"), b"img1")
+    _write(os.path.join(project_dir, "images", "img2.jpg"), b"img2")
+    _write(os.path.join(project_dir, "survey.gpkg-wal"), b"wal")
+    _write(os.path.join(project_dir, ".mergin", "mergin.json"), b"{}")
+
+    hashed = []
+
+    def counting_generate_checksum(path):
+        hashed.append(os.path.relpath(path, project_dir))
+        return generate_checksum(path)
+
+    monkeypatch.setattr(file_index, "generate_checksum", counting_generate_checksum)
+
+    def ignore(name):
+        return name.endswith("-wal")
+
+    files = scan_project_files(project_dir, ignore, FileIndex(index_path))
+    assert sorted(f["path"] for f in files) == ["images/img1.jpg", "images/img2.jpg"]
+    assert sorted(hashed) == [
+        os.path.join("images", "img1.jpg"),
+        os.path.join("images", "img2.jpg"),
+    ]
+    file = next(f for f in files if f["path"] == "images/img1.jpg")
+    assert file["checksum"] == generate_checksum(
+        os.path.join(project_dir, "images", "img1.jpg")
+    )
+    assert file["size"] == 4
+    # index was not saved so all files are hashed again
+    hashed.clear()
+    scan_project_files(project_dir, ignore, FileIndex(index_path))
+    assert len(hashed) == 2
+
+    index = FileIndex(index_path)
+    scan_project_files(project_dir, ignore, index)
+    index.save()
+    hashed.clear()
+    _write(os.path.join(project_dir, "images", "img2.jpg"), b"modified")
+    os.remove(os.path.join(project_dir, "images", "img1.jpg"))
+    files = scan_project_files(project_dir, ignore, FileIndex(index_path))
+    assert [f["path"] for f in files] == ["images/img2.jpg"]
+    assert hashed == [os.path.join("images", "img2.jpg")]
+
+    # recently modified file can change again within the same mtime tick, it is not indexed
+    index = FileIndex(index_path)
+    _write(os.path.join(project_dir, "images", "img3.jpg"), b"img3", mtime=None)
+    scan_project_files(project_dir, ignore, index)
+    index.save()
+    hashed.clear()
+    scan_project_files(project_dir, ignore, FileIndex(index_path))
+    assert hashed == [os.path.join("images", "img3.jpg")]
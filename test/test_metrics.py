@@ -0,0 +1,103 @@
+"""
+Mergin Media Sync - a tool to sync media files from Mergin projects to other storage backends
+
+Copyright (C) 2021 Lutra Consulting
+
+License: MIT
+"""
+
+import json
+import urllib.error
+import urllib.request
+
+import pytest
+
+from metrics import Metrics, start_metrics_server
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_metrics_render():
+    """Test metrics are rendered in Prometheus text format"""
+    clock = FakeClock()
+    metrics = Metrics(clock)
+    metrics.inc("files_uploaded_total", project="test/project")
+    metrics.inc("bytes_uploaded_total", 1024, project="test/project")
+    metrics.inc("bytes_uploaded_total", 1024, project="test/project")
+    metrics.add("uploads_in_flight", 1, project="test/project")
+    metrics.add("uploads_in_flight", -1, project="test/project")
+    metrics.set("retry_queue_files", 3, project='test/"quoted"')
+    with metrics.timer("upload", "test/project"):
+        clock.now += 1.5
+    with metrics.timer("upload", "test/project"):
+        clock.now += 0.5
+
+    assert metrics.get("bytes_uploaded_total", project="test/project") == 2048
+    assert metrics.get(
+        "stage_duration_seconds", stage="upload", project="test/project"
+    ) == (2.0, 2)
+    assert metrics.render().split("\n") == [
+        "# TYPE media_sync_bytes_uploaded_total counter",
+        'media_sync_bytes_uploaded_total{project="test/project"} 2048',
+        "# TYPE media_sync_files_uploaded_total counter",
+        'media_sync_files_uploaded_total{project="test/project"} 1',
+        "# TYPE media_sync_retry_queue_files gauge",
+        'media_sync_retry_queue_files{project="test/\\"quoted\\""} 3',
+        "# TYPE media_sync_stage_duration_seconds summary",
+        'media_sync_stage_duration_seconds_sum{project="test/project",stage="upload"} 2.000000',
+        'media_sync_stage_duration_seconds_count{project="test/project",stage="upload"} 2',
+        "# TYPE media_sync_uploads_in_flight gauge",
+        'media_sync_uploads_in_flight{project="test/project"} 0',
+        "",
+    ]
+
+
+def test_timer_json_logs(capsys):
+    """Test failed stage is recorded and logged as JSON line"""
+    clock = FakeClock()
+    metrics = Metrics(clock)
+    with metrics.timer("pull", "test/project"):
+        pass
+    # JSON logs are disabled by default
+    assert capsys.readouterr().out == ""
+
+    metrics.json_logs = True
+    with pytest.raises(RuntimeError):
+        with metrics.timer("upload", "test/project", bytes=100) as fields:
+            fields["path"] = "img.jpg"
+            clock.now += 2
+            raise RuntimeError("Network error")
+    line = json.loads(capsys.readouterr().out)
+    assert line["event"] == "timing"
+    assert line["stage"] == "upload"
+    assert line["duration"] == 2
+    assert line["bytes"] == 100
+    assert line["path"] == "img.jpg"
+    assert line["error"] == "Network error"
+    assert metrics.get(
+        "stage_duration_seconds", stage="upload", project="test/project"
+    ) == (2, 1)
+
+
+def test_metrics_server():
+    """Test metrics are served at /metrics endpoint"""
+    metrics = Metrics()
+    metrics.inc("sync_errors_total", project="test/project")
+    server = start_metrics_server(metrics, 0)
+    try:
+        url = f"http://127.0.0.1:{server.server_address[1]}"
+        with urllib.request.urlopen(url + "/metrics") as response:
+            assert response.headers["Content-Type"].startswith("text/plain")
+            body = response.read().decode()
+        assert 'media_sync_sync_errors_total{project="test/project"} 1' in body
+        with pytest.raises(urllib.error.HTTPError):
+            urllib.request.urlopen(url + "/other")
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,89 @@
+"""
+Mergin Media Sync - a tool to sync media files from Mergin projects to other storage backends
+
+Copyright (C) 2021 Lutra Consulting
+
+License: MIT
+"""
+
+import datetime
+import io
+
+from ratelimit import RateLimiter, ThrottledReader, TokenBucket
+
+
+class FakeClock:
+    """Clock which moves forward only when somebody sleeps"""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def test_token_bucket():
+    """Test tokens are taken in debt and callers wait until it is paid back"""
+    clock = FakeClock()
+    bucket = TokenBucket(100, clock=clock, sleep=clock.sleep)
+    # one second of burst is available right away
+    assert bucket.acquire(100) == 0
+    assert bucket.acquire(50) == 0.5
+    assert clock.now == 0.5
+    # bigger amount than capacity is allowed, caller waits longer
+    assert bucket.acquire(300) == 3
+    assert clock.now == 3.5
+    clock.now += 10
+    # saved tokens are capped by capacity
+    assert bucket.acquire(100) == 0
+    assert bucket.acquire(100) == 1
+
+
+def test_rate_limiter_windows():
+    """Test limits of active time window are applied"""
+    clock = FakeClock()
+    now = [datetime.datetime(2024, 1, 1, 12, 0)]
+    limiter = RateLimiter(
+        bytes_per_second=1000,
+        requests_per_second=2,
+        windows=[{"start": "22:00", "end": "06:00", "bytes_per_second": 0}],
+        clock=clock,
+        sleep=clock.sleep,
+        now=lambda: now[0],
+    )
+    assert limiter.is_limited()
+    assert limiter.throttle(3000) == 2
+    assert limiter.request() == 0
+    assert limiter.request() == 0
+    assert limiter.request() == 0.5
+
+    # no limit of bytes at night, requests are limited with default limit
+    now[0] = datetime.datetime(2024, 1, 1, 23, 30)
+    assert limiter.throttle(10**9) == 0
+    now[0] = datetime.datetime(2024, 1, 2, 5, 59)
+    assert limiter.throttle(10**9) == 0
+    now[0] = datetime.datetime(2024, 1, 2, 6, 0)
+    assert limiter.throttle(10**9) > 0
+    assert not RateLimiter().is_limited()
+
+
+def test_throttled_reader_fair_share():
+    """Test concurrent readers get fair share of bandwidth"""
+    clock = FakeClock()
+    limiter = RateLimiter(bytes_per_second=256 * 1024, clock=clock, sleep=clock.sleep)
+    big = ThrottledReader(io.BytesIO(b"x" * 10 * 256 * 1024), limiter)
+    small = ThrottledReader(io.BytesIO(b"y" * 2 * 256 * 1024), limiter)
+    # readers take turns in chunks, small file is not blocked until big file is read
+    done = {}
+    readers = {"big": big, "small": small}
+    while readers:
+        for name, reader in list(readers.items()):
+            if not reader.read(256 * 1024):
+                done[name] = clock.now
+                del readers[name]
+    assert done["small"] <= 4
+    assert done["big"] >= 11
+    assert big.tell() == 10 * 256 * 1024
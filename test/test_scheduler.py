@@ -0,0 +1,64 @@
+"""
+Mergin Media Sync - a tool to sync media files from Mergin projects to other storage backends
+
+Copyright (C) 2021 Lutra Consulting
+
+License: MIT
+"""
+
+from scheduler import PollScheduler
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_poll_backoff():
+    """Test idle projects are polled less often and changed project is polled again soon"""
+    clock = FakeClock()
+    scheduler = PollScheduler(
+        2, 10, max_interval=60, backoff_factor=2, clock=clock, rand=lambda: 0.5
+    )
+    assert scheduler.due() == [0, 1]
+
+    scheduler.record(0, False)
+    scheduler.record(1, True)
+    assert scheduler.due() == []
+    assert scheduler.time_to_next() == 10
+
+    clock.now = 10
+    assert scheduler.due() == [1]
+    scheduler.record(1, False)
+    assert scheduler.next_polls == [20, 30]
+
+    # interval is doubled with each poll without changes up to the max interval
+    for expected in [40, 60, 60]:
+        clock.now = scheduler.next_polls[0]
+        assert 0 in scheduler.due()
+        scheduler.record(0, False)
+        assert scheduler.intervals[0] == expected
+
+    # change resets interval to the min interval
+    clock.now = scheduler.next_polls[0]
+    scheduler.record(0, True)
+    assert scheduler.intervals[0] == 10
+    assert scheduler.next_polls[0] == clock.now + 10
+
+
+def test_poll_jitter():
+    """Test jitter spreads polls within relative bounds"""
+    clock = FakeClock()
+    values = iter([0.0, 0.999999])
+    scheduler = PollScheduler(
+        2, 100, jitter=0.2, clock=clock, rand=lambda: next(values)
+    )
+    scheduler.record(0, True)
+    scheduler.record(1, True)
+    assert scheduler.next_polls[0] == 80
+    assert round(scheduler.next_polls[1]) == 120
+    # without max interval polling interval is fixed
+    assert scheduler.max_interval == 100
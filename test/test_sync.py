@@ -8,10 +8,19 @@ License: MIT
 
 import pytest
 import os
+import media_sync
 import shutil
+import asyncio
 import sqlite3
-
-from drivers import MinioDriver, LocalDriver, GoogleDriveDriver
+import time
+import json
+
+from mergin import ClientError, MerginProject
+from mergin.utils import generate_checksum
+import drivers
+from drivers import LocalDriver, TransientDriverError, close_drivers
+from google_drive_driver import GoogleDriveDriver
+from minio_driver import MinioDriver
 from media_sync import (
     main,
     config,
@@ -19,8 +28,19 @@ from media_sync import (
     media_sync_push,
     mc_download,
     MediaSyncError,
+    _upload_files,
+    _upload_files_async,
+    _filter_synced_files,
+    _record_uploads,
+    _deduplicate_files,
+    ProjectContext,
+    _load_files_table,
+    _update_reference_table,
+    _update_references,
 )
 from config import validate_config, ConfigError
+from manifest import UploadManifest
+from metrics import metrics
 
 from .conftest import (
     API_USER,
@@ -37,7 +57,751 @@ from .conftest import (
     prepare_mergin_project,
 )
 
-from .utils import google_drive_delete_folder, google_drive_list_files_in_folder
+from .utils import (
+    google_drive_delete_folder,
+    google_drive_list_files_in_folder,
+    SlowDriver,
+    SlowAsyncDriver,
+    FakeMerginClient,
+)
+
+
+def _create_media_files(project_dir, count, size=1024):
+    """Create dummy media files in project directory and return their metadata"""
+    files = []
+    for i in range(count):
+        path = f"images/img{i}.jpg"
+        os.makedirs(os.path.join(project_dir, "images"), exist_ok=True)
+        with open(os.path.join(project_dir, path), "wb") as f:
+            f.write(os.urandom(size))
+        files.append({"path": path, "size": size})
+    return files
+
+
+def test_upload_files_concurrently(tmp_path):
+    """Test uploads are spread over pool of workers with per-file failures skipped"""
+    work_project_dir = str(tmp_path / "work")
+    driver_dir = str(tmp_path / "driver")
+    files = _create_media_files(work_project_dir, 8)
+    files.append({"path": "images/missing.jpg", "size": 0})
+    config.update(
+        {
+            "PROJECT_WORKING_DIR": work_project_dir,
+            "LOCAL__DEST": driver_dir,
+            "UPLOAD__WORKERS": 4,
+        }
+    )
+    driver = SlowDriver(config, latency=0.2, fail_paths=["images/img0.jpg"])
+
+    start = time.time()
+    migrated_files = _upload_files(driver, files)
+    duration = time.time() - start
+
+    assert driver.max_running == 4
+    assert duration < 8 * 0.2
+    # failed and missing files are skipped, rest is uploaded
+    assert sorted(migrated_files.keys()) == [f"images/img{i}.jpg" for i in range(1, 8)]
+    for path, dest in migrated_files.items():
+        assert dest == os.path.join(driver_dir, path)
+        assert os.path.exists(dest)
+
+    # single worker keeps uploads sequential
+    config.update({"UPLOAD__WORKERS": 1})
+    driver = SlowDriver(config, latency=0.01)
+    migrated_files = _upload_files(driver, files)
+    assert driver.max_running == 1
+    assert len(migrated_files) == 8
+
+
+def test_upload_files_async(tmp_path):
+    """Test asyncio upload engine with native async driver and adapted blocking driver"""
+    work_project_dir = str(tmp_path / "work")
+    driver_dir = str(tmp_path / "driver")
+    files = _create_media_files(work_project_dir, 50, size=16)
+    config.update(
+        {
+            "PROJECT_WORKING_DIR": work_project_dir,
+            "LOCAL__DEST": driver_dir,
+            "UPLOAD__WORKERS": 4,
+            "UPLOAD__MAX_IN_FLIGHT": 20,
+        }
+    )
+    async_driver = SlowAsyncDriver(latency=0.1)
+    migrated_files = asyncio.run(_upload_files_async(async_driver, files))
+    assert async_driver.max_running == 20
+    # driver is not closed, it is used by next batches
+    assert not async_driver.closed
+    close_drivers([async_driver, async_driver])
+    assert async_driver.closed
+    assert migrated_files == {f["path"]: "async://" + f["path"] for f in files}
+
+    # blocking driver is run in executor with upload.workers threads
+    driver = SlowDriver(config, latency=0.05, fail_paths=["images/img0.jpg"])
+    migrated_files = asyncio.run(_upload_files_async(driver, files))
+    assert driver.max_running == 4
+    assert len(migrated_files) == 49
+    assert "images/img0.jpg" not in migrated_files
+    assert os.path.exists(os.path.join(driver_dir, "images", "img1.jpg"))
+
+
+def test_upload_manifest(tmp_path):
+    """Test files recorded in manifest are not uploaded again unless they were changed"""
+    work_project_dir = str(tmp_path / "work")
+    files = _create_media_files(work_project_dir, 3)
+    config.update(
+        {
+            "MERGIN__PROJECT_NAME": "test/manifest",
+            "PROJECT_WORKING_DIR": work_project_dir,
+            "DRIVER": "local",
+            "LOCAL__DEST": str(tmp_path / "dest"),
+        }
+    )
+    manifest = UploadManifest(str(tmp_path / "state" / "manifest.sqlite"))
+    files_to_upload, synced_files = _filter_synced_files(manifest, files)
+    assert files_to_upload == files
+    assert not synced_files
+
+    migrated_files = {f["path"]: "/dest/" + f["path"] for f in files[:2]}
+    _record_uploads(manifest, files, migrated_files, "v1")
+    entry = manifest.get("test/manifest", "images/img0.jpg")
+    assert entry["version"] == "v1"
+    assert entry["dest"] == "/dest/images/img0.jpg"
+    manifest.close()
+
+    # manifest is persisted across runs
+    manifest = UploadManifest(str(tmp_path / "state" / "manifest.sqlite"))
+    files_to_upload, synced_files = _filter_synced_files(manifest, files)
+    assert files_to_upload == [files[2]]
+    assert synced_files == migrated_files
+
+    # driver provides current URLs of recorded files, e.g. presigned URLs which expire
+    class SigningDriver(LocalDriver):
+        def get_url(self, obj_path):
+            return "/signed/" + obj_path
+
+    _, synced_files = _filter_synced_files(
+        manifest, files, driver=SigningDriver(config)
+    )
+    assert synced_files == {f["path"]: "/signed/" + f["path"] for f in files[:2]}
+
+    # modified file needs to be uploaded again
+    with open(os.path.join(work_project_dir, files[0]["path"]), "wb") as f:
+        f.write(b"modified")
+    files_to_upload, synced_files = _filter_synced_files(manifest, files)
+    assert files_to_upload == [files[0], files[2]]
+
+    # files uploaded by other driver or of other project are not skipped
+    config.update({"DRIVER": "minio"})
+    assert _filter_synced_files(manifest, files)[0] == files
+    config.update({"DRIVER": "local", "MERGIN__PROJECT_NAME": "test/other"})
+    assert _filter_synced_files(manifest, files)[0] == files
+    # nor files uploaded to other destination
+    config.update(
+        {"MERGIN__PROJECT_NAME": "test/manifest", "LOCAL__DEST": str(tmp_path / "new")}
+    )
+    assert _filter_synced_files(manifest, files)[0] == files
+    manifest.close()
+
+
+def test_deduplicate_files(tmp_path):
+    """Test files with the same content are uploaded only once"""
+    work_project_dir = str(tmp_path / "work")
+    files = _create_media_files(work_project_dir, 3)
+    for path in ["copy_a.jpg", "images/copy_b.jpg"]:
+        shutil.copyfile(
+            os.path.join(work_project_dir, files[0]["path"]),
+            os.path.join(work_project_dir, path),
+        )
+        files.append({"path": path, "size": 1024})
+    files.append({"path": "missing.jpg", "size": 1024})
+    config.update(
+        {
+            "MERGIN__PROJECT_NAME": "test/dedup",
+            "PROJECT_WORKING_DIR": work_project_dir,
+            "DRIVER": "local",
+            "UPLOAD__DEDUPLICATE": True,
+        }
+    )
+    files_to_upload, duplicates = _deduplicate_files(files)
+    assert [f["path"] for f in files_to_upload] == [
+        "images/img0.jpg",
+        "images/img1.jpg",
+        "images/img2.jpg",
+        "missing.jpg",
+    ]
+    assert duplicates == {"images/img0.jpg": ["copy_a.jpg", "images/copy_b.jpg"]}
+
+    # content uploaded in previous run under different path is not uploaded again
+    manifest = UploadManifest(str(tmp_path / "manifest.sqlite"))
+    _record_uploads(manifest, files[:1], {"images/img0.jpg": "/dest/img0.jpg"}, "v1")
+    files_to_upload, synced_files = _filter_synced_files(manifest, files[1:])
+    assert synced_files == {
+        "copy_a.jpg": "/dest/img0.jpg",
+        "images/copy_b.jpg": "/dest/img0.jpg",
+    }
+    assert len(files_to_upload) == 3
+    manifest.close()
+
+
+def test_skip_existing_files(tmp_path):
+    """Test files already present at destination are not uploaded again after manifest was lost"""
+    work_project_dir = str(tmp_path / "work")
+    files = _create_media_files(work_project_dir, 3)
+    _create_mergin_project(work_project_dir, "v1", files)
+    config.update(
+        {
+            "MERGIN__PROJECT_NAME": "test/existing",
+            "PROJECT_WORKING_DIR": work_project_dir,
+            "LOCAL__DEST": str(tmp_path / "driver"),
+            "DRIVER": "local",
+            "MANIFEST__FILE": str(tmp_path / "manifest.sqlite"),
+            "UPLOAD__SKIP_EXISTING": True,
+        }
+    )
+    mc = FakeMerginClient({"test/existing": "v1"})
+    driver = SlowDriver(config, latency=0)
+    media_sync_push(mc, driver, files)
+    assert len(driver.uploaded) == 3
+
+    # file at destination differs from local one
+    with open(str(tmp_path / "driver" / "images" / "img2.jpg"), "wb") as f:
+        f.write(os.urandom(1024))
+    os.remove(str(tmp_path / "manifest.sqlite"))
+    driver = SlowDriver(config, latency=0)
+    media_sync_push(mc, driver, files)
+    assert driver.uploaded == ["images/img2.jpg"]
+    # existing files are recorded in new manifest
+    manifest = UploadManifest(str(tmp_path / "manifest.sqlite"))
+    assert manifest.get("test/existing", "images/img0.jpg")["dest"] == str(
+        tmp_path / "driver" / "images" / "img0.jpg"
+    )
+    manifest.close()
+
+
+def test_server_side_copy(tmp_path):
+    """Test content uploaded before under different path is copied by driver instead of uploaded"""
+    work_project_dir = str(tmp_path / "work")
+    files = _create_media_files(work_project_dir, 2)
+    copies = [
+        {"path": "images/renamed.jpg", "size": 1024},
+        {"path": "images/img1_copy.jpg", "size": 1024},
+    ]
+    for file, copy in zip(files, copies):
+        shutil.copyfile(
+            os.path.join(work_project_dir, file["path"]),
+            os.path.join(work_project_dir, copy["path"]),
+        )
+    duplicates = [{"path": "dup_a.jpg", "size": 9}, {"path": "dup_b.jpg", "size": 9}]
+    for duplicate in duplicates:
+        with open(os.path.join(work_project_dir, duplicate["path"]), "wb") as f:
+            f.write(b"duplicate")
+    _create_mergin_project(work_project_dir, "v1", files + copies + duplicates)
+    config.update(
+        {
+            "MERGIN__PROJECT_NAME": "test/copy",
+            "PROJECT_WORKING_DIR": work_project_dir,
+            "LOCAL__DEST": str(tmp_path / "driver"),
+            "DRIVER": "local",
+            "MANIFEST__FILE": str(tmp_path / "manifest.sqlite"),
+        }
+    )
+
+    class CopyingDriver(SlowDriver):
+        def copy_file(self, src_path, obj_path):
+            src = os.path.join(self.dest, src_path)
+            if not os.path.exists(src):
+                return None
+            shutil.copyfile(src, os.path.join(self.dest, obj_path))
+            self.copied.append(obj_path)
+            return os.path.join(self.dest, obj_path)
+
+    mc = FakeMerginClient({"test/copy": "v1"})
+    driver = CopyingDriver(config, latency=0)
+    driver.copied = []
+    media_sync_push(mc, driver, files)
+    assert sorted(driver.uploaded) == ["images/img0.jpg", "images/img1.jpg"]
+
+    media_sync_push(mc, driver, copies[:1])
+    assert driver.copied == ["images/renamed.jpg"]
+    assert sorted(driver.uploaded) == ["images/img0.jpg", "images/img1.jpg"]
+    assert os.path.exists(str(tmp_path / "driver" / "images" / "renamed.jpg"))
+
+    # object removed from storage meanwhile is uploaded again
+    os.remove(str(tmp_path / "driver" / "images" / "img1.jpg"))
+    media_sync_push(mc, driver, copies[1:])
+    assert "images/img1_copy.jpg" in driver.uploaded
+
+    # duplicates are recorded with object uploaded under path of original file
+    config.update({"UPLOAD__DEDUPLICATE": True})
+    media_sync_push(mc, driver, duplicates)
+    manifest = UploadManifest(str(tmp_path / "manifest.sqlite"))
+    assert manifest.get("test/copy", "dup_b.jpg")["object"] == "dup_a.jpg"
+    manifest.close()
+
+
+@pytest.mark.parametrize("operation_mode", ["copy", "move"])
+def test_update_reference_table(operation_mode):
+    """Test references are updated in bulk with single statement"""
+    config.update(
+        {
+            "OPERATION_MODE": operation_mode,
+            "REFERENCES": [
+                {
+                    "file": "survey.gpkg",
+                    "table": "notes",
+                    "local_path_column": "photo",
+                    "driver_path_column": "ext_url",
+                }
+            ],
+        }
+    )
+    conn = sqlite3.connect(":memory:")
+    cur = conn.cursor()
+    cur.execute(
+        "CREATE TABLE notes (fid INTEGER PRIMARY KEY, photo TEXT, ext_url TEXT)"
+    )
+    cur.executemany(
+        "INSERT INTO notes (photo, ext_url) VALUES (?, ?)",
+        [(f"img{i}.jpg", None) for i in range(100)] + [("other.jpg", "keep")],
+    )
+    files = {f"img{i}.jpg": f"/dest/img{i}.jpg" for i in range(0, 100, 2)}
+
+    _load_files_table(cur, files)
+    _update_reference_table(cur, config.references[0])
+    conn.commit()
+
+    rows = {
+        fid: (photo, ext_url)
+        for fid, photo, ext_url in cur.execute("SELECT fid, photo, ext_url FROM notes")
+    }
+    for i in range(100):
+        photo, ext_url = rows[i + 1]
+        if i % 2:
+            assert (photo, ext_url) == (f"img{i}.jpg", None)
+        elif operation_mode == "move":
+            assert (photo, ext_url) == (None, f"/dest/img{i}.jpg")
+        else:
+            assert (photo, ext_url) == (f"img{i}.jpg", f"/dest/img{i}.jpg")
+    assert rows[101] == ("other.jpg", "keep")
+
+
+def test_update_references_per_file(tmp_path, monkeypatch):
+    """Test tables in the same GeoPackage are updated using single connection"""
+    work_project_dir = str(tmp_path)
+    tables = ["notes", "trees", "poles"]
+    conn = sqlite3.connect(os.path.join(work_project_dir, "survey.gpkg"))
+    for table in tables:
+        conn.execute(
+            f"CREATE TABLE {table} (fid INTEGER PRIMARY KEY, photo TEXT, ext_url TEXT)"
+        )
+        conn.execute(f"INSERT INTO {table} (photo) VALUES ('img1.png')")
+    # trigger which needs function only available with extension
+    conn.execute(
+        "CREATE TRIGGER poles_update AFTER UPDATE ON poles WHEN ST_IsEmpty(NEW.photo) BEGIN SELECT 1; END"
+    )
+    conn.commit()
+    conn.close()
+    config.update(
+        {
+            "PROJECT_WORKING_DIR": work_project_dir,
+            "OPERATION_MODE": "copy",
+            "REFERENCES": [
+                {
+                    "file": "survey.gpkg",
+                    "table": table,
+                    "local_path_column": "photo",
+                    "driver_path_column": "ext_url",
+                }
+                for table in tables
+            ],
+        }
+    )
+
+    connections = []
+    connect = sqlite3.connect
+
+    def counting_connect(*args, **kwargs):
+        connections.append(args[0])
+        return connect(*args, **kwargs)
+
+    extension_loads = []
+
+    def fake_load_spatialite(gpkg_conn):
+        extension_loads.append(gpkg_conn)
+        gpkg_conn.create_function("ST_IsEmpty", 1, lambda geom: geom is None)
+
+    monkeypatch.setattr(sqlite3, "connect", counting_connect)
+    monkeypatch.setattr(media_sync, "_load_spatialite", fake_load_spatialite)
+    _update_references({"img1.png": "/dest/img1.png"})
+    monkeypatch.undo()
+
+    assert len(connections) == 1
+    # extension was loaded only once for the table with trigger
+    assert len(extension_loads) == 1
+    conn = sqlite3.connect(os.path.join(work_project_dir, "survey.gpkg"))
+    for table in tables:
+        assert (
+            conn.execute(f"SELECT ext_url FROM {table}").fetchone()[0]
+            == "/dest/img1.png"
+        )
+    conn.close()
+
+
+def _create_mergin_project(project_dir, version, files=None):
+    """Create local working directory of Mergin project with given version and files"""
+    os.makedirs(os.path.join(project_dir, ".mergin"))
+    files_meta = [
+        {
+            "path": f["path"],
+            "size": f["size"],
+            "checksum": generate_checksum(os.path.join(project_dir, f["path"])),
+            "mtime": "2024-01-01T00:00:00+00:00",
+        }
+        for f in files or []
+    ]
+    with open(os.path.join(project_dir, ".mergin", "mergin.json"), "w") as f:
+        json.dump(
+            {
+                "name": "project",
+                "namespace": "test",
+                "version": version,
+                "files": files_meta,
+            },
+            f,
+        )
+
+
+def test_pull_without_changes(tmp_path, monkeypatch):
+    """Test pull with no new version on server does single API call and does not scan working dir"""
+    work_project_dir = str(tmp_path / "project")
+    _create_mergin_project(work_project_dir, "v2")
+    config.update({"PROJECT_WORKING_DIR": work_project_dir})
+
+    scans = []
+    get_push_changes = MerginProject.get_push_changes
+
+    def counting_get_push_changes(mp):
+        scans.append(mp.dir)
+        return get_push_changes(mp)
+
+    monkeypatch.setattr(MerginProject, "get_push_changes", counting_get_push_changes)
+    mc = FakeMerginClient({"test/project": "v2"})
+    assert mc_pull(mc) is None
+    assert mc.calls == ["get_projects_by_names"]
+    assert scans == []
+
+    # new version on server, local changes are checked before pull
+    mc = FakeMerginClient({"test/project": "v3"})
+    _create_media_files(work_project_dir, 1)
+    with pytest.raises(MediaSyncError, match="There are pending changes"):
+        mc_pull(mc)
+    assert mc.calls == ["get_projects_by_names"]
+    assert len(scans) == 1
+
+    with pytest.raises(MediaSyncError, match="Unable to get project version"):
+        mc_pull(FakeMerginClient({}))
+
+
+def test_project_context(tmp_path, monkeypatch):
+    """Test local files are inspected once and only touched files are inspected again"""
+    work_project_dir = str(tmp_path / "project")
+    files = _create_media_files(work_project_dir, 3)
+    _create_mergin_project(work_project_dir, "v1", files)
+    config.update({"PROJECT_WORKING_DIR": work_project_dir})
+
+    scans = []
+    scan_project_files = media_sync.scan_project_files
+
+    def counting_scan_project_files(directory, *args):
+        scans.append(directory)
+        return scan_project_files(directory, *args)
+
+    monkeypatch.setattr(media_sync, "scan_project_files", counting_scan_project_files)
+    ctx = ProjectContext(config)
+    assert ctx.mp.get_push_changes()["updated"] == []
+    assert len(scans) == 1
+
+    # modified file is detected only once it is invalidated
+    with open(os.path.join(work_project_dir, files[0]["path"]), "wb") as f:
+        f.write(b"modified")
+    os.remove(os.path.join(work_project_dir, files[1]["path"]))
+    assert ctx.mp.get_push_changes()["updated"] == []
+    ctx.invalidate([files[0]["path"], files[1]["path"]])
+    ctx.reload()
+    status_push = ctx.mp.get_push_changes()
+    assert [f["path"] for f in status_push["updated"]] == [files[0]["path"]]
+    assert status_push["updated"][0]["size"] == len(b"modified")
+    assert [f["path"] for f in status_push["removed"]] == [files[1]["path"]]
+    assert len(scans) == 1
+
+
+def test_push_in_batches(tmp_path, monkeypatch):
+    """Test uploaded files are committed in batches as uploads complete"""
+    work_project_dir = str(tmp_path / "project")
+    files = _create_media_files(work_project_dir, 5)
+    _create_mergin_project(work_project_dir, "v1", files)
+    config.update(
+        {
+            "MERGIN__PROJECT_NAME": "test/project",
+            "PROJECT_WORKING_DIR": work_project_dir,
+            "LOCAL__DEST": str(tmp_path / "driver"),
+            "DRIVER": "local",
+            "MANIFEST__FILE": str(tmp_path / "manifest.sqlite"),
+            "UPLOAD__WORKERS": 2,
+            "UPLOAD__BATCH_SIZE": 2,
+        }
+    )
+    batches = []
+    monkeypatch.setattr(
+        media_sync, "_update_references", lambda files, config: batches.append(files)
+    )
+    mc = FakeMerginClient({"test/project": "v1"})
+    driver = SlowDriver(config, latency=0.01)
+    media_sync_push(mc, driver, files)
+    assert [len(b) for b in batches] == [2, 2, 1]
+    assert sorted(p for b in batches for p in b) == [f["path"] for f in files]
+    # nothing changed in project so there is nothing to push
+    assert mc.calls == []
+
+    # interrupted sync keeps files committed in previous batches
+    os.remove(str(tmp_path / "manifest.sqlite"))
+    batches.clear()
+
+    class FailingDriver(SlowDriver):
+        def upload_file(self, src, obj_path):
+            if len(self.uploaded) == 3:
+                raise RuntimeError("Interrupted")
+            return super(FailingDriver, self).upload_file(src, obj_path)
+
+    config.update({"UPLOAD__WORKERS": 1})
+    with pytest.raises(RuntimeError):
+        media_sync_push(mc, FailingDriver(config, latency=0.01), files)
+    assert [len(b) for b in batches] == [2]
+    manifest = UploadManifest(str(tmp_path / "manifest.sqlite"))
+    for file in files:
+        assert (manifest.get("test/project", file["path"]) is not None) == (
+            file["path"] in batches[0]
+        )
+    manifest.close()
+
+
+def test_push_checkpoints(tmp_path):
+    """Test long sync pushes committed files to Mergin in checkpoints"""
+    work_project_dir = str(tmp_path / "project")
+    files = _create_media_files(work_project_dir, 5)
+    _create_mergin_project(work_project_dir, "v1", files)
+    config.update(
+        {
+            "MERGIN__PROJECT_NAME": "test/project",
+            "PROJECT_WORKING_DIR": work_project_dir,
+            "LOCAL__DEST": str(tmp_path / "driver"),
+            "DRIVER": "local",
+            "OPERATION_MODE": "move",
+            "UPLOAD__BATCH_SIZE": 2,
+            "CHECKPOINT__FILES": 2,
+        }
+    )
+    mc = FakeMerginClient({"test/project": "v1"})
+    driver = SlowDriver(config, latency=0.01)
+    media_sync_push(mc, driver, files)
+    # two checkpoints and the last batch at the end
+    assert mc.calls == ["push_project"] * 3
+    assert mc.versions["test/project"] == "v4"
+    assert not os.path.exists(os.path.join(work_project_dir, "images", "img0.jpg"))
+
+    # checkpoint is not postponed until the end of batch
+    shutil.rmtree(work_project_dir)
+    files = _create_media_files(work_project_dir, 5)
+    _create_mergin_project(work_project_dir, "v1", files)
+    config.update({"UPLOAD__BATCH_SIZE": 0})
+    mc = FakeMerginClient({"test/project": "v1"})
+    media_sync_push(mc, SlowDriver(config, latency=0.01), files)
+    assert mc.calls == ["push_project"] * 3
+
+    # checkpoint by time since last push
+    config.update({"CHECKPOINT__FILES": None, "CHECKPOINT__MINUTES": 1})
+    assert not media_sync._is_checkpoint_due(10, time.monotonic())
+    assert media_sync._is_checkpoint_due(10, time.monotonic() - 60)
+    assert not media_sync._is_checkpoint_due(0, time.monotonic() - 60)
+
+
+@pytest.mark.parametrize("manifest", [False, True])
+def test_retry_failed_uploads(tmp_path, manifest):
+    """Test files which failed to upload are retried in later runs"""
+    work_project_dir = str(tmp_path / "project")
+    files = _create_media_files(work_project_dir, 3)
+    _create_mergin_project(work_project_dir, "v1", files)
+    config.update(
+        {
+            "MERGIN__PROJECT_NAME": "test/retry-" + str(manifest),
+            "PROJECT_WORKING_DIR": work_project_dir,
+            "LOCAL__DEST": str(tmp_path / "driver"),
+            "DRIVER": "local",
+            "MANIFEST__FILE": str(tmp_path / "manifest.sqlite") if manifest else "",
+            "RETRY__QUEUE_DELAY": 0.1,
+        }
+    )
+    mc = FakeMerginClient({})
+    driver = SlowDriver(config, latency=0, fail_paths=["images/img1.jpg"])
+    media_sync_push(mc, driver, files)
+    assert sorted(driver.uploaded) == ["images/img0.jpg", "images/img2.jpg"]
+    project = config.mergin.project_name
+    assert metrics.get("retry_queue_files", project=project) == 1
+    assert metrics.get("upload_failures_total", project=project) == 1
+    assert metrics.get("files_uploaded_total", project=project) == 2
+
+    # failed file is retried only after delay, also when pull returned no changes
+    driver = SlowDriver(config, latency=0)
+    media_sync_push(mc, driver, None)
+    assert driver.uploaded == []
+    time.sleep(0.1)
+
+    # local changes are not pushed together with retried files
+    img2 = os.path.join(work_project_dir, "images", "img2.jpg")
+    with open(img2, "rb") as f:
+        content = f.read()
+    with open(img2, "wb") as f:
+        f.write(b"edited by hand")
+    with pytest.raises(MediaSyncError, match="There are pending changes"):
+        media_sync_push(mc, driver, None)
+    assert driver.uploaded == []
+    assert "push_project" not in mc.calls
+    with open(img2, "wb") as f:
+        f.write(content)
+
+    media_sync_push(mc, driver, [])
+    assert driver.uploaded == ["images/img1.jpg"]
+    assert metrics.get("retry_queue_files", project=project) == 0
+
+    # successfully uploaded file is removed from queue
+    time.sleep(0.1)
+    media_sync_push(mc, driver, [])
+    assert driver.uploaded == ["images/img1.jpg"]
+
+
+def test_retry_failed_duplicates(tmp_path):
+    """Test duplicates of file which failed to upload are retried together with it"""
+    work_project_dir = str(tmp_path / "project")
+    files = _create_media_files(work_project_dir, 2)
+    shutil.copyfile(
+        os.path.join(work_project_dir, "images", "img0.jpg"),
+        os.path.join(work_project_dir, "dup.jpg"),
+    )
+    files.append({"path": "dup.jpg", "size": 1024})
+    _create_mergin_project(work_project_dir, "v1", files)
+    config.update(
+        {
+            "MERGIN__PROJECT_NAME": "test/retry-dup",
+            "PROJECT_WORKING_DIR": work_project_dir,
+            "LOCAL__DEST": str(tmp_path / "driver"),
+            "DRIVER": "local",
+            "OPERATION_MODE": "move",
+            "UPLOAD__DEDUPLICATE": True,
+            "RETRY__QUEUE_DELAY": 0.01,
+        }
+    )
+    mc = FakeMerginClient({"test/retry-dup": "v1"})
+    driver = SlowDriver(config, latency=0, fail_paths=["images/img0.jpg"])
+    media_sync_push(mc, driver, files)
+    assert driver.uploaded == ["images/img1.jpg"]
+    assert os.path.exists(os.path.join(work_project_dir, "dup.jpg"))
+
+    time.sleep(0.01)
+    driver = SlowDriver(config, latency=0)
+    media_sync_push(mc, driver, [])
+    # content is uploaded once, either of paths can be chosen
+    assert len(driver.uploaded) == 1
+    # duplicate is committed too, i.e. removed in move mode
+    assert not os.path.exists(os.path.join(work_project_dir, "images", "img0.jpg"))
+    assert not os.path.exists(os.path.join(work_project_dir, "dup.jpg"))
+
+
+def test_retry_interrupted_sync(tmp_path):
+    """Test failed and uncommitted files are queued when sync is interrupted"""
+    work_project_dir = str(tmp_path / "project")
+    files = _create_media_files(work_project_dir, 4)
+    _create_mergin_project(work_project_dir, "v1", files)
+    config.update(
+        {
+            "MERGIN__PROJECT_NAME": "test/retry-interrupted",
+            "PROJECT_WORKING_DIR": work_project_dir,
+            "LOCAL__DEST": str(tmp_path / "driver"),
+            "DRIVER": "local",
+            "OPERATION_MODE": "move",
+            "UPLOAD__BATCH_SIZE": 2,
+            "CHECKPOINT__FILES": 2,
+            "RETRY__QUEUE_DELAY": 0.01,
+        }
+    )
+
+    class LockedMerginClient(FakeMerginClient):
+        def push_project(self, directory):
+            raise ClientError("Project is locked")
+
+    mc = LockedMerginClient({"test/retry-interrupted": "v1"})
+    driver = SlowDriver(config, latency=0, fail_paths=["images/img0.jpg"])
+    with pytest.raises(MediaSyncError, match="Project is locked"):
+        media_sync_push(mc, driver, files)
+    # the first batch was committed locally, the rest was not uploaded or committed yet
+    project = config.mergin.project_name
+    assert media_sync._retry_queue.count_failed(project) == 2
+
+    time.sleep(0.01)
+    mc = FakeMerginClient({"test/retry-interrupted": "v1"})
+    driver = SlowDriver(config, latency=0)
+    # changes of the first batch were not pushed, they need to be reviewed first
+    with pytest.raises(MediaSyncError, match="There are pending changes"):
+        media_sync_push(mc, driver, [])
+    assert driver.uploaded == []
+    mc.push_project(work_project_dir)
+    media_sync_push(mc, driver, [])
+    assert sorted(driver.uploaded) == ["images/img0.jpg", "images/img3.jpg"]
+    assert not os.listdir(os.path.join(work_project_dir, "images"))
+    assert media_sync._retry_queue.count_failed(project) == 0
+
+
+class NativeAsyncDriver(SlowAsyncDriver):
+    """Driver of plugin with asyncio interface only, the first upload fails with transient error"""
+
+    def __init__(self, config):
+        super(NativeAsyncDriver, self).__init__(latency=0)
+        self.attempts = 0
+
+    async def upload_file_async(self, src, obj_path):
+        self.attempts += 1
+        if self.attempts == 1:
+            raise TransientDriverError("Connection reset")
+        return await super(NativeAsyncDriver, self).upload_file_async(src, obj_path)
+
+
+def test_native_async_driver(tmp_path, monkeypatch):
+    """Test driver with asyncio interface keeps it when wrapped by retrying driver"""
+    work_project_dir = str(tmp_path / "project")
+    files = _create_media_files(work_project_dir, 3)
+    _create_mergin_project(work_project_dir, "v1", files)
+    monkeypatch.setattr(drivers, "_drivers", dict(drivers._drivers))
+    drivers.register_driver("native_async", NativeAsyncDriver)
+    config.update(
+        {
+            "MERGIN__PROJECT_NAME": "test/native-async",
+            "PROJECT_WORKING_DIR": work_project_dir,
+            "DRIVER": "native_async",
+            "UPLOAD__ENGINE": "asyncio",
+            "UPLOAD__BATCH_SIZE": 2,
+            "RETRY__BACKOFF": 0,
+            "REFERENCES": [],
+        }
+    )
+    (driver,) = drivers.create_drivers([config])
+    assert drivers.as_async_driver(driver) is driver
+    mc = FakeMerginClient({"test/native-async": "v1"})
+    media_sync_push(mc, driver, files)
+    # failed attempt is repeated, driver is used by all batches and stays open
+    assert driver.driver.attempts == 4
+    assert not driver.driver.closed
+    assert media_sync._retry_queue.count_failed("test/native-async") == 0
+    drivers.close_drivers([driver])
+    assert driver.driver.closed
 
 
 def test_sync(mc):
@@ -1,5 +1,102 @@
+import asyncio
+import json
+import threading
+import time
 import typing
-from drivers import GoogleDriveDriver
+from mergin import MerginProject
+from drivers import AsyncDriver, DriverError, LocalDriver
+from google_drive_driver import GoogleDriveDriver
+
+
+class SlowDriver(LocalDriver):
+    """Local driver with artificial latency, tracks number of concurrent uploads"""
+
+    def __init__(self, config, latency=0.1, fail_paths=None):
+        super(SlowDriver, self).__init__(config)
+        self.latency = latency
+        self.fail_paths = fail_paths or []
+        self.uploaded = []
+        self.running = 0
+        self.max_running = 0
+        self._lock = threading.Lock()
+
+    def upload_file(self, src, obj_path):
+        with self._lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        try:
+            time.sleep(self.latency)
+            if obj_path in self.fail_paths:
+                raise DriverError("Slow driver error: " + obj_path)
+            dest = super(SlowDriver, self).upload_file(src, obj_path)
+            with self._lock:
+                self.uploaded.append(obj_path)
+            return dest
+        finally:
+            with self._lock:
+                self.running -= 1
+
+
+class SlowAsyncDriver(AsyncDriver):
+    """Native asyncio driver with artificial latency, only pretends to upload files"""
+
+    def __init__(self, latency=0.1):
+        self.latency = latency
+        self.running = 0
+        self.max_running = 0
+        self.closed = False
+
+    async def upload_file_async(self, src, obj_path):
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        try:
+            await asyncio.sleep(self.latency)
+            return "async://" + obj_path
+        finally:
+            self.running -= 1
+
+    async def close(self):
+        self.closed = True
+
+
+class FakeMerginClient:
+    """Stand-in for MerginClient which reports project versions and records API calls"""
+
+    def __init__(self, versions):
+        self.versions = versions
+        self.calls = []
+
+    def get_projects_by_names(self, projects):
+        self.calls.append("get_projects_by_names")
+        return {
+            name: (
+                {"version": self.versions[name]}
+                if name in self.versions
+                else {"error": 404}
+            )
+            for name in projects
+        }
+
+    def project_info(self, project_path, since=None, version=None):
+        self.calls.append("project_info")
+        return {"version": self.versions[project_path], "files": []}
+
+    def pull_project(self, directory):
+        self.calls.append("pull_project")
+
+    def push_project(self, directory):
+        """Pretend local changes were pushed, server version is incremented"""
+        self.calls.append("push_project")
+        mp = MerginProject(directory)
+        metadata_path = mp.fpath_meta("mergin.json")
+        with open(metadata_path, "r") as f:
+            metadata = json.load(f)
+        version = "v" + str(int(metadata["version"][1:]) + 1)
+        metadata["version"] = version
+        metadata["files"] = mp.inspect_files()
+        with open(metadata_path, "w") as f:
+            json.dump(metadata, f, default=str)
+        self.versions[mp.project_full_name()] = version
 
 
 def google_drive_delete_folder(driver: GoogleDriveDriver, folder_name: str) -> None: